@@ -0,0 +1,399 @@
+"""
+Offer analytics: how often each offer is listed in /api/nearby_offers
+responses (impressions) and how often it triggers a proximity notification
+on a user's device.
+
+Request threads only append an event to a fixed-size ring buffer, without
+taking a lock. A background thread drains it every ANALYTICS_FLUSH_SECONDS
+into per-offer, per-hour counters, kept in memory for the dashboard window
+and written to the configured sink as one batch of deltas per flush:
+
+- memory: nothing persisted (default)
+- file: an append-only JSON lines file of deltas, replayed on startup
+- sqlite: a table of hourly counters, added to by every worker, which the
+  dashboard then reads instead of this worker's memory
+
+When writers outrun the flusher the oldest unread events are overwritten
+and counted as dropped.
+"""
+import atexit
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from metrics import registry
+from storage import ConnectionPool
+
+ANALYTICS_SINKS = ('memory', 'file', 'sqlite')
+ANALYTICS_BUFFER_SIZE = int(os.environ.get('ANALYTICS_BUFFER_SIZE', 65536))
+ANALYTICS_FLUSH_SECONDS = float(os.environ.get('ANALYTICS_FLUSH_SECONDS', 5))
+# Hours of counters kept in memory and shown on the dashboard
+STATS_WINDOW_HOURS = 7 * 24
+# Offers accepted in one proximity report from a client
+MAX_REPORTED_OFFERS = 100
+
+# Event kinds, also the index of their counter
+IMPRESSION = 0
+PROXIMITY_HIT = 1
+
+
+def current_hour(now=None):
+    return int(time.time() if now is None else now) // 3600
+
+
+class EventBuffer:
+    """
+    Ring buffer with many writers and a single reader.
+    A writer claims a sequence number from an itertools.count, which is
+    atomic under the GIL, and stores (sequence, event) in its slot, so
+    appends never wait on each other or on the reader. The reader checks
+    each slot's sequence: an older one means the writer has not stored it
+    yet (read it on the next drain), a newer one means the slot was
+    overwritten and the events in between were dropped
+    """
+
+    def __init__(self, capacity=ANALYTICS_BUFFER_SIZE):
+        self.capacity = capacity
+        self.dropped = 0
+        self._slots = [None] * capacity
+        self._sequence = itertools.count()
+        self._read = 0
+
+    def append(self, event):
+        sequence = next(self._sequence)
+        self._slots[sequence % self.capacity] = (sequence, event)
+
+    def drain(self):
+        """
+        Events appended since the last drain, oldest first. Only the flusher
+        thread calls it
+        """
+        slots, capacity = self._slots, self.capacity
+        read = self._read
+        events = []
+        while len(events) < capacity:
+            entry = slots[read % capacity]
+            if entry is None or entry[0] < read:
+                break
+            if entry[0] > read:
+                # Lapped: the slots after this one hold the oldest survivors
+                oldest = entry[0] - capacity + 1
+                self.dropped += oldest - read
+                read = oldest
+                continue
+            events.append(entry[1])
+            read += 1
+        self._read = read
+        return events
+
+    @property
+    def flushed(self):
+        return self._read - self.dropped
+
+
+class OfferStats:
+    """
+    offer_id -> {hour: [impressions, proximity hits]} over the last
+    window_hours
+    """
+
+    def __init__(self, window_hours=STATS_WINDOW_HOURS):
+        self.window_hours = window_hours
+        self._hours = {}
+        self._lock = threading.Lock()
+
+    def add(self, deltas):
+        """
+        Add {(offer_id, hour): [impressions, proximity hits]} deltas
+        """
+        oldest = current_hour() - self.window_hours
+        with self._lock:
+            for (offer_id, hour), (impressions, proximity_hits) in deltas.items():
+                if hour <= oldest:
+                    continue
+                counts = self._hours.setdefault(offer_id, {}).setdefault(hour, [0, 0])
+                counts[IMPRESSION] += impressions
+                counts[PROXIMITY_HIT] += proximity_hits
+
+    def prune(self):
+        """
+        Drop the hours that left the window
+        """
+        oldest = current_hour() - self.window_hours
+        with self._lock:
+            for offer_id in list(self._hours):
+                hours = self._hours[offer_id]
+                for hour in [hour for hour in hours if hour <= oldest]:
+                    del hours[hour]
+                if not hours:
+                    del self._hours[offer_id]
+
+    def totals(self, offer_ids, since_hour):
+        """
+        {offer_id: (impressions, proximity hits)} from since_hour on
+        """
+        totals = {}
+        with self._lock:
+            for offer_id in offer_ids:
+                impressions = proximity_hits = 0
+                for hour, counts in self._hours.get(offer_id, {}).items():
+                    if hour >= since_hour:
+                        impressions += counts[IMPRESSION]
+                        proximity_hits += counts[PROXIMITY_HIT]
+                totals[offer_id] = (impressions, proximity_hits)
+        return totals
+
+
+class AnalyticsSink:
+    """
+    Durable destination of the flushed counter deltas
+    """
+
+    # Whether every worker writes here, so stats are read from the sink
+    shared = False
+
+    def write(self, deltas):
+        pass
+
+    def replay(self, since_hour):
+        """
+        {(offer_id, hour): [impressions, proximity hits]} persisted by
+        previous runs, to seed the in-memory counters
+        """
+        return {}
+
+    def totals(self, offer_ids, since_hour):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemorySink(AnalyticsSink):
+    """
+    Nothing persisted; counters live in this worker only
+    """
+
+
+class FileSink(AnalyticsSink):
+    """
+    Append-only JSON lines file, one [offer_id, hour, impressions,
+    proximity hits] line per changed counter and flush
+    """
+
+    def __init__(self, path='analytics.jsonl'):
+        self.path = path
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def write(self, deltas):
+        self._file.write(''.join(json.dumps([offer_id, hour, impressions, proximity_hits]) + '\n'
+                                 for (offer_id, hour), (impressions, proximity_hits) in deltas.items()))
+        self._file.flush()
+
+    def replay(self, since_hour):
+        deltas = {}
+        with open(self.path, encoding='utf-8') as lines:
+            for line in lines:
+                try:
+                    offer_id, hour, impressions, proximity_hits = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash
+                    continue
+                if hour >= since_hour:
+                    counts = deltas.setdefault((offer_id, hour), [0, 0])
+                    counts[IMPRESSION] += impressions
+                    counts[PROXIMITY_HIT] += proximity_hits
+        return deltas
+
+    def close(self):
+        self._file.close()
+
+
+class SQLiteSink(AnalyticsSink):
+    """
+    Hourly counters in SQLite, keyed by (offer_id, hour) so a dashboard
+    lookup reads a few index ranges. Flushes add to the stored counts, so
+    any number of workers can share the file
+    """
+
+    shared = True
+
+    def __init__(self, path='analytics.db', pool_size=2):
+        self.path = path
+        self.pool = ConnectionPool(self._connect, pool_size)
+        with self.pool.connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS offer_hourly_stats (
+                    offer_id TEXT NOT NULL,
+                    hour INTEGER NOT NULL,
+                    impressions INTEGER NOT NULL DEFAULT 0,
+                    proximity_hits INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (offer_id, hour)
+                ) WITHOUT ROWID
+            """)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def write(self, deltas):
+        rows = [(offer_id, hour, impressions, proximity_hits)
+                for (offer_id, hour), (impressions, proximity_hits) in deltas.items()]
+        with self.pool.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany("""
+                    INSERT INTO offer_hourly_stats (offer_id, hour, impressions, proximity_hits)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (offer_id, hour) DO UPDATE SET
+                        impressions = impressions + excluded.impressions,
+                        proximity_hits = proximity_hits + excluded.proximity_hits
+                """, rows)
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    def totals(self, offer_ids, since_hour):
+        offer_ids = list(offer_ids)
+        totals = {offer_id: (0, 0) for offer_id in offer_ids}
+        if not offer_ids:
+            return totals
+        with self.pool.connection() as conn:
+            rows = conn.execute(f"""
+                SELECT offer_id, SUM(impressions), SUM(proximity_hits) FROM offer_hourly_stats
+                WHERE offer_id IN ({', '.join('?' * len(offer_ids))}) AND hour >= ?
+                GROUP BY offer_id
+            """, offer_ids + [since_hour]).fetchall()
+        for offer_id, impressions, proximity_hits in rows:
+            totals[offer_id] = (impressions, proximity_hits)
+        return totals
+
+    def close(self):
+        self.pool.close()
+
+
+class AnalyticsPipeline:
+    """
+    Records events on the request path and flushes them on a background
+    thread into the in-memory counters and the sink
+    """
+
+    def __init__(self, sink=None, buffer_size=ANALYTICS_BUFFER_SIZE, flush_seconds=ANALYTICS_FLUSH_SECONDS):
+        self.sink = sink or MemorySink()
+        self.buffer = EventBuffer(buffer_size)
+        self.stats = OfferStats()
+        self.flush_seconds = flush_seconds
+        self._flush_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._pruned_hour = current_hour()
+        self.stats.add(self.sink.replay(current_hour() - self.stats.window_hours))
+
+    # Request path
+
+    def record_impressions(self, offer_ids):
+        if offer_ids:
+            self.buffer.append((IMPRESSION, current_hour(), offer_ids))
+
+    def record_proximity_hits(self, offer_ids):
+        if offer_ids:
+            self.buffer.append((PROXIMITY_HIT, current_hour(), offer_ids))
+
+    # Flushing
+
+    def flush(self):
+        """
+        Aggregate the buffered events and write them out.
+        Returns the number of events flushed
+        """
+        with self._flush_lock:
+            events = self.buffer.drain()
+            if not events:
+                return 0
+
+            deltas = {}
+            for kind, hour, offer_ids in events:
+                for offer_id in offer_ids:
+                    counts = deltas.get((offer_id, hour))
+                    if counts is None:
+                        counts = deltas[(offer_id, hour)] = [0, 0]
+                    counts[kind] += 1
+
+            self.stats.add(deltas)
+            try:
+                self.sink.write(deltas)
+            except Exception as e:
+                logging.error(f"Error writing offer analytics: {e}")
+
+            hour = current_hour()
+            if hour != self._pruned_hour:
+                self._pruned_hour = hour
+                self.stats.prune()
+            return len(events)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='offer-analytics', daemon=True)
+        self._thread.start()
+        # Flush what is still buffered when the worker exits
+        atexit.register(self.stop)
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stopping.wait(self.flush_seconds):
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Error flushing offer analytics: {e}")
+
+    # Reads
+
+    def offer_totals(self, offer_ids, hours=STATS_WINDOW_HOURS):
+        """
+        {offer_id: (impressions, proximity hits)} over the last hours,
+        from the pre-aggregated counters
+        """
+        since_hour = current_hour() - hours + 1
+        if self.sink.shared:
+            return self.sink.totals(offer_ids, since_hour)
+        return self.stats.totals(offer_ids, since_hour)
+
+
+def create_analytics_pipeline(kind=None):
+    """
+    Pipeline with the sink selected by ANALYTICS_SINK (defaults to memory)
+    and ANALYTICS_PATH
+    """
+    kind = kind or os.environ.get('ANALYTICS_SINK', 'memory')
+    if kind not in ANALYTICS_SINKS:
+        raise ValueError(f"Unknown analytics sink: {kind}")
+    path = os.environ.get('ANALYTICS_PATH')
+    if kind == 'file':
+        sink = FileSink(path or 'analytics.jsonl')
+    elif kind == 'sqlite':
+        sink = SQLiteSink(path or 'analytics.db')
+    else:
+        sink = MemorySink()
+    pipeline = AnalyticsPipeline(sink)
+
+    def events():
+        return [({'result': 'flushed'}, pipeline.buffer.flushed),
+                ({'result': 'dropped'}, pipeline.buffer.dropped)]
+
+    registry.callback('analytics_events', 'Offer analytics events flushed or dropped', events, 'counter')
+    return pipeline
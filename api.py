@@ -0,0 +1,477 @@
+"""
+Framework-independent builders for the read-heavy /api/* responses.
+Shared by the Flask routes and the asyncio handlers in asgi.py so both
+serving modes return the same payloads, caches and ETags.
+"""
+import hashlib
+import math
+import os
+
+from models import Business, Offer, sync_repository
+from geofence import get_nearby_offers, search_nearby_offers, haversine_distance, initial_bearing, destination_point
+from ranking import rank_nearby_offers
+from app import repository, nearby_offers_cache, shared_snapshot, analytics
+from cache import VersionedSnapshot
+from metrics import NEARBY_PHASES, register_cache
+from serialization import NEARBY_SHAPES, iter_nearby_offers_json, iter_businesses_json, iter_viewport_json
+from clustering import CLUSTER_MAX_ZOOM
+from search import query_terms
+
+# Decimal places kept when snapping user coordinates for the nearby cache
+# (4 places is a cell of roughly 11 meters)
+NEARBY_CACHE_PRECISION = int(os.environ.get('NEARBY_CACHE_PRECISION', 4))
+MAX_RECOMMENDED_OFFERS = 100
+# Largest radius a nearby, search or batch query is answered for
+MAX_RADIUS_METERS = int(os.environ.get('MAX_RADIUS_METERS', 50000))
+# Trajectory prefetch: seconds of predicted travel covered, capped at a
+# distance, plus a margin the user can move in any direction. Prefetch
+# radii are rounded up to steps so nearby users share cache entries
+PREFETCH_HORIZON_SECONDS = float(os.environ.get('PREFETCH_HORIZON_SECONDS', 60))
+MAX_PREFETCH_DISTANCE = 2000
+PREFETCH_MARGIN_METERS = 50
+PREFETCH_RADIUS_STEP = 50
+MAX_HISTORY_POINTS = 10
+# Bounds on a map viewport response: cells scanned for clusters, and
+# businesses listed individually above the cluster zoom levels
+MAX_VIEWPORT_CELLS = 4096
+MAX_VIEWPORT_BUSINESSES = 500
+# Text search: characters of ?q= considered, and results per response
+MAX_SEARCH_QUERY_LENGTH = 200
+MAX_SEARCH_RESULTS = 100
+# Tells this process's repository.version apart in ETags: two workers at
+# the same local version can hold different data
+WORKER_TAG = os.urandom(4).hex()
+
+
+class InvalidQuery(ValueError):
+    """
+    Raised for request parameters that should produce a 400 response;
+    the message is shown to the client
+    """
+
+
+def nearby_offer_payload(offer, business, distance):
+    return {
+        'id': offer.id,
+        'title': offer.title,
+        'description': offer.description,
+        'discount_percentage': offer.discount_percentage,
+        'valid_until': offer.valid_until,
+        'category': offer.category,
+        'business_name': business.name,
+        'business_address': business.address,
+        'business_phone': business.phone,
+        'business_lat': business.latitude,
+        'business_lng': business.longitude,
+        'distance': round(distance, 2)
+    }
+
+
+def business_payload(business, offers_count=None):
+    return {
+        'id': business.id,
+        'name': business.name,
+        'address': business.address,
+        'phone': business.phone,
+        'latitude': business.latitude,
+        'longitude': business.longitude,
+        'offers_count': business.count_active_offers() if offers_count is None else offers_count
+    }
+
+
+def offer_payload(offer):
+    return {
+        'id': offer.id,
+        'business_id': offer.business_id,
+        'title': offer.title,
+        'description': offer.description,
+        'discount_percentage': offer.discount_percentage,
+        'valid_until': offer.valid_until,
+        'category': offer.category
+    }
+
+
+def parse_location(args, default_radius=1000):
+    """
+    (lat, lng, radius) from query args or a JSON object. Coordinates must be
+    finite and on the globe; the radius is clamped to MAX_RADIUS_METERS
+    """
+    try:
+        latitude = float(args.get('lat', 0))
+        longitude = float(args.get('lng', 0))
+        radius = int(float(args.get('radius', default_radius)))
+    except (TypeError, ValueError, OverflowError):
+        raise InvalidQuery('Ubicación inválida')
+
+    # NaN fails every comparison, so it is rejected with the out-of-range values
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180) or latitude == 0 or longitude == 0:
+        raise InvalidQuery('Ubicación inválida')
+    return latitude, longitude, min(max(radius, 0), MAX_RADIUS_METERS)
+
+
+# Nearby offers
+
+def data_version():
+    """
+    Version the nearby results depend on: this worker's repository version,
+    plus the shared snapshot generation when workers answer from one
+    """
+    if shared_snapshot is None:
+        return f"{WORKER_TAG}.{repository.version}"
+    return f"{WORKER_TAG}.{repository.version}.{shared_snapshot.generation}"
+
+
+def parse_shape(args):
+    """
+    Response shape from ?shape=, 'flat' (default) or 'normalized'
+    """
+    shape = args.get('shape', 'flat')
+    if shape not in NEARBY_SHAPES:
+        raise InvalidQuery('Formato inválido')
+    return shape
+
+
+def parse_trajectory(args):
+    """
+    (heading in degrees, speed in m/s) from ?heading=&speed=, or derived
+    from ?history=lat,lng,ms;... (recent positions, oldest first, with
+    their timestamps). None when the request carries neither
+    """
+    if args.get('heading') is not None and args.get('speed') is not None:
+        try:
+            heading, speed = float(args.get('heading')), float(args.get('speed'))
+        except ValueError:
+            raise InvalidQuery('Trayectoria inválida')
+        if not (math.isfinite(heading) and math.isfinite(speed)) or speed < 0:
+            raise InvalidQuery('Trayectoria inválida')
+        return heading % 360, speed
+
+    history = args.get('history')
+    if not history:
+        return None
+    try:
+        points = [tuple(float(value) for value in point.split(',')) for point in history.split(';')]
+    except ValueError:
+        raise InvalidQuery('Trayectoria inválida')
+    if any(len(point) != 3 or not all(map(math.isfinite, point)) for point in points):
+        raise InvalidQuery('Trayectoria inválida')
+
+    # Average velocity over the retained history
+    points = points[-MAX_HISTORY_POINTS:]
+    (lat1, lng1, t1), (lat2, lng2, t2) = points[0], points[-1]
+    if t2 <= t1:
+        return None
+    speed = haversine_distance(lat1, lng1, lat2, lng2) / ((t2 - t1) / 1000)
+    return initial_bearing(lat1, lng1, lat2, lng2), speed
+
+
+def nearby_offers_key(latitude, longitude, radius, shape='flat', trajectory=None):
+    """
+    Nearby users share one cached result per snapped cell, radius and shape.
+    With a (heading, speed) trajectory the query is moved halfway along the
+    predicted path and widened so its results stay complete for any
+    position within `valid_radius` of the snapped center.
+    Returns (snapped latitude, snapped longitude, radius, shape, valid
+    radius or None) and its ETag
+    """
+    valid_radius = None
+    if trajectory is not None:
+        heading, speed = trajectory
+        lookahead = min(speed * PREFETCH_HORIZON_SECONDS, MAX_PREFETCH_DISTANCE)
+        latitude, longitude = destination_point(latitude, longitude, heading, lookahead / 2)
+        # The margin also absorbs the snapping of the center (under 8m)
+        margin = lookahead / 2 + PREFETCH_MARGIN_METERS
+        fetch_radius = math.ceil((radius + margin) / PREFETCH_RADIUS_STEP) * PREFETCH_RADIUS_STEP
+        radius, valid_radius = fetch_radius, fetch_radius - radius
+
+    key = (round(latitude, NEARBY_CACHE_PRECISION), round(longitude, NEARBY_CACHE_PRECISION), radius, shape,
+           valid_radius)
+    etag = f"{data_version()}:{key[0]}:{key[1]}:{radius}:{shape}"
+    return key, etag if valid_radius is None else f"{etag}:{valid_radius}"
+
+
+def nearby_offers_body(key):
+    """
+    Encoded response for a cache key; the offers it lists are recorded as
+    impressions
+    """
+    entry = nearby_offers_cache.get(key)
+    if entry is None:
+        entry = build_nearby_offers_body(key)
+    body, offer_ids = entry
+    analytics.record_impressions(offer_ids)
+    return body
+
+
+def build_nearby_offers_body(key):
+    """
+    Run the nearby query for a cache key and cache the encoded response
+    with the ids of the offers it lists, as (body, offer ids)
+    """
+    latitude, longitude, radius, shape, valid_radius = key
+    version = data_version()
+    matches = get_nearby_offers(latitude, longitude, radius)
+    # Prefetched results: distances are from the center, and the client
+    # filters them locally while it stays inside the valid region
+    leading = None
+    if valid_radius is not None:
+        leading = {'prefetch': {'lat': latitude, 'lng': longitude, 'radius': radius, 'valid_radius': valid_radius}}
+    with NEARBY_PHASES['serialize'].time():
+        body = ''.join(iter_nearby_offers_json(matches, shape, leading)).encode()
+    entry = (body, tuple(offer.id for offer, _, _ in matches))
+    # A write during the query already cleared the cache; storing this
+    # result now would serve it after the write until the TTL
+    if data_version() == version:
+        nearby_offers_cache.set(key, entry)
+    return entry
+
+
+# Business list
+
+def build_businesses_body():
+    """
+    (body, etag) of the business list. The ETag is taken from the content,
+    so workers holding the same businesses answer each other's clients
+    with 304 whatever their local versions
+    """
+    body = ''.join(iter_businesses_json(Business.get_all_with_location())).encode()
+    return body, 'businesses:' + hashlib.sha1(body).hexdigest()[:20]
+
+
+# Business list rebuilt only when the repository version moves
+businesses_snapshot = VersionedSnapshot(build_businesses_body)
+register_cache('businesses', businesses_snapshot)
+
+
+def businesses_response(version):
+    return businesses_snapshot.get(version)
+
+
+# Map viewport
+
+def parse_viewport(args):
+    """
+    (min_lat, min_lng, max_lat, max_lng, zoom) from ?bbox=west,south,east,north
+    (Leaflet's toBBoxString order) and ?zoom=
+    """
+    try:
+        west, south, east, north = (float(value) for value in args.get('bbox', '').split(','))
+        zoom = int(args.get('zoom', 13))
+    except ValueError:
+        raise InvalidQuery('Área inválida')
+
+    if not (-90 <= south <= north <= 90) or not (-180 <= west <= 180 and -180 <= east <= 180) or zoom < 0:
+        raise InvalidQuery('Área inválida')
+    return south, west, north, east, zoom
+
+
+def viewport_etag(viewport):
+    return f"viewport:{WORKER_TAG}.{repository.version}:" + ':'.join(str(value) for value in viewport)
+
+
+def viewport_body(viewport):
+    """
+    Clusters of the businesses in the box, or the businesses themselves when
+    zoomed in past the cluster levels and few enough of them are in view
+    """
+    min_lat, min_lng, max_lat, max_lng, zoom = viewport
+    clusters_index = repository.business_clusters
+    revision = feed_revision()
+
+    if zoom > CLUSTER_MAX_ZOOM and clusters_index.count_in(min_lat, min_lng, max_lat, max_lng) <= MAX_VIEWPORT_BUSINESSES:
+        ids = clusters_index.members(min_lat, min_lng, max_lat, max_lng)
+        businesses = [business for business in map(Business.get, ids) if business]
+        return ''.join(iter_viewport_json(zoom, revision, [], businesses)).encode()
+
+    zoom = clusters_index.fit_zoom(min_lat, min_lng, max_lat, max_lng, zoom, MAX_VIEWPORT_CELLS)
+    clusters = clusters_index.clusters(min_lat, min_lng, max_lat, max_lng, zoom)
+    return ''.join(iter_viewport_json(zoom, revision, clusters, [])).encode()
+
+
+# Text search
+
+def parse_search(args):
+    """
+    (query terms, lat, lng, radius, limit, shape) of a text search around a
+    location, from ?q= and the nearby offers parameters
+    """
+    terms = tuple(query_terms(args.get('q', '')[:MAX_SEARCH_QUERY_LENGTH]))
+    if not terms:
+        raise InvalidQuery('Búsqueda vacía')
+    latitude, longitude, radius = parse_location(args)
+    try:
+        limit = min(int(args.get('limit', MAX_SEARCH_RESULTS)), MAX_SEARCH_RESULTS)
+    except ValueError:
+        raise InvalidQuery('Parámetros inválidos')
+    if limit < 1:
+        raise InvalidQuery('Parámetros inválidos')
+    return terms, latitude, longitude, radius, limit, parse_shape(args)
+
+
+def search_offers_etag(search):
+    # Terms may hold any script, headers only take latin-1
+    return f"search:{data_version()}:" + hashlib.sha1(repr(search).encode()).hexdigest()[:20]
+
+
+def search_offers_body(search):
+    """
+    Matching offers closest first, in the /api/nearby_offers shapes, led by
+    the terms the query was reduced to
+    """
+    terms, latitude, longitude, radius, limit, shape = search
+    matches = search_nearby_offers(terms, latitude, longitude, radius)[:limit]
+    return ''.join(iter_nearby_offers_json(matches, shape, {'terms': list(terms)})).encode()
+
+
+# Change feed
+
+def feed_revision():
+    """
+    Revision clients resume the change feed from. Workers sharing a backend
+    count in its change log, the same sequence in every worker; a lone
+    process counts in its repository version
+    """
+    if repository.backend.shared:
+        return repository.backend_revision
+    return repository.version
+
+
+def reset_payload(revision):
+    return {
+        'revision': revision,
+        'reset': True,
+        'businesses': {
+            'upserted': [business_payload(b) for b in Business.get_all_with_location()],
+            'removed': []
+        },
+        'offers': {'upserted': [], 'removed': []}
+    }
+
+
+def changes_payload(since):
+    """
+    Businesses and offers added, changed or removed since a client revision.
+    With since=0, or a revision older than the server keeps, the response is
+    flagged as reset and carries every business instead of a delta.
+    """
+    if repository.backend.shared:
+        return shared_changes_payload(since)
+
+    revision = repository.version
+    changed = repository.changes_since(since) if since > 0 else None
+    if changed is None:
+        return reset_payload(revision)
+
+    businesses_delta = {'upserted': [], 'removed': []}
+    for business_id in changed['business']:
+        business = Business.get(business_id)
+        if business and business.has_location():
+            businesses_delta['upserted'].append(business_payload(business))
+        else:
+            businesses_delta['removed'].append(business_id)
+
+    # Inactive offers are reported as removed, clients only show active ones.
+    # Upserts carry their business position, so a client whose map shows
+    # clusters can tell whether the offer is in range without refetching
+    offers_delta = {'upserted': [], 'removed': []}
+    for offer_id in changed['offer']:
+        offer = Offer.get(offer_id)
+        if offer and offer.is_active:
+            business = Business.get(offer.business_id)
+            offers_delta['upserted'].append({
+                **offer_payload(offer),
+                'business_lat': business.latitude if business else None,
+                'business_lng': business.longitude if business else None
+            })
+        else:
+            offers_delta['removed'].append(offer_id)
+
+    return {
+        'revision': revision,
+        'reset': False,
+        'businesses': businesses_delta,
+        'offers': offers_delta
+    }
+
+
+def shared_changes_payload(since):
+    """
+    changes_payload over the backend's change log, for workers sharing a
+    backend: a client polls whichever worker it reaches, so deltas are read
+    from the log and the records from the backend, never from this
+    worker's copy, which may be behind the revision it reports
+    """
+    backend = repository.backend
+    # Catch up first, so a reset lists records up to the revision it reports
+    sync_repository()
+    changes = backend.changes_since(since) if since > 0 else None
+    if changes is not None and not changes[1] and since > backend.change_revision():
+        # A revision the log never reached, from before the database was replaced
+        changes = None
+    if changes is None:
+        return reset_payload(repository.backend_revision)
+
+    revision, changed = changes
+    business_ids = {record_id for kind, record_id in changed if kind == 'business'}
+    offer_ids = [record_id for kind, record_id in changed if kind == 'offer']
+    offers = [Offer(*row) for row in backend.offer_rows(offer_ids)]
+    businesses = {row[0]: Business(*row)
+                  for row in backend.business_rows(business_ids | {offer.business_id for offer in offers})}
+    offers_count = dict.fromkeys(business_ids, 0)
+    for row in backend.business_offer_rows(business_ids):
+        offer = Offer(*row)
+        if offer.is_active:
+            offers_count[offer.business_id] += 1
+
+    businesses_delta = {'upserted': [], 'removed': []}
+    for business_id in business_ids:
+        business = businesses.get(business_id)
+        if business and business.has_location():
+            businesses_delta['upserted'].append(business_payload(business, offers_count[business_id]))
+        else:
+            businesses_delta['removed'].append(business_id)
+
+    offers_delta = {'upserted': [], 'removed': list(set(offer_ids) - {offer.id for offer in offers})}
+    for offer in offers:
+        if offer.is_active:
+            business = businesses.get(offer.business_id)
+            offers_delta['upserted'].append({
+                **offer_payload(offer),
+                'business_lat': business.latitude if business else None,
+                'business_lng': business.longitude if business else None
+            })
+        else:
+            offers_delta['removed'].append(offer.id)
+
+    return {
+        'revision': revision,
+        'reset': False,
+        'businesses': businesses_delta,
+        'offers': offers_delta
+    }
+
+
+# Personalized ranking
+
+def recommended_offers_payload(args, profile):
+    """
+    Nearby offers ranked for a preference profile, best match first
+    """
+    latitude, longitude, _ = parse_location(args)
+    try:
+        limit = min(int(args.get('limit', 20)), MAX_RECOMMENDED_OFFERS)
+        radius = args.get('radius')
+        radius = int(float(radius)) if radius else None
+    except (ValueError, OverflowError):
+        raise InvalidQuery('Parámetros inválidos')
+
+    offers_data = []
+    for offer, business, distance, score in rank_nearby_offers(latitude, longitude, profile, limit, radius):
+        payload = nearby_offer_payload(offer, business, distance)
+        payload['score'] = round(score, 3)
+        offers_data.append(payload)
+
+    return {
+        'offers': offers_data,
+        'count': len(offers_data)
+    }
@@ -2,12 +2,25 @@ import os
 import logging
 from flask import Flask
 from flask_login import LoginManager
+from werkzeug.middleware.proxy_fix import ProxyFix
+from repository import Repository
+from storage import create_storage_backend
+from cache import ResponseCache
+from metrics import registry, register_cache
+from serialization import fragments
+from snapshot import create_shared_snapshot
+from auth import UserCache
+from search import OfferTextIndex
+from analytics import create_analytics_pipeline
+from sharding import create_shard_map, SHARD_SYNC_SECONDS
+from database import DatabaseProbe, register_commands
 
 # Set up logging for debugging
 logging.basicConfig(level=logging.DEBUG)
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-change-in-production")
+app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
 # Initialize Flask-Login
 login_manager = LoginManager()
@@ -15,59 +28,113 @@ login_manager.init_app(app)
 login_manager.login_view = 'login'
 login_manager.login_message = 'Por favor inicia sesión para acceder a esta página.'
 
-# In-memory storage for businesses and offers
-businesses = {}
-offers = {}
-offer_counter = 0
-business_counter = 0
-
-# Database availability flag
-database_available = False
-
-# Try to setup database if available
-try:
-    from flask_sqlalchemy import SQLAlchemy
-    from sqlalchemy.orm import DeclarativeBase
-    from werkzeug.middleware.proxy_fix import ProxyFix
-    
-    app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
-    
-    class Base(DeclarativeBase):
-        pass
-
-    db = SQLAlchemy(model_class=Base)
-    
-    # Configure the database
-    database_url = os.environ.get("DATABASE_URL")
-    if database_url and database_url.startswith("postgres://"):
-        database_url = database_url.replace("postgres://", "postgresql://", 1)
-        
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_url
-    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-        "pool_recycle": 300,
-        "pool_pre_ping": True,
-        "connect_args": {
-            "connect_timeout": 10,
-            "sslmode": "require"
-        }
-    }
-    
-    # Initialize the app with the extension
-    db.init_app(app)
-    
-    with app.app_context():
-        db.create_all()
-        database_available = True
-        logging.info("Database connection successful")
-        
-except Exception as e:
-    logging.warning(f"Database connection failed, using in-memory storage: {e}")
-    database_available = False
+# In-memory storage for businesses and offers, written through to the
+# storage backend selected by STORAGE_BACKEND (memory or sqlite)
+repository = Repository(create_storage_backend())
+businesses = repository.businesses
+offers = repository.offers
+
+# Geo shard of this node (SHARD_NODES / SHARD_ID), None when unsharded. A
+# shard node holds only the businesses of its own cells and answers geo
+# queries from them, never from the whole shared database
+shard_map = create_shard_map()
+local_shard_map = shard_map if shard_map is not None and shard_map.local_shard is not None else None
+owns_location = local_shard_map.owns if local_shard_map is not None else None
+if owns_location is not None:
+    if not repository.backend.shared:
+        raise RuntimeError("SHARD_ID needs a storage backend shared by every node (STORAGE_BACKEND=sqlite)")
+    repository.backend.spatial_queries = False
+
+# Spatial index over business locations, kept current by the repository
+business_index = repository.business_index
+business_coordinates = repository.business_coordinates
+
+# Rendered /api/nearby_offers responses with the ids of the offers they
+# list, dropped on every write to the store
+nearby_offers_cache = ResponseCache(
+    max_entries=int(os.environ.get("NEARBY_CACHE_SIZE", 4096)),
+    ttl_seconds=float(os.environ.get("NEARBY_CACHE_TTL", 60))
+)
+repository.add_listener(nearby_offers_cache.clear)
+register_cache('nearby_offers', nearby_offers_cache)
+
+# Offer impressions and proximity hits, buffered on the request path and
+# flushed into hourly counters (ANALYTICS_SINK) by a background thread
+analytics = create_analytics_pipeline()
+
+# Encoded offer/business JSON fragments, dropped per record on writes
+repository.add_change_listener(fragments.invalidate)
+
+# Memory-mapped snapshot shared by every worker (SHARED_SNAPSHOT_PATH, with
+# a shared storage backend); writes from other workers reach this one
+# through a new generation. It only backs the nearby distance pass: the
+# repository below is still loaded in full by every worker
+shared_snapshot, snapshot_publisher = create_shared_snapshot(repository, shard_map=local_shard_map)
+if shared_snapshot is not None:
+    shared_snapshot.add_listener(nearby_offers_cache.clear)
+
+# Optional PostgreSQL database (DATABASE_URL). Nothing connects at import
+# time: a background probe reports when it is reachable, and tables are
+# created with `flask --app main init-db`
+database_probe = DatabaseProbe(app)
+register_commands(app)
+registry.callback('database_available', 'Whether the optional PostgreSQL database answered the probe',
+                  lambda: [({}, 1.0 if database_probe.available else 0.0)])
+
+def _load_business(user_id):
+    from models import Business
+    business = Business.get(user_id)
+    if business is None:
+        # Registered through another worker sharing the storage backend
+        rows = repository.backend.business_rows([str(user_id)])
+        business = Business(*rows[0]) if rows else None
+    return business
+
+# Session users, looked up on every authenticated request
+user_cache = UserCache(_load_business)
+repository.add_change_listener(user_cache.invalidate)
+register_cache('users', user_cache)
+
+# Text search over active offer titles and descriptions, kept current per
+# offer through the change feed
+offer_text_index = OfferTextIndex(repository)
 
 @login_manager.user_loader
 def load_user(user_id):
-    from models import Business
-    return Business.get(user_id)
+    return user_cache.get(str(user_id))
 
 # Import routes after app initialization
 from routes import *
+
+# flask --app main import businesses|offers FILE
+from bulk_import import import_cli
+app.cli.add_command(import_cli)
+
+# Deactivate offers as their valid_until date lapses; registered before
+# loading so persisted offers are scheduled too
+from expiry import expiry_scheduler
+expiry_scheduler.start()
+
+# Load the records persisted by previous runs
+from models import load_repository, sync_repository, start_repository_sync
+load_repository()
+
+# Records other workers wrote are reloaded before answering from a newer
+# snapshot generation, so ids and bodies always come from the same data
+if shared_snapshot is not None:
+    shared_snapshot.add_listener(sync_repository)
+# A shard node also picks up, on its own, the businesses written through
+# other nodes into its cells
+if owns_location is not None:
+    start_repository_sync(SHARD_SYNC_SECONDS)
+
+database_probe.start()
+analytics.start()
+
+# Positions posted through other workers for the geofence streams open here
+from geofence_stream import geofence_sessions
+geofence_sessions.start_relay()
+
+# Publish once loaded, then after every write
+if snapshot_publisher is not None:
+    snapshot_publisher.start()
@@ -0,0 +1,232 @@
+"""
+Asyncio serving mode.
+
+The read-heavy GET endpoints in ASYNC_ROUTES are answered by native async
+handlers: cache hits and 304s are served straight from the event loop,
+cache misses and rankings run on a small compute pool, and geofence streams
+wait on an asyncio queue instead of parking a thread per idle client.
+Every other route (pages, forms, writes) is passed to the Flask app through
+a2wsgi. Both paths share the repository, caches and geofence code via api.py.
+
+    gunicorn -k uvicorn_worker.UvicornWorker -w 4 --bind 0.0.0.0:5000 asgi:application
+"""
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from a2wsgi import WSGIMiddleware
+
+from app import app, repository, nearby_offers_cache, analytics
+from models import PreferenceProfile
+from api import (InvalidQuery, parse_location, parse_shape, parse_trajectory, nearby_offers_key,
+                 build_nearby_offers_body, businesses_response, businesses_snapshot, changes_payload,
+                 recommended_offers_payload, parse_viewport, viewport_etag, viewport_body, parse_search,
+                 search_offers_etag, search_offers_body)
+from metrics import request_duration
+from geofence_stream import geofence_sessions, parse_geofence_radius, sse_message, GEOFENCE_HEARTBEAT_SECONDS
+
+# Threads for cache misses and rankings, so a slow query never stalls the loop
+compute_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('ASYNC_COMPUTE_THREADS', 4)),
+    thread_name_prefix='async-api'
+)
+
+# Thread pool running the Flask app for the routes without an async handler
+flask_application = WSGIMiddleware(app, workers=int(os.environ.get('ASYNC_WSGI_THREADS', 10)))
+
+
+async def run_blocking(function, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(compute_executor, function, *args)
+
+
+class JSONResponse:
+    def __init__(self, body, status=200, etag=None):
+        self.body = body if isinstance(body, bytes) else body.encode()
+        self.status = status
+        self.etag = etag
+
+    async def send(self, send):
+        headers = [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(self.body)).encode()),
+        ]
+        if self.etag is not None:
+            headers.append((b'etag', f'"{self.etag}"'.encode()))
+            headers.append((b'cache-control', b'no-cache'))
+        await send({'type': 'http.response.start', 'status': self.status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': self.body})
+
+
+def error_response(message, status):
+    return JSONResponse(app.json.dumps({'error': message}), status)
+
+
+def etag_matches(headers, etag):
+    value = headers.get(b'if-none-match')
+    if not value:
+        return False
+    for candidate in value.decode('latin-1').split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == '*' or candidate.strip('"') == etag:
+            return True
+    return False
+
+
+# Handlers, each returning a JSONResponse
+
+async def nearby_offers(args, headers):
+    key, etag = nearby_offers_key(*parse_location(args), parse_shape(args), parse_trajectory(args))
+    if etag_matches(headers, etag):
+        return JSONResponse(b'', 304, etag)
+
+    entry = nearby_offers_cache.get(key)
+    if entry is None:
+        entry = await run_blocking(build_nearby_offers_body, key)
+    body, offer_ids = entry
+    analytics.record_impressions(offer_ids)
+    return JSONResponse(body, 200, etag)
+
+
+async def search_offers(args, headers):
+    search = parse_search(args)
+    etag = search_offers_etag(search)
+    if etag_matches(headers, etag):
+        return JSONResponse(b'', 304, etag)
+    return JSONResponse(await run_blocking(search_offers_body, search), 200, etag)
+
+
+async def businesses(args, headers):
+    version = repository.version
+    entry = businesses_snapshot.peek(version)
+    if entry is None:
+        entry = await run_blocking(businesses_response, version)
+    body, etag = entry
+    if etag_matches(headers, etag):
+        return JSONResponse(b'', 304, etag)
+    return JSONResponse(body, 200, etag)
+
+
+async def businesses_viewport(args, headers):
+    viewport = parse_viewport(args)
+    etag = viewport_etag(viewport)
+    if etag_matches(headers, etag):
+        return JSONResponse(b'', 304, etag)
+    return JSONResponse(await run_blocking(viewport_body, viewport), 200, etag)
+
+
+async def changes(args, headers):
+    try:
+        since = int(args.get('since', 0))
+    except ValueError:
+        raise InvalidQuery('Revisión inválida')
+    return JSONResponse(app.json.dumps(await run_blocking(changes_payload, since)))
+
+
+async def recommended_offers(args, headers):
+    # Reads the shared backend, off the event loop like the ranking itself
+    profile = await run_blocking(PreferenceProfile.get, args.get('profile_id', ''))
+    if not profile:
+        return error_response('Perfil no encontrado', 404)
+    return JSONResponse(app.json.dumps(await run_blocking(recommended_offers_payload, args, profile)))
+
+
+ASYNC_ROUTES = {
+    '/api/nearby_offers': nearby_offers,
+    '/api/search_offers': search_offers,
+    '/api/businesses': businesses,
+    '/api/businesses/viewport': businesses_viewport,
+    '/api/changes': changes,
+    '/api/recommended_offers': recommended_offers,
+}
+
+
+async def geofence_stream(scope, receive, send):
+    """
+    Async twin of the Flask /api/geofence/stream route: events are handed
+    from the position updates to this coroutine through an asyncio queue
+    """
+    args = dict(parse_qsl(scope['query_string'].decode('latin-1')))
+    session = await run_blocking(geofence_sessions.create, parse_geofence_radius(args))
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+    session.subscriber = lambda event: loop.call_soon_threadsafe(events.put_nowait, event)
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ]})
+        await _send_chunk(send, sse_message('session', {'session_id': session.id, 'radius': session.radius_meters}))
+
+        while not disconnected.done():
+            next_event = asyncio.ensure_future(events.get())
+            done, _ = await asyncio.wait({next_event, disconnected}, timeout=GEOFENCE_HEARTBEAT_SECONDS,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if next_event in done:
+                event = next_event.result()
+                await _send_chunk(send, sse_message(event['type'], event))
+            else:
+                next_event.cancel()
+                if not disconnected.done():
+                    session.last_seen = time.monotonic()
+                    await _send_chunk(send, ": keepalive\n\n")
+    finally:
+        disconnected.cancel()
+        # Not awaited, so it also runs when this task is cancelled
+        compute_executor.submit(geofence_sessions.remove, session.id)
+
+
+async def _wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def _send_chunk(send, text):
+    await send({'type': 'http.response.body', 'body': text.encode(), 'more_body': True})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            compute_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    if scope['type'] == 'http' and scope['method'] == 'GET':
+        path = scope['path']
+        if path == '/api/geofence/stream':
+            return await geofence_stream(scope, receive, send)
+
+        handler = ASYNC_ROUTES.get(path)
+        if handler is not None:
+            start = time.perf_counter()
+            args = dict(parse_qsl(scope['query_string'].decode('latin-1')))
+            headers = dict(scope['headers'])
+            try:
+                response = await handler(args, headers)
+            except InvalidQuery as e:
+                response = error_response(str(e), 400)
+            except Exception as e:
+                logging.error(f"Error serving {path}: {e}")
+                response = error_response('Error interno del servidor', 500)
+            await response.send(send)
+            request_duration.observe(time.perf_counter() - start, route=path, method='GET', status=response.status)
+            return
+
+    return await flask_application(scope, receive, send)
@@ -0,0 +1,190 @@
+"""
+Password hashing and session user lookup for the business accounts.
+
+Hashes are computed on a small dedicated thread pool with a bounded
+backlog, so a burst of logins occupies at most PASSWORD_HASH_THREADS cores
+and the request threads serving the geo API keep running. The hashing
+method is configurable; a login with a hash made under other parameters is
+rehashed with the current ones.
+"""
+import hashlib
+import os
+import string
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+
+# werkzeug method string, e.g. scrypt:32768:8:1 or pbkdf2:sha256:600000
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+PASSWORD_SALT_LENGTH = int(os.environ.get('PASSWORD_SALT_LENGTH', 16))
+PASSWORD_HASH_THREADS = int(os.environ.get('PASSWORD_HASH_THREADS', 2))
+# Hashes queued or running at once; beyond it logins are turned away
+PASSWORD_HASH_BACKLOG = int(os.environ.get('PASSWORD_HASH_BACKLOG', 32))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 30))
+
+# Parameters werkzeug fills in when a method string leaves them out
+METHOD_DEFAULTS = {
+    'scrypt': ('32768', '8', '1'),
+    'pbkdf2': ('sha256', str(DEFAULT_PBKDF2_ITERATIONS)),
+}
+
+
+class PasswordHashingBusy(RuntimeError):
+    """
+    Raised when the hashing backlog is full; the client should retry
+    """
+
+
+def method_parameters(method):
+    """
+    A werkzeug method string as a tuple, with the defaults werkzeug applies
+    filled in: 'scrypt' and 'scrypt:32768:8:1' give the same tuple
+    """
+    name, *parameters = method.split(':')
+    defaults = METHOD_DEFAULTS.get(name, ())
+    return (name, *parameters, *defaults[len(parameters):])
+
+
+class PasswordHasher:
+    """
+    Runs werkzeug hashing on a bounded thread pool
+    """
+
+    def __init__(self, method=PASSWORD_HASH_METHOD, salt_length=PASSWORD_SALT_LENGTH,
+                 threads=PASSWORD_HASH_THREADS, backlog=PASSWORD_HASH_BACKLOG):
+        self.method = method
+        self.salt_length = salt_length
+        self._parameters = method_parameters(method)
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(max(backlog, threads))
+
+    @contextmanager
+    def _slot(self):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHashingBusy('Demasiados inicios de sesión simultáneos')
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    def _run(self, function, *args):
+        with self._slot():
+            return self._executor.submit(function, *args).result()
+
+    def _hash_one(self, password):
+        return generate_password_hash(password, self.method, self.salt_length)
+
+    def hash(self, password):
+        return self._run(self._hash_one, password)
+
+    def hash_many(self, passwords):
+        """
+        Hash a batch spread over the pool threads, for bulk imports. Holds a
+        single backlog slot, so logins queue behind at most one batch
+        """
+        with self._slot():
+            return list(self._executor.map(self._hash_one, passwords))
+
+    def needs_rehash(self, password_hash):
+        """
+        Whether a stored hash was made with other parameters (algorithm,
+        cost, iterations or salt length) than the configured ones
+        """
+        parts = password_hash.split('$', 2)
+        if len(parts) < 3:
+            # Not a method$salt$digest hash at all
+            return True
+        method, salt, _ = parts
+        return method_parameters(method) != self._parameters or len(salt) != self.salt_length
+
+    def recognises(self, password_hash):
+        """
+        Whether a stored value is a hash check_password_hash can verify:
+        method$salt$digest with a scrypt or pbkdf2 method whose parameters
+        are well formed, a salt, and a hex digest of the length the method
+        produces. Hashes made with other parameters than the configured ones
+        are recognised, and rehashed at the next login
+        """
+        parts = password_hash.split('$')
+        if len(parts) != 3 or not parts[1]:
+            return False
+        method, _, digest = parts
+        name, *parameters = method_parameters(method)
+        try:
+            if name == 'scrypt':
+                n, r, p = map(int, parameters)
+                valid = n > 1 and n & (n - 1) == 0 and r > 0 and p > 0
+                digest_size = 64
+            elif name == 'pbkdf2':
+                hash_name, iterations = parameters
+                valid = int(iterations) > 0
+                digest_size = hashlib.new(hash_name).digest_size
+            else:
+                return False
+        except ValueError:
+            return False
+        return valid and len(digest) == 2 * digest_size and all(c in string.hexdigits for c in digest)
+
+    def verify(self, password_hash, password):
+        """
+        Check a password. Returns (matches, new hash), the new hash being
+        set when the password matched under outdated parameters
+        """
+        if not self._run(check_password_hash, password_hash, password):
+            return False, None
+        if self.needs_rehash(password_hash):
+            return True, self.hash(password)
+        return True, None
+
+
+password_hasher = PasswordHasher()
+
+
+class UserCache:
+    """
+    Per-process cache of session users for Flask-Login's user_loader.
+    Entries expire after ttl_seconds, which bounds how long a change made by
+    another worker goes unseen; the repository change listener drops them
+    on local writes
+    """
+
+    def __init__(self, load, ttl_seconds=USER_CACHE_TTL):
+        self._load = load
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        now = time.monotonic()
+        if entry is not None and entry[0] > now:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        user = self._load(user_id)
+        if user is not None:
+            with self._lock:
+                self._entries[user_id] = (now + self.ttl_seconds, user)
+        else:
+            self._entries.pop(user_id, None)
+        return user
+
+    def invalidate(self, changes):
+        """
+        Repository change listener; no changes means everything may differ
+        """
+        with self._lock:
+            if not changes:
+                self._entries.clear()
+            for kind, item_id in changes:
+                if kind == 'business':
+                    self._entries.pop(item_id, None)
+
+    def __len__(self):
+        return len(self._entries)
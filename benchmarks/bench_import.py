@@ -0,0 +1,65 @@
+"""
+Bulk import throughput in rows per second, for businesses (pre-hashed
+passwords, so hashing cost does not hide the write path) and their offers,
+at several batch sizes. Runs against the configured STORAGE_BACKEND; with
+sqlite, point SQLITE_PATH at a scratch file.
+
+Usage: python benchmarks/bench_import.py [rows...] [--batch-sizes 1 100 1000]
+                                         [--offers-per-business N]
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.disable(logging.CRITICAL)
+
+from app import repository  # noqa: E402
+from bulk_import import import_businesses, import_offers, iter_records  # noqa: E402
+from datagen import CITY_BOUNDS  # noqa: E402
+
+
+def jsonl(records):
+    return io.StringIO(''.join(json.dumps(record) + '\n' for record in records))
+
+
+def business_records(count, prefix, rng):
+    min_lat, max_lat, min_lng, max_lng = CITY_BOUNDS
+    return [{'email': f'{prefix}-{i}@example.com', 'name': f'Negocio {i}', 'password_hash': 'x',
+             'latitude': rng.uniform(min_lat, max_lat), 'longitude': rng.uniform(min_lng, max_lng)}
+            for i in range(count)]
+
+
+def offer_records(emails, per_business, rng):
+    return [{'business_email': email, 'title': 'Oferta', 'description': 'Descripción',
+             'discount_percentage': rng.randint(5, 60), 'valid_until': '2030-12-31'}
+            for email in emails for _ in range(per_business)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('rows', nargs='*', type=int, default=[10000])
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 100, 1000])
+    parser.add_argument('--offers-per-business', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'rows':>8} {'batch':>6} {'businesses/s':>14} {'offers/s':>12}")
+    for rows in args.rows:
+        for batch_size in args.batch_sizes:
+            repository.clear()
+            businesses = business_records(rows, f'{rows}-{batch_size}', rng)
+            business_result = import_businesses(iter_records(jsonl(businesses), 'jsonl'), batch_size)
+            offers = offer_records([record['email'] for record in businesses], args.offers_per_business, rng)
+            offer_result = import_offers(iter_records(jsonl(offers), 'jsonl'), batch_size)
+            print(f"{rows:>8} {batch_size:>6} {business_result.rows_per_second:>14,.0f} "
+                  f"{offer_result.rows_per_second:>12,.0f}", flush=True)
+
+
+if __name__ == '__main__':
+    main()
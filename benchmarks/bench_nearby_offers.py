@@ -0,0 +1,73 @@
+"""
+Latency of geofence.get_nearby_offers with the spatial index versus the
+previous full scan over every active offer.
+
+Usage: python benchmarks/bench_nearby_offers.py [sizes...] [--radius METERS]
+"""
+import argparse
+import logging
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.disable(logging.CRITICAL)
+
+from datagen import populate, random_points  # noqa: E402
+from models import Offer  # noqa: E402
+from geofence import get_nearby_offers, haversine_distance  # noqa: E402
+
+QUERIES = 200
+FULL_SCAN_QUERIES = 5
+
+
+def full_scan_nearby(user_lat, user_lng, radius_meters):
+    """
+    The pre-index implementation, kept here as the baseline
+    """
+    nearby_offers = []
+    for offer in Offer.get_all_active():
+        business = offer.get_business()
+        if business and business.latitude != 0 and business.longitude != 0:
+            distance = haversine_distance(user_lat, user_lng, business.latitude, business.longitude)
+            if distance <= radius_meters:
+                nearby_offers.append((offer, business, distance))
+    nearby_offers.sort(key=lambda x: x[2])
+    return nearby_offers
+
+
+def measure(function, points, radius):
+    timings = []
+    results = 0
+    for lat, lng in points:
+        start = time.perf_counter()
+        results += len(function(lat, lng, radius))
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        'p50_ms': statistics.median(timings),
+        'p99_ms': timings[min(len(timings) - 1, int(len(timings) * 0.99))],
+        'avg_results': results / len(points),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('sizes', nargs='*', type=int, default=[1000, 100000, 1000000])
+    parser.add_argument('--radius', type=float, default=1000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    print(f"{'businesses':>12} {'index p50':>10} {'index p99':>10} {'scan p50':>10} {'results':>8}")
+    for size in args.sizes:
+        populate(size, offers_per_business=1, active_ratio=1.0, seed=args.seed)
+        points = random_points(QUERIES, seed=args.seed)
+        indexed = measure(get_nearby_offers, points, args.radius)
+        scan = measure(full_scan_nearby, points[:FULL_SCAN_QUERIES], args.radius)
+        print(f"{size:>12} {indexed['p50_ms']:>8.2f}ms {indexed['p99_ms']:>8.2f}ms "
+              f"{scan['p50_ms']:>8.2f}ms {indexed['avg_results']:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
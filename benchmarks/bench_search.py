@@ -0,0 +1,95 @@
+"""
+Latency of a text + radius offer search (geofence.search_nearby_offers)
+versus a substring scan over every active offer, for a rare term, a common
+term and a prefix.
+
+Usage: python benchmarks/bench_search.py [sizes...] [--radius METERS]
+"""
+import argparse
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.disable(logging.CRITICAL)
+
+from app import repository  # noqa: E402
+from datagen import generate, random_points  # noqa: E402
+from models import Offer  # noqa: E402
+from geofence import search_nearby_offers, haversine_distance  # noqa: E402
+from search import fold, query_terms  # noqa: E402
+
+QUERIES = 200
+FULL_SCAN_QUERIES = 5
+# Title words with a skewed frequency: the first ones are in most offers
+WORDS = ['descuento', 'promo', 'café', 'pizza', 'cerveza', 'helado', 'menú', 'postres', 'librería', 'zapatos',
+         '2x1', 'panadería', 'sushi', 'empanadas', 'vinos', 'peluquería']
+SEARCHES = {'common': 'descuento', 'rare': 'peluquería', 'prefix': 'empan'}
+
+
+def populate(size, seed):
+    rng = random.Random(seed)
+    businesses, offers = generate(size, offers_per_business=3, active_ratio=1.0, seed=seed)
+    weights = [1 / (rank + 1) for rank in range(len(WORDS))]
+    for offer in offers:
+        offer.title = ' '.join(rng.choices(WORDS, weights, k=2))
+        offer.description = ' '.join(rng.choices(WORDS, weights, k=4))
+    repository.clear()
+    repository.add_businesses(businesses)
+    repository.add_offers(offers)
+
+
+def full_scan_search(query, user_lat, user_lng, radius_meters):
+    """
+    The naive implementation, kept here as the baseline
+    """
+    needle = fold(query)
+    matches = []
+    for offer in Offer.get_all_active():
+        if needle in fold(offer.title) or needle in fold(offer.description):
+            business = offer.get_business()
+            distance = haversine_distance(user_lat, user_lng, business.latitude, business.longitude)
+            if distance <= radius_meters:
+                matches.append((offer, business, distance))
+    matches.sort(key=lambda x: x[2])
+    return matches
+
+
+def measure(function, query, points, radius):
+    timings = []
+    results = 0
+    for lat, lng in points:
+        start = time.perf_counter()
+        results += len(function(query, lat, lng, radius))
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        'p50_ms': statistics.median(timings),
+        'p99_ms': timings[min(len(timings) - 1, int(len(timings) * 0.99))],
+        'avg_results': results / len(points),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('sizes', nargs='*', type=int, default=[10000, 100000])
+    parser.add_argument('--radius', type=float, default=1000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    print(f"{'offers':>10} {'query':>8} {'index p50':>10} {'index p99':>10} {'scan p50':>10} {'results':>8}")
+    for size in args.sizes:
+        populate(size, args.seed)
+        points = random_points(QUERIES, seed=args.seed)
+        for name, query in SEARCHES.items():
+            indexed = measure(search_nearby_offers, tuple(query_terms(query)), points, args.radius)
+            scan = measure(full_scan_search, query, points[:FULL_SCAN_QUERIES], args.radius)
+            print(f"{size * 3:>10} {name:>8} {indexed['p50_ms']:>8.2f}ms {indexed['p99_ms']:>8.2f}ms "
+                  f"{scan['p50_ms']:>8.2f}ms {indexed['avg_results']:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Per-call cost of the repository lookups behind login, the dashboard and
+/api/businesses as the store grows. With the secondary indexes in place the
+lookup columns stay flat and /api/businesses grows with its output only.
+
+Usage: python benchmarks/bench_store.py [sizes...] [--offers-per-business N]
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.disable(logging.CRITICAL)
+
+from app import app, repository  # noqa: E402
+from models import Business, Offer  # noqa: E402
+from datagen import populate  # noqa: E402
+
+LOOKUPS = 2000
+
+
+def per_call_us(function, arguments):
+    start = time.perf_counter()
+    for argument in arguments:
+        function(argument)
+    return (time.perf_counter() - start) / len(arguments) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('sizes', nargs='*', type=int, default=[1000, 10000, 100000])
+    parser.add_argument('--offers-per-business', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    client = app.test_client()
+    print(f"{'businesses':>12} {'get_by_email':>14} {'get_offers':>12} "
+          f"{'get_all_active':>16} {'/api/businesses':>17} {'per business':>14}")
+    for size in args.sizes:
+        populate(size, args.offers_per_business, seed=args.seed)
+        emails = [f'b{rng.randint(1, size)}@example.com' for _ in range(LOOKUPS)]
+        owners = rng.choices(list(repository.businesses.values()), k=LOOKUPS)
+
+        by_email = per_call_us(Business.get_by_email, emails)
+        get_offers = per_call_us(Business.get_offers, owners)
+        all_active = per_call_us(lambda _: Offer.get_all_active(), range(LOOKUPS))
+
+        start = time.perf_counter()
+        client.get('/api/businesses')
+        endpoint_ms = (time.perf_counter() - start) * 1000
+
+        print(f"{size:>12} {by_email:>12.2f}us {get_offers:>10.2f}us {all_active:>14.2f}us "
+              f"{endpoint_ms:>15.1f}ms {endpoint_ms * 1000 / size:>12.2f}us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Synthetic data for the benchmarks: businesses spread uniformly over a
+city-sized bounding box, each with a fixed number of offers of which a
+configurable share is active. Generation is deterministic for a seed.
+"""
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import repository  # noqa: E402
+from models import Business, Offer, OFFER_CATEGORIES  # noqa: E402
+
+# Roughly the city of Buenos Aires: (min_lat, max_lat, min_lng, max_lng)
+CITY_BOUNDS = (-34.70, -34.53, -58.53, -58.34)
+
+
+def generate(businesses, offers_per_business=3, active_ratio=0.8, seed=42, bounds=CITY_BOUNDS):
+    """
+    Returns (businesses, offers) as model instances, not yet stored
+    """
+    rng = random.Random(seed)
+    categories = list(OFFER_CATEGORIES)
+    min_lat, max_lat, min_lng, max_lng = bounds
+
+    business_list, offer_list = [], []
+    offer_id = 0
+    for i in range(1, businesses + 1):
+        business = Business(str(i), f'b{i}@example.com', f'Negocio {i}', 'x',
+                            latitude=rng.uniform(min_lat, max_lat),
+                            longitude=rng.uniform(min_lng, max_lng))
+        business_list.append(business)
+        for _ in range(offers_per_business):
+            offer_id += 1
+            offer_list.append(Offer(str(offer_id), business.id, 'Oferta', 'Descripción', rng.randint(5, 60),
+                                    '2030-12-31', is_active=rng.random() < active_ratio,
+                                    category=rng.choice(categories)))
+    return business_list, offer_list
+
+
+def populate(businesses, offers_per_business=3, active_ratio=0.8, seed=42, bounds=CITY_BOUNDS):
+    """
+    Replace the repository contents with a generated data set, using the
+    batch add paths. Returns (businesses, offers)
+    """
+    business_list, offer_list = generate(businesses, offers_per_business, active_ratio, seed, bounds)
+    repository.clear()
+    repository.add_businesses(business_list)
+    repository.add_offers(offer_list)
+    # Move the id counters past the generated ids for later creates
+    repository.load([], [])
+    return business_list, offer_list
+
+
+def random_points(count, seed=0, bounds=CITY_BOUNDS):
+    """
+    User positions uniformly spread over the same bounding box
+    """
+    rng = random.Random(seed)
+    min_lat, max_lat, min_lng, max_lng = bounds
+    return [(rng.uniform(min_lat, max_lat), rng.uniform(min_lng, max_lng)) for _ in range(count)]
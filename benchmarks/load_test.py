@@ -0,0 +1,230 @@
+"""
+Throughput and tail latency of /api/nearby_offers under concurrent
+keep-alive clients, comparing the sync gunicorn deployment with the asyncio
+worker (asgi.py). Optional idle geofence streams show the difference the
+event loop makes: every open stream pins a sync worker, while the async
+worker holds them as parked coroutines.
+
+Each mode is started as a gunicorn server on benchmarks/seeded_app.py, or
+pass --url to load an already running server.
+
+Usage: python benchmarks/load_test.py [--mode sync async] [--concurrency 1 10 100 500]
+                                      [--idle-streams N] [--duration SECONDS] [--workers N]
+                                      [--businesses N] [--output results.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from urllib.parse import urlsplit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CITY_BOUNDS = (-34.70, -34.53, -58.53, -58.34)
+WORKER_CLASSES = {
+    'sync': ('sync', 'seeded_app:app'),
+    'async': ('uvicorn_worker.UvicornWorker', 'seeded_app:application'),
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode, port, workers, businesses):
+    worker_class, target = WORKER_CLASSES[mode]
+    env = dict(os.environ, BENCH_BUSINESSES=str(businesses))
+    return subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--chdir', BENCH_DIR, '-k', worker_class, '-w', str(workers),
+         '-b', f'127.0.0.1:{port}', '--log-level', 'warning', target],
+        env=env
+    )
+
+
+async def wait_until_ready(host, port, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+            writer.write(f'GET /api/changes?since=0 HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n'.encode())
+            status, _ = await read_response(reader)
+            writer.close()
+            if status == 200:
+                return
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError(f'Server on port {port} did not become ready')
+
+
+async def read_response(reader):
+    """
+    Read one HTTP/1.1 response; returns (status, keep_alive)
+    """
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split()[1])
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip().lower()
+
+    keep_alive = headers.get('connection') != 'close'
+    if 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    elif headers.get('transfer-encoding') == 'chunked':
+        while True:
+            size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    elif status != 304:
+        await reader.read()
+        keep_alive = False
+    return status, keep_alive
+
+
+async def run_client(host, port, paths, deadline, timeout, latencies, errors):
+    rng = random.Random()
+    reader = writer = None
+    while time.perf_counter() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+            start = time.perf_counter()
+            writer.write(f'GET {rng.choice(paths)} HTTP/1.1\r\nHost: {host}\r\n\r\n'.encode())
+            status, keep_alive = await asyncio.wait_for(read_response(reader), timeout)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+            errors.append(1)
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+            continue
+
+        if status == 200:
+            latencies.append(time.perf_counter() - start)
+        else:
+            errors.append(status)
+        if not keep_alive:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def open_idle_stream(host, port):
+    """
+    A geofence stream that never sends a position, like a backgrounded tab
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(f'GET /api/geofence/stream HTTP/1.1\r\nHost: {host}\r\n\r\n'.encode())
+
+    async def drain():
+        try:
+            while await reader.read(4096):
+                pass
+        except OSError:
+            pass
+
+    return writer, asyncio.ensure_future(drain())
+
+
+async def run_level(host, port, concurrency, duration, timeout, paths, idle_streams):
+    streams = [await open_idle_stream(host, port) for _ in range(idle_streams)]
+    # Give the server a moment to accept the streams before loading it
+    await asyncio.sleep(0.5 if streams else 0)
+
+    latencies, errors = [], []
+    start = time.perf_counter()
+    deadline = start + duration
+    await asyncio.gather(*(run_client(host, port, paths, deadline, timeout, latencies, errors)
+                           for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    for writer, drain in streams:
+        writer.close()
+        drain.cancel()
+
+    latencies.sort()
+    return {
+        'concurrency': concurrency,
+        'idle_streams': idle_streams,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2) if latencies else None,
+        'p99_ms': round(latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000, 2) if latencies else None,
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 2) if latencies else None,
+    }
+
+
+def query_paths(count, radius, seed):
+    rng = random.Random(seed)
+    min_lat, max_lat, min_lng, max_lng = CITY_BOUNDS
+    return [f'/api/nearby_offers?lat={rng.uniform(min_lat, max_lat):.6f}'
+            f'&lng={rng.uniform(min_lng, max_lng):.6f}&radius={radius}'
+            for _ in range(count)]
+
+
+async def benchmark(mode, host, port, args, paths):
+    await wait_until_ready(host, port)
+    results = []
+    for concurrency in args.concurrency:
+        result = await run_level(host, port, concurrency, args.duration, args.timeout, paths, args.idle_streams)
+        result['mode'] = mode
+        results.append(result)
+        print(f"{mode:>6} {concurrency:>6} {args.idle_streams:>6} {result['requests']:>9} "
+              f"{result['requests_per_second']:>9} {result['p50_ms'] or '-':>9} {result['p99_ms'] or '-':>9} "
+              f"{result['errors']:>7}", flush=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', nargs='+', choices=sorted(WORKER_CLASSES), default=['sync', 'async'])
+    parser.add_argument('--url', help='Load this running server instead of starting one per mode')
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 10, 100, 500])
+    parser.add_argument('--idle-streams', type=int, default=0)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--timeout', type=float, default=10, help='Per request timeout in seconds')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--businesses', type=int, default=10000)
+    parser.add_argument('--points', type=int, default=1000,
+                        help='Distinct query locations; fewer points means more cache hits')
+    parser.add_argument('--radius', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    paths = query_paths(args.points, args.radius, args.seed)
+    print(f"{'mode':>6} {'conns':>6} {'idle':>6} {'requests':>9} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7}")
+
+    results = []
+    if args.url:
+        url = urlsplit(args.url)
+        results += asyncio.run(benchmark('remote', url.hostname, url.port or 80, args, paths))
+    else:
+        for mode in args.mode:
+            port = free_port()
+            server = start_server(mode, port, args.workers, args.businesses)
+            try:
+                results += asyncio.run(benchmark(mode, '127.0.0.1', port, args, paths))
+            finally:
+                server.terminate()
+                server.wait(timeout=30)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
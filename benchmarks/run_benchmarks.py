@@ -0,0 +1,252 @@
+"""
+Reproducible benchmark suite for the geo and offer code paths.
+
+Micro benchmarks time haversine_distance, get_nearby_offers,
+Business.get_by_email and Business.get_offers directly. Endpoint benchmarks
+drive /api/nearby_offers and /api/businesses through the Flask test client
+from 1, 4, 16 and 64 concurrent threads. Every data set is generated from
+--seed, so two runs on the same machine measure the same work.
+
+Startup benchmarks time fresh interpreters importing the app, with no
+database and with an unreachable one (see bench_startup.py).
+
+Results are written as JSON. Pass --compare with an earlier results file to
+print the change of every metric and exit with status 1 when any p50 got
+slower than --threshold.
+
+Usage: python benchmarks/run_benchmarks.py [--businesses 1000 10000 100000]
+                                           [--offers-per-business N] [--active-ratio R]
+                                           [--concurrency 1 4 16 64] [--output FILE]
+                                           [--startup-runs N] [--compare FILE] [--threshold 0.2]
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.disable(logging.CRITICAL)
+
+from datagen import populate, random_points  # noqa: E402
+from bench_startup import startup_timings  # noqa: E402
+from app import app, nearby_offers_cache  # noqa: E402
+from models import Business  # noqa: E402
+from geofence import haversine_distance, get_nearby_offers  # noqa: E402
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def summarize(timings, elapsed=None):
+    """
+    Latency percentiles in microseconds plus throughput for a list of
+    per-operation timings in seconds
+    """
+    timings = sorted(timings)
+    count = len(timings)
+    total = elapsed if elapsed is not None else sum(timings)
+    return {
+        'operations': count,
+        'mean_us': round(statistics.fmean(timings) * 1e6, 3),
+        'p50_us': round(timings[count // 2] * 1e6, 3),
+        'p95_us': round(timings[min(count - 1, int(count * 0.95))] * 1e6, 3),
+        'p99_us': round(timings[min(count - 1, int(count * 0.99))] * 1e6, 3),
+        'ops_per_second': round(count / total, 1) if total else None,
+    }
+
+
+def time_calls(function, arguments, repeat=1):
+    """
+    Per-call timings; `repeat` calls are timed together for very fast functions
+    """
+    timings = []
+    for argument in arguments:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            function(*argument)
+        timings.append((time.perf_counter() - start) / repeat)
+    return timings
+
+
+def micro_benchmarks(size, seed, queries, radius):
+    rng = random.Random(seed)
+    points = random_points(queries, seed=seed)
+    businesses = list(Business.get_all_with_location())
+    owners = rng.choices(businesses, k=queries)
+
+    return {
+        'haversine_distance': summarize(time_calls(
+            haversine_distance, [(lat, lng, b.latitude, b.longitude) for (lat, lng), b in zip(points, owners)],
+            repeat=100)),
+        'get_nearby_offers': summarize(time_calls(
+            get_nearby_offers, [(lat, lng, radius) for lat, lng in points])),
+        'Business.get_by_email': summarize(time_calls(
+            Business.get_by_email, [(f'b{rng.randint(1, size)}@example.com',) for _ in range(queries)],
+            repeat=100)),
+        'Business.get_offers': summarize(time_calls(
+            Business.get_offers, [(business,) for business in owners], repeat=10)),
+    }
+
+
+def endpoint_benchmark(paths_for_thread, concurrency):
+    """
+    Run GETs from `concurrency` threads, each with its own test client
+    """
+    timings, failures = [], []
+    lock = threading.Lock()
+    barrier = threading.Barrier(concurrency + 1)
+
+    def worker(index):
+        client = app.test_client()
+        local_timings, local_failures = [], 0
+        paths = paths_for_thread(index)
+        barrier.wait()
+        for path in paths:
+            start = time.perf_counter()
+            response = client.get(path)
+            local_timings.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                local_failures += 1
+        with lock:
+            timings.extend(local_timings)
+            failures.append(local_failures)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    result = summarize(timings, time.perf_counter() - start)
+    result['errors'] = sum(failures)
+    return result
+
+
+def endpoint_benchmarks(concurrency_levels, requests, seed, radius):
+    results = {'/api/nearby_offers': {}, '/api/businesses': {}}
+    for concurrency in concurrency_levels:
+        per_thread = max(1, requests // concurrency)
+
+        # Distinct points per run so the measurement covers the uncached path
+        nearby_offers_cache.clear()
+
+        def nearby_paths(index):
+            points = random_points(per_thread, seed=seed * 1000 + concurrency * 100 + index)
+            return [f'/api/nearby_offers?lat={lat}&lng={lng}&radius={radius}' for lat, lng in points]
+
+        results['/api/nearby_offers'][str(concurrency)] = endpoint_benchmark(nearby_paths, concurrency)
+        results['/api/businesses'][str(concurrency)] = endpoint_benchmark(
+            lambda index: ['/api/businesses'] * max(1, per_thread // 10), concurrency)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(RESULTS_DIR)).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def flatten(results, prefix=''):
+    """
+    {'a': {'b': {'p50_us': 1}}} -> {'a / b': {'p50_us': 1}}
+    """
+    flat = {}
+    for key, value in results.items():
+        name = f'{prefix} / {key}' if prefix else key
+        if isinstance(value, dict) and 'p50_us' not in value:
+            flat.update(flatten(value, name))
+        else:
+            flat[name] = value
+    return flat
+
+
+def compare(previous, current, threshold):
+    """
+    Print the p50 change of every benchmark present in both runs.
+    Returns the names of the benchmarks slower than the threshold
+    """
+    before, after = flatten(previous['results']), flatten(current['results'])
+    regressions = []
+    print(f"\n{'benchmark':<60} {'before p50':>12} {'after p50':>12} {'change':>8}")
+    for name, metrics in after.items():
+        if name not in before:
+            continue
+        old, new = before[name]['p50_us'], metrics['p50_us']
+        change = (new - old) / old if old else 0.0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:<60} {old:>10.2f}us {new:>10.2f}us {change:>+7.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--businesses', nargs='+', type=int, default=[1000, 10000, 100000])
+    parser.add_argument('--offers-per-business', type=int, default=3)
+    parser.add_argument('--active-ratio', type=float, default=0.8)
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4, 16, 64])
+    parser.add_argument('--queries', type=int, default=500, help='Calls per micro benchmark')
+    parser.add_argument('--requests', type=int, default=512, help='Requests per endpoint and concurrency level')
+    parser.add_argument('--radius', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--startup-runs', type=int, default=5, help='Fresh interpreters per startup scenario')
+    parser.add_argument('--output', help='Results file (default: benchmarks/results/<timestamp>.json)')
+    parser.add_argument('--compare', help='Earlier results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Slowdown reported as a regression')
+    args = parser.parse_args()
+
+    run = {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'results': {},
+    }
+
+    print("Startup", flush=True)
+    run['results']['startup'] = {name: summarize(timings)
+                                 for name, timings in startup_timings(args.startup_runs).items()}
+    for name, metrics in flatten(run['results']['startup']).items():
+        print(f"  {name:<40} p50 {metrics['p50_us'] / 1000:>10.1f}ms", flush=True)
+
+    for size in args.businesses:
+        print(f"{size} businesses, {args.offers_per_business} offers each", flush=True)
+        populate(size, args.offers_per_business, args.active_ratio, seed=args.seed)
+        run['results'][str(size)] = {
+            'micro': micro_benchmarks(size, args.seed, args.queries, args.radius),
+            'endpoints': endpoint_benchmarks(args.concurrency, args.requests, args.seed, args.radius),
+        }
+        for name, metrics in flatten(run['results'][str(size)]).items():
+            print(f"  {name:<40} p50 {metrics['p50_us']:>10.2f}us  p99 {metrics['p99_us']:>10.2f}us  "
+                  f"{metrics['ops_per_second']:>10} ops/s", flush=True)
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    with open(output, 'w') as f:
+        json.dump(run, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), run, args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+"""
+The app preloaded with synthetic businesses and offers, for load tests.
+Serves the same data in both modes:
+
+    gunicorn --chdir benchmarks seeded_app:app                                   (sync)
+    gunicorn --chdir benchmarks -k uvicorn_worker.UvicornWorker seeded_app:application  (async)
+
+BENCH_BUSINESSES and BENCH_SEED control the data set.
+"""
+import logging
+import os
+
+logging.disable(logging.CRITICAL)
+
+from datagen import populate  # noqa: E402
+from app import app  # noqa: E402,F401
+from asgi import application  # noqa: E402,F401
+
+populate(int(os.environ.get('BENCH_BUSINESSES', 10000)), seed=int(os.environ.get('BENCH_SEED', 42)))
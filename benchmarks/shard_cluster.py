@@ -0,0 +1,196 @@
+"""
+Local geo-sharded cluster: seeds a shared SQLite file with several cities,
+starts one app process per shard, an unsharded reference node and the
+shard router, then checks that routed nearby queries return the same
+offers, at the same distances, as the reference, and reports latencies,
+how the businesses were spread over the shards and how soon a business
+written through another node is routed to.
+
+Usage: python benchmarks/shard_cluster.py [--shards N] [--businesses PER_CITY]
+                                          [--queries N] [--radius METERS]
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.error import URLError
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+logging.disable(logging.CRITICAL)
+
+from datagen import generate, random_points  # noqa: E402
+from models import Business, Offer  # noqa: E402
+from sharding import ShardMap  # noqa: E402
+from storage import SQLiteBackend  # noqa: E402
+
+# (min_lat, max_lat, min_lng, max_lng); the last one straddles the corner
+# of four cells, so its queries need more than one shard
+CITIES = {
+    'buenos_aires': (-34.70, -34.53, -58.53, -58.34),
+    'cordoba': (-31.48, -31.35, -64.26, -64.10),
+    'rosario': (-33.02, -32.88, -60.72, -60.60),
+    'mendoza': (-32.95, -32.84, -68.90, -68.78),
+    'montevideo': (-34.92, -34.80, -56.26, -56.05),
+    'cell_corner': (-35.03, -34.97, -58.03, -57.97),
+}
+BASE_PORT = 5600
+STARTUP_TIMEOUT_SECONDS = 60
+
+
+def seed(path, per_city, seed_value):
+    """
+    Write every city into one SQLite file, with ids unique across cities
+    """
+    backend = SQLiteBackend(path)
+    business_offset = offer_offset = 0
+    for i, bounds in enumerate(CITIES.values()):
+        businesses, offers = generate(per_city, seed=seed_value + i, bounds=bounds)
+        for business in businesses:
+            business.id = str(business_offset + int(business.id))
+            business.email = f'b{business.id}@example.com'
+        for offer in offers:
+            offer.id = str(offer_offset + int(offer.id))
+            offer.business_id = str(business_offset + int(offer.business_id))
+        backend.insert_businesses(businesses)
+        backend.insert_offers(offers)
+        business_offset += len(businesses)
+        offer_offset += len(offers)
+    backend.close()
+
+
+def start(command, env):
+    return subprocess.Popen(command, cwd=ROOT, env={**os.environ, **env},
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def node_command(port):
+    return [sys.executable, '-m', 'flask', '--app', 'main', 'run', '--port', str(port)]
+
+
+def get(url):
+    start_time = time.perf_counter()
+    with urlopen(url, timeout=10) as response:
+        body = json.loads(response.read())
+    return body, (time.perf_counter() - start_time) * 1000
+
+
+def wait_ready(urls):
+    deadline = time.monotonic() + STARTUP_TIMEOUT_SECONDS
+    for url in urls:
+        while True:
+            try:
+                get(url)
+                break
+            except (URLError, OSError):
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"{url} did not come up")
+                time.sleep(0.2)
+
+
+def ranked(body):
+    """
+    (distance, offer id) pairs of a nearby response, closest first. Offers
+    of businesses at the same rounded distance may come in either order
+    """
+    return sorted((offer['distance'], offer['id']) for offer in body['offers'])
+
+
+def time_to_visible(database, router, lat, lng):
+    """
+    Seconds until a business and offer written straight to the shared
+    database, as any node would, are returned by the router
+    """
+    backend = SQLiteBackend(database)
+    business_id, = backend.allocate_ids('business')
+    offer_id, = backend.allocate_ids('offer')
+    backend.insert_businesses([Business(business_id, f'b{business_id}@example.com', 'Nuevo', 'x',
+                                        latitude=lat, longitude=lng)])
+    backend.insert_offers([Offer(offer_id, business_id, 'Oferta', 'Descripción', 10, '2030-12-31')])
+    backend.close()
+
+    start_time = time.monotonic()
+    query = urlencode({'lat': lat, 'lng': lng, 'radius': 100})
+    while time.monotonic() - start_time < STARTUP_TIMEOUT_SECONDS:
+        if any(offer['id'] == offer_id for offer in get(f'{router}/api/nearby_offers?{query}')[0]['offers']):
+            return time.monotonic() - start_time
+        time.sleep(0.05)
+    return None
+
+
+def percentile(timings, fraction):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--shards', type=int, default=3)
+    parser.add_argument('--businesses', type=int, default=2000, help='businesses per city')
+    parser.add_argument('--queries', type=int, default=50, help='queries per city')
+    parser.add_argument('--radius', type=float, default=2000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='shard-cluster-')
+    database = os.path.join(workdir, 'geoofertas.db')
+    seed(database, args.businesses, args.seed)
+
+    nodes = [f'http://127.0.0.1:{BASE_PORT + i}' for i in range(args.shards)]
+    reference = f'http://127.0.0.1:{BASE_PORT + args.shards}'
+    router = f'http://127.0.0.1:{BASE_PORT + args.shards + 1}'
+    storage_env = {'STORAGE_BACKEND': 'sqlite', 'SQLITE_PATH': database}
+    shard_env = {'SHARD_NODES': ','.join(nodes)}
+
+    processes = [start(node_command(BASE_PORT + i), {**storage_env, **shard_env, 'SHARD_ID': str(i)})
+                 for i in range(args.shards)]
+    processes.append(start(node_command(BASE_PORT + args.shards), storage_env))
+    processes.append(start([sys.executable, 'shard_router.py', '--port', str(BASE_PORT + args.shards + 1)],
+                           shard_env))
+    try:
+        wait_ready([f'{url}/api/businesses' for url in nodes + [reference]])
+        wait_ready([f'{router}/api/nearby_offers?lat=-34.6&lng=-58.4'])
+
+        total = len(get(f'{reference}/api/businesses')[0]['businesses'])
+        print(f"{total} businesses in {len(CITIES)} cities over {args.shards} shards")
+        for i, url in enumerate(nodes):
+            print(f"  shard {i}: {len(get(f'{url}/api/businesses')[0]['businesses'])} businesses")
+
+        shard_map = ShardMap(nodes)
+        print(f"{'city':>14} {'shards':>7} {'router p50':>11} {'router p99':>11} {'single p50':>11} {'offers':>7}"
+              f" {'mismatches':>10}")
+        for i, (city, bounds) in enumerate(CITIES.items()):
+            routed_ms, reference_ms, shards_touched, offers, mismatches = [], [], [], 0, 0
+            for lat, lng in random_points(args.queries, seed=args.seed + i, bounds=bounds):
+                query = urlencode({'lat': lat, 'lng': lng, 'radius': args.radius})
+                routed, routed_time = get(f'{router}/api/nearby_offers?{query}')
+                expected, reference_time = get(f'{reference}/api/nearby_offers?{query}')
+                routed_ms.append(routed_time)
+                reference_ms.append(reference_time)
+                shards_touched.append(len(shard_map.shards_for_circle(lat, lng, args.radius)))
+                offers += expected['count']
+                if ranked(routed) != ranked(expected):
+                    mismatches += 1
+            print(f"{city:>14} {statistics.mean(shards_touched):>7.2f} {statistics.median(routed_ms):>9.2f}ms "
+                  f"{percentile(routed_ms, 0.99):>9.2f}ms {statistics.median(reference_ms):>9.2f}ms "
+                  f"{offers / args.queries:>7.1f} {mismatches:>10}")
+
+        for city, (min_lat, max_lat, min_lng, max_lng) in CITIES.items():
+            seconds = time_to_visible(database, router, (min_lat + max_lat) / 2, (min_lng + max_lng) / 2)
+            print(f"new business in {city}: " + (f"routed after {seconds:.2f}s" if seconds is not None else "never routed"))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
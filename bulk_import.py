@@ -0,0 +1,333 @@
+"""
+Bulk import of businesses and offers from CSV or JSON lines.
+
+Records are read from a stream and handled in batches: a batch is
+validated, its passwords are hashed across the hashing pool, and it goes to
+the repository in a single add_businesses / add_offers call. The backend
+writes it in one transaction, and the indexes, response caches and change
+feed are updated once per batch instead of once per row. Memory stays flat
+however large the input is.
+
+Rejected rows are reported by line number and do not stop the import.
+"""
+import csv
+import datetime
+import io
+import json
+import sys
+import time
+
+import click
+
+from app import repository
+from auth import password_hasher
+from models import Business, Offer, OFFER_CATEGORIES, DEFAULT_CATEGORY
+from storage import MemoryBackend, DuplicateRecord
+
+IMPORT_FORMATS = ('csv', 'jsonl')
+DEFAULT_BATCH_SIZE = 1000
+# Rejected rows listed in a result; the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+
+class ImportRowError(ValueError):
+    """
+    Raised for a record that cannot be imported; the message is reported
+    with its line number
+    """
+
+
+class ImportResult:
+    """
+    Counts and throughput of one import run
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.imported = 0
+        self.rejected = 0
+        self.batches = 0
+        self.errors = []
+        self.started = time.perf_counter()
+        self.seconds = 0.0
+
+    def reject(self, line, message):
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'error': message})
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self.started
+        return self
+
+    @property
+    def rows_per_second(self):
+        return round(self.rows / self.seconds, 1) if self.seconds else None
+
+    def to_dict(self):
+        return {
+            'rows': self.rows,
+            'imported': self.imported,
+            'rejected': self.rejected,
+            'batches': self.batches,
+            'seconds': round(self.seconds, 3),
+            'rows_per_second': self.rows_per_second,
+            'errors': self.errors,
+        }
+
+
+def detect_format(filename, content_type=None):
+    """
+    Import format from a file name or Content-Type, csv unless it looks
+    like JSON lines
+    """
+    if content_type and ('ndjson' in content_type or 'jsonl' in content_type or 'json' in content_type):
+        return 'jsonl'
+    if filename and filename.lower().endswith(('.jsonl', '.ndjson', '.json')):
+        return 'jsonl'
+    return 'csv'
+
+
+def iter_records(stream, fmt):
+    """
+    (line number, record dict or ImportRowError) pairs from a text stream
+    """
+    if fmt not in IMPORT_FORMATS:
+        raise ValueError(f"Unknown import format: {fmt}")
+
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+        return
+
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield line_number, ImportRowError('JSON inválido')
+            continue
+        yield line_number, record if isinstance(record, dict) else ImportRowError('Se esperaba un objeto')
+
+
+def _text(record, field, required=False):
+    value = record.get(field)
+    value = '' if value is None else str(value).strip()
+    if required and not value:
+        raise ImportRowError(f"Falta el campo {field}")
+    return value
+
+
+def _number(record, field, convert=float, default=0):
+    value = record.get(field)
+    if value is None or value == '':
+        return default
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        raise ImportRowError(f"Valor inválido en {field}")
+
+
+def _flag(record, field, default=True):
+    value = record.get(field)
+    if value is None or value == '':
+        return default
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ('1', 'true', 'yes', 'si', 'sí'):
+        return True
+    if text in ('0', 'false', 'no'):
+        return False
+    raise ImportRowError(f"Valor inválido en {field}")
+
+
+def validate_business(record, seen_emails):
+    """
+    Fields of a business record; the password is hashed later, with its
+    batch. A record may carry a password_hash instead of a password, in a
+    format the password hasher can verify
+    """
+    email = _text(record, 'email', required=True)
+    if email in seen_emails or repository.get_business_by_email(email):
+        raise ImportRowError(f"Ya existe un negocio con el email {email}")
+    password, password_hash = _text(record, 'password'), _text(record, 'password_hash')
+    if not password and not password_hash:
+        raise ImportRowError('Falta el campo password')
+    if password_hash and not password_hasher.recognises(password_hash):
+        raise ImportRowError('Formato inválido en password_hash')
+
+    latitude, longitude = _number(record, 'latitude'), _number(record, 'longitude')
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ImportRowError('Ubicación inválida')
+
+    name = _text(record, 'name', required=True)
+    seen_emails.add(email)
+    return {
+        'email': email,
+        'name': name,
+        'password': password,
+        'password_hash': password_hash,
+        'phone': _text(record, 'phone'),
+        'address': _text(record, 'address'),
+        'latitude': latitude,
+        'longitude': longitude,
+    }
+
+
+def validate_offer(record, business_id=None):
+    """
+    Offer fields of a record. The business is given by business_id or
+    business_email, or fixed by the caller (business_id argument)
+    """
+    if business_id is None:
+        business_id = _text(record, 'business_id')
+        business = Business.get(business_id) if business_id else \
+            Business.get_by_email(_text(record, 'business_email', required=True))
+        if business is None:
+            raise ImportRowError('Negocio no encontrado')
+        business_id = business.id
+
+    discount_percentage = _number(record, 'discount_percentage', int, None)
+    if discount_percentage is None or not 1 <= discount_percentage <= 90:
+        raise ImportRowError('El porcentaje de descuento debe estar entre 1% y 90%.')
+    valid_until = _text(record, 'valid_until', required=True)
+    try:
+        datetime.date.fromisoformat(valid_until)
+    except ValueError:
+        raise ImportRowError('Fecha inválida en valid_until')
+    category = _text(record, 'category') or DEFAULT_CATEGORY
+    if category not in OFFER_CATEGORIES:
+        raise ImportRowError('Categoría inválida')
+
+    return {
+        'business_id': business_id,
+        'title': _text(record, 'title', required=True),
+        'description': _text(record, 'description', required=True),
+        'discount_percentage': discount_percentage,
+        'valid_until': valid_until,
+        'is_active': _flag(record, 'is_active'),
+        'category': category,
+    }
+
+
+def _run_import(records, validate, store, batch_size):
+    result = ImportResult()
+    batch = []
+    for line_number, record in records:
+        result.rows += 1
+        try:
+            if isinstance(record, ImportRowError):
+                raise record
+            batch.append((line_number, validate(record)))
+        except ImportRowError as e:
+            result.reject(line_number, str(e))
+            continue
+        if len(batch) >= batch_size:
+            _store_batch(batch, store, result)
+            batch = []
+    if batch:
+        _store_batch(batch, store, result)
+    return result.finish()
+
+
+def _store_batch(batch, store, result):
+    rejected = store(batch)
+    for line_number, message in rejected:
+        result.reject(line_number, message)
+    result.imported += len(batch) - len(rejected)
+    result.batches += 1
+
+
+def _store_businesses(batch):
+    """
+    Add a batch of (line number, fields), returning the (line number,
+    message) of the rows left out. A batch colliding with a business
+    another process stored since it was validated is retried row by row,
+    and only the colliding rows are rejected
+    """
+    hashes = iter(password_hasher.hash_many([fields['password'] for _, fields in batch
+                                             if not fields['password_hash']]))
+    businesses = [
+        Business(business_id, fields['email'], fields['name'],
+                 fields['password_hash'] or next(hashes), fields['phone'], fields['address'],
+                 fields['latitude'], fields['longitude'])
+        for business_id, (_, fields) in zip(repository.next_business_ids(len(batch)), batch)
+    ]
+    try:
+        repository.add_businesses(businesses)
+        return []
+    except DuplicateRecord:
+        pass
+
+    rejected = []
+    for (line_number, fields), business in zip(batch, businesses):
+        try:
+            repository.add_business(business)
+        except DuplicateRecord:
+            rejected.append((line_number, f"Ya existe un negocio con el email {fields['email']}"))
+    return rejected
+
+
+def _store_offers(batch):
+    repository.add_offers([
+        Offer(offer_id, fields['business_id'], fields['title'], fields['description'],
+              fields['discount_percentage'], fields['valid_until'], is_active=fields['is_active'],
+              category=fields['category'])
+        for offer_id, (_, fields) in zip(repository.next_offer_ids(len(batch)), batch)
+    ])
+    return []
+
+
+def import_businesses(records, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Import (line number, record) pairs from iter_records as businesses
+    """
+    seen_emails = set()
+    return _run_import(records, lambda record: validate_business(record, seen_emails), _store_businesses,
+                       batch_size)
+
+
+def import_offers(records, batch_size=DEFAULT_BATCH_SIZE, business_id=None):
+    """
+    Import (line number, record) pairs from iter_records as offers, all for
+    business_id when it is given
+    """
+    return _run_import(records, lambda record: validate_offer(record, business_id), _store_offers, batch_size)
+
+
+# CLI: flask --app main import businesses|offers FILE
+
+@click.group('import', help='Bulk import businesses or offers from CSV or JSON lines.')
+def import_cli():
+    pass
+
+
+def _cli_import(run, path, fmt, batch_size):
+    stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline='') if path == '-' else \
+        open(path, encoding='utf-8', newline='')
+    with stream:
+        result = run(iter_records(stream, fmt or detect_format(path)), batch_size)
+    click.echo(json.dumps(result.to_dict(), ensure_ascii=False, indent=2))
+    if isinstance(repository.backend, MemoryBackend):
+        click.echo('Warning: STORAGE_BACKEND=memory, the imported rows are not persisted', err=True)
+
+
+@import_cli.command('businesses')
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(IMPORT_FORMATS), help='Default: from the file extension')
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True)
+def import_businesses_command(path, fmt, batch_size):
+    """Import businesses from PATH ('-' for stdin)."""
+    _cli_import(import_businesses, path, fmt, batch_size)
+
+
+@import_cli.command('offers')
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(IMPORT_FORMATS), help='Default: from the file extension')
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True)
+def import_offers_command(path, fmt, batch_size):
+    """Import offers from PATH ('-' for stdin)."""
+    _cli_import(import_offers, path, fmt, batch_size)
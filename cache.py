@@ -0,0 +1,90 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU cache with a per-entry time to live.
+    Meant for rendered API responses; the repository clears it on every
+    write, the TTL only bounds how long an idle entry keeps memory.
+    """
+
+    def __init__(self, max_entries=1024, ttl_seconds=60):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl_seconds
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class VersionedSnapshot:
+    """
+    A single value rebuilt lazily whenever the data version it was built
+    from no longer matches the current one
+    """
+
+    def __init__(self, build):
+        self._build = build
+        self._current = (None, None)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, version):
+        current_version, value = self._current
+        if current_version == version:
+            self.hits += 1
+            return value
+        with self._lock:
+            current_version, value = self._current
+            if current_version != version:
+                self.misses += 1
+                value = self._build()
+                self._current = (version, value)
+            else:
+                self.hits += 1
+            return value
+
+    def peek(self, version):
+        """
+        The value if it was built for `version`, else None (never builds)
+        """
+        current_version, value = self._current
+        if current_version != version:
+            return None
+        self.hits += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._current = (None, None)
@@ -0,0 +1,156 @@
+import math
+import os
+
+# Web Mercator latitude limit, as used by the map tiles
+MAX_MERCATOR_LAT = 85.05112878
+# Cluster cells are this many pixels wide on 256px tiles
+CLUSTER_CELL_PIXELS = 64
+CELLS_PER_TILE = 256 // CLUSTER_CELL_PIXELS
+# Highest zoom with clusters; above it the map gets individual businesses
+CLUSTER_MAX_ZOOM = int(os.environ.get('CLUSTER_MAX_ZOOM', 16))
+
+
+def mercator(lat, lng):
+    """
+    Normalized Web Mercator coordinates, both in [0, 1)
+    """
+    lat = min(max(lat, -MAX_MERCATOR_LAT), MAX_MERCATOR_LAT)
+    x = (lng + 180.0) / 360.0
+    sin_lat = math.sin(math.radians(lat))
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return min(max(x, 0.0), 1.0 - 1e-12), min(max(y, 0.0), 1.0 - 1e-12)
+
+
+class ClusterIndex:
+    """
+    Grid aggregates of point locations at every zoom level from 0 to
+    max_zoom. A level divides each map tile into CELLS_PER_TILE x
+    CELLS_PER_TILE cells and keeps (count, sum of lat, sum of lng) per
+    occupied cell, so a cluster and its centroid are read without touching
+    its members. Inserts and removals update one cell per level. The finest
+    level also keeps the member ids for individual markers at high zoom.
+    """
+
+    def __init__(self, max_zoom=CLUSTER_MAX_ZOOM):
+        self.max_zoom = max_zoom
+        self._levels = [{} for _ in range(max_zoom + 1)]
+        self._members = {}
+        self._locations = {}
+
+    @staticmethod
+    def cells_per_axis(zoom):
+        return (1 << zoom) * CELLS_PER_TILE
+
+    def _cell(self, x, y, zoom):
+        scale = self.cells_per_axis(zoom)
+        return int(x * scale), int(y * scale)
+
+    def insert(self, item_id, lat, lng):
+        if item_id in self._locations:
+            self.remove(item_id)
+        x, y = mercator(lat, lng)
+        self._locations[item_id] = (lat, lng, x, y)
+        for zoom, cells in enumerate(self._levels):
+            cell = self._cell(x, y, zoom)
+            aggregate = cells.get(cell)
+            if aggregate is None:
+                cells[cell] = [1, lat, lng]
+            else:
+                aggregate[0] += 1
+                aggregate[1] += lat
+                aggregate[2] += lng
+        self._members.setdefault(self._cell(x, y, self.max_zoom), set()).add(item_id)
+
+    def remove(self, item_id):
+        location = self._locations.pop(item_id, None)
+        if location is None:
+            return
+        lat, lng, x, y = location
+        for zoom, cells in enumerate(self._levels):
+            cell = self._cell(x, y, zoom)
+            aggregate = cells[cell]
+            aggregate[0] -= 1
+            if aggregate[0] == 0:
+                del cells[cell]
+            else:
+                aggregate[1] -= lat
+                aggregate[2] -= lng
+        cell = self._cell(x, y, self.max_zoom)
+        members = self._members[cell]
+        members.discard(item_id)
+        if not members:
+            del self._members[cell]
+
+    def _cell_ranges(self, min_lat, min_lng, max_lat, max_lng, zoom):
+        """
+        (x ranges, y range) of the cells covering a bounding box; a box
+        crossing the antimeridian (min_lng > max_lng) gives two x ranges
+        """
+        last = self.cells_per_axis(zoom) - 1
+        west, north = self._cell(*mercator(max_lat, min_lng), zoom)
+        east, south = self._cell(*mercator(min_lat, max_lng), zoom)
+        x_ranges = [(west, east)] if west <= east else [(west, last), (0, east)]
+        return x_ranges, (north, south)
+
+    def _cells_in(self, cells, x_ranges, y_range):
+        box_cells = (y_range[1] - y_range[0] + 1) * sum(b - a + 1 for a, b in x_ranges)
+        if box_cells > len(cells):
+            # Big box: walking the occupied cells is cheaper
+            for (cx, cy), value in cells.items():
+                if y_range[0] <= cy <= y_range[1] and any(a <= cx <= b for a, b in x_ranges):
+                    yield value
+            return
+        for first, last in x_ranges:
+            for cx in range(first, last + 1):
+                for cy in range(y_range[0], y_range[1] + 1):
+                    value = cells.get((cx, cy))
+                    if value is not None:
+                        yield value
+
+    def fit_zoom(self, min_lat, min_lng, max_lat, max_lng, zoom, max_cells):
+        """
+        Highest zoom up to `zoom` at which the box spans at most max_cells
+        cells, which bounds the number of clusters a query can return
+        """
+        zoom = min(max(int(zoom), 0), self.max_zoom)
+        while zoom > 0:
+            x_ranges, y_range = self._cell_ranges(min_lat, min_lng, max_lat, max_lng, zoom)
+            if (y_range[1] - y_range[0] + 1) * sum(b - a + 1 for a, b in x_ranges) <= max_cells:
+                break
+            zoom -= 1
+        return zoom
+
+    def clusters(self, min_lat, min_lng, max_lat, max_lng, zoom):
+        """
+        (lat, lng, count) of the clusters in the box at a zoom level, the
+        position being the centroid of the members
+        """
+        zoom = min(max(int(zoom), 0), self.max_zoom)
+        x_ranges, y_range = self._cell_ranges(min_lat, min_lng, max_lat, max_lng, zoom)
+        return [(total_lat / count, total_lng / count, count)
+                for count, total_lat, total_lng in self._cells_in(self._levels[zoom], x_ranges, y_range)]
+
+    def count_in(self, min_lat, min_lng, max_lat, max_lng):
+        """
+        Number of points in the cells covering the box at the finest level
+        """
+        x_ranges, y_range = self._cell_ranges(min_lat, min_lng, max_lat, max_lng, self.max_zoom)
+        return sum(len(members) for members in self._cells_in(self._members, x_ranges, y_range))
+
+    def members(self, min_lat, min_lng, max_lat, max_lng):
+        """
+        Ids of the points inside the box
+        """
+        x_ranges, y_range = self._cell_ranges(min_lat, min_lng, max_lat, max_lng, self.max_zoom)
+        wrapped = min_lng > max_lng
+        ids = []
+        for members in self._cells_in(self._members, x_ranges, y_range):
+            for item_id in members:
+                lat, lng = self._locations[item_id][:2]
+                inside_lng = (lng >= min_lng or lng <= max_lng) if wrapped else min_lng <= lng <= max_lng
+                if min_lat <= lat <= max_lat and inside_lng:
+                    ids.append(item_id)
+        return ids
+
+    def __len__(self):
+        return len(self._locations)
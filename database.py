@@ -0,0 +1,138 @@
+"""
+Optional PostgreSQL database (DATABASE_URL), set up off the startup path.
+
+Nothing here runs at import time: SQLAlchemy and models_db are imported
+the first time the database is used, tables are created with the
+`flask init-db` command, and a background probe checks reachability with
+a short timeout. A worker therefore boots at the same speed whether the
+database is up, down or not configured.
+"""
+import logging
+import os
+import threading
+
+# Seconds a reachability check may wait for the server
+DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', 3))
+# Seconds between checks while the database is unreachable
+DB_PROBE_INTERVAL = float(os.environ.get('DB_PROBE_INTERVAL', 30))
+
+_db = None
+_lock = threading.Lock()
+
+
+def database_url():
+    url = os.environ.get("DATABASE_URL")
+    if url and url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+    return url
+
+
+def get_db(app=None):
+    """
+    The Flask-SQLAlchemy extension, created and bound to the app on first
+    use. Importing SQLAlchemy is deferred until then
+    """
+    global _db
+    with _lock:
+        if _db is None:
+            from flask_sqlalchemy import SQLAlchemy
+            from sqlalchemy.orm import DeclarativeBase
+
+            class Base(DeclarativeBase):
+                pass
+
+            if app is None:
+                from app import app
+            app.config["SQLALCHEMY_DATABASE_URI"] = database_url()
+            app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+                "pool_recycle": 300,
+                "pool_pre_ping": True,
+                "connect_args": {
+                    "connect_timeout": 10,
+                    "sslmode": "require"
+                }
+            }
+            _db = SQLAlchemy(model_class=Base)
+            _db.init_app(app)
+        return _db
+
+
+def check_connection(timeout=DB_CONNECT_TIMEOUT):
+    """
+    Whether the database accepts a connection within `timeout` seconds
+    """
+    url = database_url()
+    if not url:
+        return False
+    from sqlalchemy import create_engine, text
+
+    engine = create_engine(url, connect_args={"connect_timeout": timeout, "sslmode": "require"})
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+        return True
+    finally:
+        engine.dispose()
+
+
+class DatabaseProbe:
+    """
+    Background reachability check for the configured database.
+    Retries every DB_PROBE_INTERVAL seconds until the database answers, then
+    binds the SQLAlchemy extension and marks it available. Records are
+    never stored in this database: the repository writes only to its
+    storage backend (STORAGE_BACKEND) whatever the probe finds
+    """
+
+    def __init__(self, app, interval=DB_PROBE_INTERVAL):
+        self.app = app
+        self.interval = interval
+        self.available = False
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None or not database_url():
+            return
+        logging.error(f"DATABASE_URL is set but businesses and offers are stored by the "
+                      f"{os.environ.get('STORAGE_BACKEND', 'memory')} storage backend, not in that database"
+                      + ("; nothing is persisted, set STORAGE_BACKEND=sqlite to keep records"
+                         if os.environ.get('STORAGE_BACKEND', 'memory') == 'memory' else ""))
+        self._thread = threading.Thread(target=self._run, name='database-probe', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+
+    @property
+    def status(self):
+        """
+        'not_configured' without DATABASE_URL, else 'available' once the
+        probe got an answer and 'unreachable' until then
+        """
+        if not database_url():
+            return 'not_configured'
+        return 'available' if self.available else 'unreachable'
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                if check_connection():
+                    get_db(self.app)
+                    self.available = True
+                    logging.info("Database connection successful")
+                    return
+            except Exception as e:
+                logging.warning(f"Database unreachable: {e}")
+            self._stopping.wait(self.interval)
+
+
+def register_commands(app):
+    @app.cli.command('init-db')
+    def init_db():
+        """Create the database tables."""
+        db = get_db(app)
+        import models_db  # noqa: F401  registers the tables on db.metadata
+        with app.app_context():
+            db.create_all()
+        print("Database tables created")
@@ -0,0 +1,163 @@
+import datetime
+import functools
+import heapq
+import logging
+import threading
+import time
+
+from app import repository
+
+# Longest sleep between checks, so wall clock adjustments are picked up
+MAX_SLEEP_SECONDS = 60
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_valid_until(valid_until):
+    """
+    Timestamp at which an offer valid until the given YYYY-MM-DD date
+    lapses: the end of that day in server local time.
+    Returns None for empty or malformed dates (the offer never expires)
+    """
+    try:
+        day = datetime.date.fromisoformat(str(valid_until).strip())
+    except ValueError:
+        return None
+    return datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time.min).timestamp()
+
+
+def offer_is_live(offer, now=None):
+    """
+    Whether an offer is active and its valid_until date has not lapsed,
+    for readers that may see an offer before the scheduler deactivates it
+    """
+    if not offer.is_active:
+        return False
+    expires_at = parse_valid_until(offer.valid_until)
+    return expires_at is None or expires_at > (time.time() if now is None else now)
+
+
+class ExpiryScheduler:
+    """
+    Deactivates offers when their valid_until date lapses.
+    Active offers are kept in a min-heap ordered by expiry time; a
+    background thread sleeps until the earliest one is due. Rescheduled or
+    deactivated offers leave stale heap entries behind, skipped when popped
+    because they no longer match the offer's current expiry.
+    """
+
+    def __init__(self, repository, clock=time.time):
+        self.repository = repository
+        self.clock = clock
+        self._heap = []
+        self._expiry = {}
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        repository.add_change_listener(self._on_change)
+
+    def _on_change(self, changes):
+        offer_ids = [item_id for kind, item_id in changes if kind == 'offer']
+        with self._condition:
+            if not changes:
+                self._reschedule_all()
+            for offer_id in offer_ids:
+                self._schedule(self.repository.get_offer(offer_id), offer_id)
+            if offer_ids or not changes:
+                # The earliest expiry may have moved, let the thread re-check
+                self._condition.notify()
+
+    def _schedule(self, offer, offer_id):
+        expires_at = parse_valid_until(offer.valid_until) if offer and offer.is_active else None
+        if expires_at is None:
+            self._expiry.pop(offer_id, None)
+        elif self._expiry.get(offer_id) != expires_at:
+            self._expiry[offer_id] = expires_at
+            heapq.heappush(self._heap, (expires_at, offer_id))
+            # Rebuild once stale entries outnumber the live ones
+            if len(self._heap) > 2 * len(self._expiry) + 1024:
+                self._heap = [(at, item_id) for item_id, at in self._expiry.items()]
+                heapq.heapify(self._heap)
+
+    def _reschedule_all(self):
+        self._expiry = {}
+        for offer in self.repository.active_offers():
+            expires_at = parse_valid_until(offer.valid_until)
+            if expires_at is not None:
+                self._expiry[offer.id] = expires_at
+        self._heap = [(expires_at, offer_id) for offer_id, expires_at in self._expiry.items()]
+        heapq.heapify(self._heap)
+
+    def next_expiry(self):
+        """
+        Timestamp of the earliest scheduled expiry, or None
+        """
+        with self._condition:
+            self._drop_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def _drop_stale(self):
+        heap = self._heap
+        while heap and self._expiry.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def expire_due(self, now=None):
+        """
+        Deactivate every offer whose expiry has passed.
+        Returns the number of offers deactivated
+        """
+        now = self.clock() if now is None else now
+        due = []
+        with self._condition:
+            heap = self._heap
+            while heap and heap[0][0] <= now:
+                expires_at, offer_id = heapq.heappop(heap)
+                if self._expiry.get(offer_id) == expires_at:
+                    del self._expiry[offer_id]
+                    due.append(offer_id)
+
+        # Deactivate outside the lock: the write calls back into _on_change
+        expired = 0
+        for offer_id in due:
+            offer = self.repository.get_offer(offer_id)
+            # Skip offers extended since their entry was popped
+            expires_at = parse_valid_until(offer.valid_until) if offer else None
+            if offer and offer.is_active and expires_at is not None and expires_at <= now:
+                offer.update(is_active=False)
+                expired += 1
+        return expired
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='offer-expiry', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._stopping:
+                    return
+                self._drop_stale()
+                delay = self._heap[0][0] - self.clock() if self._heap else MAX_SLEEP_SECONDS
+                if delay > 0:
+                    self._condition.wait(min(delay, MAX_SLEEP_SECONDS))
+                    continue
+            try:
+                expired = self.expire_due()
+                if expired:
+                    logging.info(f"Expired {expired} offers")
+            except Exception as e:
+                logging.error(f"Error expiring offers: {e}")
+
+
+expiry_scheduler = ExpiryScheduler(repository)
@@ -1,5 +1,16 @@
+import heapq
 import math
+import time
+import numpy as np
 from models import Business, Offer
+from app import (repository, business_index, business_coordinates, shared_snapshot, snapshot_publisher,
+                 offer_text_index)
+from expiry import offer_is_live
+from spatial_index import EARTH_RADIUS_METERS
+from metrics import NEARBY_PHASES, nearby_candidates, nearby_matches
+
+# Upper bound on distance matrix entries computed in one batch step
+MAX_DISTANCE_MATRIX_CELLS = 4000000
 
 def haversine_distance(lat1, lon1, lat2, lon2):
     """
@@ -21,32 +32,287 @@ def haversine_distance(lat1, lon1, lat2, lon2):
     
     return c * r
 
+def initial_bearing(lat1, lon1, lat2, lon2):
+    """
+    Compass bearing in degrees (0 = north, clockwise) of the great circle
+    from the first point to the second
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+    dlon = lon2 - lon1
+    x = math.sin(dlon) * math.cos(lat2)
+    y = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(dlon)
+    return math.degrees(math.atan2(x, y)) % 360
+
+def destination_point(lat, lon, bearing, distance_meters):
+    """
+    Point reached by travelling distance_meters from (lat, lon) along the
+    given compass bearing in degrees
+    Returns (lat, lon) in decimal degrees
+    """
+    lat, lon, bearing = map(math.radians, [lat, lon, bearing])
+    angular = distance_meters / EARTH_RADIUS_METERS
+    lat2 = math.asin(math.sin(lat) * math.cos(angular) + math.cos(lat) * math.sin(angular) * math.cos(bearing))
+    lon2 = lon + math.atan2(math.sin(bearing) * math.sin(angular) * math.cos(lat),
+                            math.cos(angular) - math.sin(lat) * math.sin(lat2))
+    return math.degrees(lat2), (math.degrees(lon2) + 540) % 360 - 180
+
+def haversine_distances(lats, lngs, lat_rad, lng_rad, cos_lat):
+    """
+    Batch haversine from M points (decimal degrees) to N points given as
+    precomputed radians and cos(latitude) arrays.
+    Scalar lats/lngs return a length N array, sequences an M x N matrix.
+    Returns distances in meters
+    """
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    lngs = np.radians(np.asarray(lngs, dtype=np.float64))
+    if lats.ndim:
+        lats, lngs = lats[:, np.newaxis], lngs[:, np.newaxis]
+
+    a = np.sin((lat_rad - lats) / 2) ** 2 + np.cos(lats) * cos_lat * np.sin((lng_rad - lngs) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def business_distances(user_lat, user_lng, business_ids=None):
+    """
+    Distances from one user point to many businesses in a single pass.
+    business_ids defaults to every business with a location.
+    Returns (business ids, distances) with the ids in array order
+    """
+    if business_ids is None:
+        slots = None
+        ids = business_coordinates.ids[:len(business_coordinates)]
+    else:
+        slots = business_coordinates.slots_for(business_ids)
+        ids = [business_coordinates.ids[slot] for slot in slots]
+
+    distances = haversine_distances(user_lat, user_lng, *business_coordinates.columns(slots))
+    return ids, distances
+
+def get_nearby_businesses(user_lat, user_lng, radius_meters=1000):
+    """
+    Businesses within the radius of the user's location, closest first
+    Returns list of tuples: (business_id, distance)
+    """
+    start = time.perf_counter()
+    candidates = business_index.query_radius(user_lat, user_lng, radius_meters)
+    fetched = time.perf_counter()
+    NEARBY_PHASES['candidates'].observe(fetched - start)
+    nearby_candidates.inc(len(candidates))
+    if not candidates:
+        return []
+
+    ids, distances = business_distances(user_lat, user_lng, candidates)
+    inside = np.flatnonzero(distances <= radius_meters)
+    measured = time.perf_counter()
+    NEARBY_PHASES['distances'].observe(measured - fetched)
+    nearby_matches.inc(len(inside))
+
+    inside = inside[np.argsort(distances[inside], kind='stable')]
+    nearby = [(ids[i], float(distances[i])) for i in inside]
+    NEARBY_PHASES['sort'].observe(time.perf_counter() - measured)
+    return nearby
+
 def get_nearby_offers(user_lat, user_lng, radius_meters=1000):
     """
     Get all active offers within the specified radius of the user's location
     Returns list of tuples: (offer, business, distance)
     """
+    if shared_snapshot is not None:
+        snapshot = shared_snapshot.current()
+        if snapshot is not None:
+            return get_nearby_offers_from_snapshot(snapshot, user_lat, user_lng, radius_meters)
+
+    if repository.backend.spatial_queries:
+        return get_nearby_offers_from_backend(user_lat, user_lng, radius_meters)
+
+    nearby_businesses = get_nearby_businesses(user_lat, user_lng, radius_meters)
+    if not nearby_businesses:
+        return []
+
+    with NEARBY_PHASES['offers'].time():
+        return _attach_offers([nearby_businesses])[0]
+
+def search_nearby_offers(terms, user_lat, user_lng, radius_meters=1000):
+    """
+    Active offers within the radius whose title or description contains the
+    search terms (see search.query_terms), closest first. The text matches and the spatial candidates
+    are intersected from the smaller side: a rare term measures only the
+    businesses of its offers, a common one only the businesses in range
+    Returns list of tuples: (offer, business, distance)
+    """
+    matches = offer_text_index.match(terms)
+    if not matches:
+        return []
+    candidates = business_index.query_radius(user_lat, user_lng, radius_meters)
+    if not candidates:
+        return []
+
+    if len(matches) < len(candidates):
+        business_ids = set()
+        for offer_id in matches:
+            offer = repository.get_offer(offer_id)
+            if offer is not None:
+                business_ids.add(offer.business_id)
+        candidates = business_ids
+
+    ids, distances = business_distances(user_lat, user_lng, candidates)
+    inside = np.flatnonzero(distances <= radius_meters)
+    inside = inside[np.argsort(distances[inside], kind='stable')]
+
+    nearby_offers = []
+    for i in inside:
+        business_offers = [offer for offer in repository.active_business_offers(ids[i]) if offer.id in matches]
+        if business_offers:
+            business = Business.get(ids[i])
+            if business:
+                distance = float(distances[i])
+                nearby_offers.extend((offer, business, distance) for offer in business_offers)
+    return nearby_offers
+
+def get_nearby_offers_from_backend(user_lat, user_lng, radius_meters=1000):
+    """
+    get_nearby_offers with the bounding box filter run by the storage
+    backend, so only the rows inside the box are read. Loaded records are
+    reused; rows written by other processes are built from the database
+    Returns list of tuples: (offer, business, distance)
+    """
+    start = time.perf_counter()
+    rows = repository.backend.nearby_offer_rows(user_lat, user_lng, radius_meters)
+    fetched = time.perf_counter()
+    NEARBY_PHASES['candidates'].observe(fetched - start)
+    nearby_candidates.inc(len(rows))
+    if not rows:
+        return []
+
+    lats = np.radians(np.fromiter((business_row[6] for business_row, _ in rows), dtype=np.float64, count=len(rows)))
+    lngs = np.radians(np.fromiter((business_row[7] for business_row, _ in rows), dtype=np.float64, count=len(rows)))
+    distances = haversine_distances(user_lat, user_lng, lats, lngs, np.cos(lats))
+    inside = np.flatnonzero(distances <= radius_meters)
+    measured = time.perf_counter()
+    NEARBY_PHASES['distances'].observe(measured - fetched)
+    nearby_matches.inc(len(inside))
+
+    inside = inside[np.argsort(distances[inside], kind='stable')]
+    sorted_at = time.perf_counter()
+    NEARBY_PHASES['sort'].observe(sorted_at - measured)
+
     nearby_offers = []
-    
-    # Get all active offers
-    active_offers = Offer.get_all_active()
-    
-    for offer in active_offers:
-        business = offer.get_business()
-        if business and business.latitude != 0 and business.longitude != 0:
-            distance = haversine_distance(user_lat, user_lng, business.latitude, business.longitude)
-            
-            if distance <= radius_meters:
-                nearby_offers.append((offer, business, distance))
-    
-    # Sort by distance (closest first)
-    nearby_offers.sort(key=lambda x: x[2])
-    
+    for i in inside:
+        business_row, offer_row = rows[i]
+        business = Business.get(business_row[0]) or Business(*business_row)
+        offer = Offer.get(offer_row[0]) or Offer(*offer_row)
+        nearby_offers.append((offer, business, float(distances[i])))
+    NEARBY_PHASES['offers'].observe(time.perf_counter() - sorted_at)
+    return nearby_offers
+
+def get_nearby_offers_from_snapshot(snapshot, user_lat, user_lng, radius_meters=1000):
+    """
+    get_nearby_offers over the shared memory-mapped snapshot, so every
+    worker answers from the same published generation. Businesses this
+    process wrote since its last publish are answered from the live records
+    instead, and every offer is checked against its live state (deactivated
+    or expired since the generation was built). Records this process has
+    not loaded (written by another worker) are read from the backend
+    Returns list of tuples: (offer, business, distance)
+    """
+    pending = snapshot_publisher.pending_businesses() if snapshot_publisher is not None else set()
+    start = time.perf_counter()
+    nearby = [hit for hit in snapshot.nearby(user_lat, user_lng, radius_meters) if hit[0] not in pending]
+    if pending:
+        nearby = _merge_by_distance(nearby, _pending_nearby(pending, user_lat, user_lng, radius_meters))
+    measured = time.perf_counter()
+    NEARBY_PHASES['distances'].observe(measured - start)
+    nearby_matches.inc(len(nearby))
+    if not nearby:
+        return []
+
+    businesses = {business_id: Business.get(business_id) for business_id, _, _ in nearby}
+    offers = {offer_id: Offer.get(offer_id) for _, _, offer_ids in nearby for offer_id in offer_ids}
+    missing_businesses = [business_id for business_id, business in businesses.items() if business is None]
+    missing_offers = [offer_id for offer_id, offer in offers.items() if offer is None]
+    for row in repository.backend.business_rows(missing_businesses):
+        businesses[row[0]] = Business(*row)
+    for row in repository.backend.offer_rows(missing_offers):
+        offers[row[0]] = Offer(*row)
+
+    now = time.time()
+    nearby_offers = []
+    for business_id, distance, offer_ids in nearby:
+        business = businesses[business_id]
+        if business:
+            nearby_offers.extend((offers[offer_id], business, distance) for offer_id in offer_ids
+                                 if offers[offer_id] and offer_is_live(offers[offer_id], now))
+    NEARBY_PHASES['offers'].observe(time.perf_counter() - measured)
     return nearby_offers
 
-def is_user_near_business(user_lat, user_lng, business_lat, business_lng, radius_meters=100):
+def _pending_nearby(business_ids, user_lat, user_lng, radius_meters):
+    """
+    snapshot.nearby over the live records of the given businesses
+    Returns (business id, distance, active offer ids) tuples, closest first
+    """
+    located = [business_id for business_id in business_ids
+               if business_id in business_coordinates and repository.active_offer_count(business_id)]
+    if not located:
+        return []
+    ids, distances = business_distances(user_lat, user_lng, located)
+    inside = np.flatnonzero(distances <= radius_meters)
+    inside = inside[np.argsort(distances[inside], kind='stable')]
+    return [(ids[i], float(distances[i]), [offer.id for offer in repository.active_business_offers(ids[i])])
+            for i in inside]
+
+def _merge_by_distance(first, second):
+    return list(heapq.merge(first, second, key=lambda hit: hit[1]))
+
+def get_nearby_offers_batch(points):
+    """
+    Nearby offers for many user positions at once.
+    points is a sequence of (lat, lng, radius_meters). The candidate cells of
+    every point are merged, distances are computed as one M x N matrix over
+    that shared candidate set and active offers are joined in a single pass.
+    Returns one list of (offer, business, distance) tuples per point
+    """
+    candidate_ids = set()
+    for lat, lng, radius in points:
+        candidate_ids.update(business_index.query_radius(lat, lng, radius))
+    if not candidate_ids:
+        return [[] for _ in points]
+
+    slots = business_coordinates.slots_for(candidate_ids)
+    ids = [business_coordinates.ids[slot] for slot in slots]
+    columns = business_coordinates.columns(slots)
+    lats = np.array([point[0] for point in points], dtype=np.float64)
+    lngs = np.array([point[1] for point in points], dtype=np.float64)
+    radii = np.array([point[2] for point in points], dtype=np.float64)
+
+    # Bound the matrix size when the batch spans many cells
+    rows_per_chunk = max(1, MAX_DISTANCE_MATRIX_CELLS // len(ids))
+    nearby_businesses = []
+    for start in range(0, len(points), rows_per_chunk):
+        end = start + rows_per_chunk
+        distances = haversine_distances(lats[start:end], lngs[start:end], *columns)
+        within = distances <= radii[start:end, np.newaxis]
+        for row, row_distances in enumerate(distances):
+            inside = np.flatnonzero(within[row])
+            inside = inside[np.argsort(row_distances[inside], kind='stable')]
+            nearby_businesses.append([(ids[i], float(row_distances[i])) for i in inside])
+
+    return _attach_offers(nearby_businesses)
+
+def _attach_offers(nearby_businesses):
     """
-    Check if user is within the specified radius of a business
+    Expand lists of (business_id, distance) into lists of
+    (offer, business, distance), looking up each business's active offers once
     """
-    distance = haversine_distance(user_lat, user_lng, business_lat, business_lng)
-    return distance <= radius_meters
+    wanted = {business_id for hits in nearby_businesses for business_id, _ in hits}
+    offers_by_business = {business_id: repository.active_business_offers(business_id) for business_id in wanted}
+
+    results = []
+    for hits in nearby_businesses:
+        nearby_offers = []
+        for business_id, distance in hits:
+            business_offers = offers_by_business.get(business_id)
+            if business_offers:
+                business = Business.get(business_id)
+                if business:
+                    nearby_offers.extend((offer, business, distance) for offer in business_offers)
+        results.append(nearby_offers)
+    return results
@@ -0,0 +1,215 @@
+import json
+import logging
+import math
+import os
+import queue
+import secrets
+import threading
+import time
+
+import numpy as np
+
+from models import Business
+from geofence import business_distances
+from app import business_index, repository
+
+# Default geofence radius
+GEOFENCE_RADIUS_METERS = 100
+# Extra distance before an entered geofence counts as exited, so GPS jitter
+# around the boundary does not produce enter/exit storms
+GEOFENCE_EXIT_MARGIN_METERS = 30
+# Sessions without a position update or open stream for this long are dropped
+SESSION_IDLE_SECONDS = 15 * 60
+# Seconds between keep-alive comments on idle geofence streams
+GEOFENCE_HEARTBEAT_SECONDS = 15
+# Streams the Flask app serves at once per process. Each holds a worker
+# thread for as long as it is open, so the cap stays below the gunicorn
+# --threads count; further clients get a 503 and poll instead
+GEOFENCE_SYNC_STREAMS = int(os.environ.get('GEOFENCE_SYNC_STREAMS', 4))
+# With a shared storage backend, how often a process picks up the positions
+# posted through other processes for its streams, and how often it tells
+# them its streams are still open
+GEOFENCE_RELAY_SECONDS = float(os.environ.get('GEOFENCE_RELAY_SECONDS', 0.25))
+GEOFENCE_SESSION_TOUCH_SECONDS = 10
+# Positions are not relayed to a session untouched for longer (its process
+# is gone); the client gets a 404 and opens a new stream
+GEOFENCE_SESSION_MAX_AGE = 3 * GEOFENCE_SESSION_TOUCH_SECONDS
+
+
+def sse_message(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def parse_geofence_radius(args):
+    """
+    Geofence radius from query args, clamped to 10m-1km
+    """
+    try:
+        radius = float(args.get('radius', GEOFENCE_RADIUS_METERS))
+    except (TypeError, ValueError):
+        radius = GEOFENCE_RADIUS_METERS
+    if math.isnan(radius):
+        radius = GEOFENCE_RADIUS_METERS
+    return min(max(radius, 10), 1000)
+
+
+class GeofenceSession:
+    """
+    Per-client geofence state: the businesses the user is currently inside
+    and a queue of pending enter/exit events for the client's stream
+    """
+
+    def __init__(self, session_id, radius_meters=GEOFENCE_RADIUS_METERS,
+                 exit_margin_meters=GEOFENCE_EXIT_MARGIN_METERS):
+        self.id = session_id
+        self.radius_meters = radius_meters
+        self.exit_radius_meters = radius_meters + exit_margin_meters
+        self.inside = {}
+        self.events = queue.SimpleQueue()
+        # Optional callable receiving events instead of the queue, used by
+        # async streams that must not park a thread on events.get()
+        self.subscriber = None
+        self.last_seen = time.monotonic()
+        self._lock = threading.Lock()
+
+    def update_position(self, lat, lng):
+        """
+        Move the user and queue an event for every geofence transition.
+        Returns the list of queued events
+        """
+        self.last_seen = time.monotonic()
+        candidates = business_index.query_radius(lat, lng, self.exit_radius_meters)
+        ids, distances = business_distances(lat, lng, candidates) if candidates else ([], np.empty(0))
+        distance_by_id = {ids[i]: float(distances[i]) for i in np.flatnonzero(distances <= self.exit_radius_meters)}
+
+        with self._lock:
+            now_inside = {}
+            for business_id, distance in distance_by_id.items():
+                # Enter at the geofence radius, leave only past the exit radius
+                if distance <= self.radius_meters or business_id in self.inside:
+                    now_inside[business_id] = distance
+
+            events = []
+            for business_id in self.inside.keys() - now_inside.keys():
+                events.append({'type': 'exit', 'business_id': business_id})
+            for business_id in now_inside.keys() - self.inside.keys():
+                event = self._enter_event(business_id, now_inside[business_id])
+                if event:
+                    events.append(event)
+                else:
+                    del now_inside[business_id]
+            self.inside = now_inside
+
+        for event in events:
+            self.publish(event)
+        return events
+
+    def publish(self, event):
+        subscriber = self.subscriber
+        if subscriber is not None:
+            subscriber(event)
+        else:
+            self.events.put(event)
+
+    def _enter_event(self, business_id, distance):
+        business = Business.get(business_id)
+        if not business:
+            return None
+        return {
+            'type': 'enter',
+            'business_id': business.id,
+            'business_name': business.name,
+            'business_lat': business.latitude,
+            'business_lng': business.longitude,
+            'distance': round(distance, 2),
+            'offers': [
+                {
+                    'id': offer.id,
+                    'title': offer.title,
+                    'discount_percentage': offer.discount_percentage
+                }
+                for offer in business.get_active_offers()
+            ]
+        }
+
+
+class GeofenceSessionManager:
+    """
+    Registry of the live geofence sessions of this worker process.
+    Sessions are also recorded in the storage backend: when it is shared, a
+    position posted to another worker is relayed through it and applied
+    here by a polling thread, so a stream and its position updates may land
+    on different workers
+    """
+
+    def __init__(self, backend, idle_seconds=SESSION_IDLE_SECONDS):
+        self.backend = backend
+        self.idle_seconds = idle_seconds
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._relay_thread = None
+
+    def create(self, radius_meters=GEOFENCE_RADIUS_METERS):
+        self.expire_idle()
+        session = GeofenceSession(secrets.token_urlsafe(16), radius_meters)
+        with self._lock:
+            self._sessions[session.id] = session
+        self.backend.touch_geofence_sessions([session.id])
+        return session
+
+    def get(self, session_id):
+        return self._sessions.get(session_id)
+
+    def remove(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        self.backend.drop_geofence_session(session_id)
+
+    def relay(self, session_id, lat, lng):
+        """
+        Hand a position for a session this process does not serve to the one
+        that does. Returns False when no process serves it
+        """
+        return self.backend.relay_geofence_position(session_id, lat, lng, GEOFENCE_SESSION_MAX_AGE)
+
+    def expire_idle(self):
+        cutoff = time.monotonic() - self.idle_seconds
+        with self._lock:
+            for session_id in [s.id for s in self._sessions.values() if s.last_seen < cutoff]:
+                del self._sessions[session_id]
+
+    def start_relay(self, interval=GEOFENCE_RELAY_SECONDS):
+        """
+        Poll the positions relayed to this process's sessions on a background
+        thread; only needed with a backend other processes share
+        """
+        if self._relay_thread is not None or not self.backend.shared:
+            return
+        self._relay_thread = threading.Thread(target=self._relay, args=(interval,), name='geofence-relay',
+                                              daemon=True)
+        self._relay_thread.start()
+
+    def _relay(self, interval):
+        position_id = 0
+        touched = time.monotonic()
+        while True:
+            time.sleep(interval)
+            try:
+                position_id, positions = self.backend.geofence_positions_since(position_id)
+                for session_id, lat, lng in positions:
+                    session = self.get(session_id)
+                    if session is not None:
+                        session.update_position(lat, lng)
+                if time.monotonic() - touched >= GEOFENCE_SESSION_TOUCH_SECONDS:
+                    touched = time.monotonic()
+                    session_ids = list(self._sessions)
+                    if session_ids:
+                        self.backend.touch_geofence_sessions(session_ids)
+            except Exception as e:
+                logging.error(f"Error relaying geofence positions: {e}")
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+geofence_sessions = GeofenceSessionManager(repository.backend)
@@ -0,0 +1,296 @@
+"""
+In-process metrics in the Prometheus text format, without external
+dependencies. Counters and histograms are updated on the hot paths; callback
+metrics are read only when /metrics is scraped.
+"""
+import bisect
+import collections
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from 50us to 10s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in labels)
+    return '{' + pairs + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    A named metric family; `labels(**values)` returns the child for one
+    label combination, cached so hot paths can keep a reference to it
+    """
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, **values):
+        key = tuple(str(values[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        """
+        Yields (suffix, labels, value) for every child
+        """
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class _CounterChild:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1, **labels):
+        self.labels(**labels).inc(amount)
+
+    def samples(self):
+        for key, child in list(self._children.items()):
+            yield '_total', list(zip(self.labelnames, key)), child.value
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value, **labels):
+        self.labels(**labels).observe(value)
+
+    def samples(self):
+        for key, child in list(self._children.items()):
+            labels = list(zip(self.labelnames, key))
+            with child._lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield '_bucket', labels + [('le', _format_value(float(bound)))], cumulative
+            yield '_sum', labels, total
+            yield '_count', labels, count
+
+
+class CallbackMetric(Metric):
+    """
+    A gauge or counter whose samples are read from `callback` at scrape
+    time; the callback returns a list of (labels dict, value)
+    """
+
+    def __init__(self, name, help, callback, type='gauge'):
+        super().__init__(name, help)
+        self.type = type
+        self.callback = callback
+
+    def samples(self):
+        suffix = '_total' if self.type == 'counter' else ''
+        for labels, value in self.callback():
+            yield suffix, sorted(labels.items()), value
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Duplicate metric: {metric.name}")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def callback(self, name, help, callback, type='gauge'):
+        return self.register(CallbackMetric(name, help, callback, type))
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in list(self._metrics.values())) + '\n'
+
+
+registry = MetricsRegistry()
+
+# Request latency per route, recorded by the Flask hooks and asgi.py
+request_duration = registry.histogram(
+    'http_request_duration_seconds', 'Request latency by route', ('route', 'method', 'status'))
+
+# Phases of a nearby query: candidate fetch, distance computation, sort,
+# offer lookup and JSON serialization
+nearby_phase_duration = registry.histogram(
+    'nearby_query_phase_duration_seconds', 'Time spent in each phase of a nearby query', ('phase',))
+NEARBY_PHASES = {phase: nearby_phase_duration.labels(phase=phase)
+                 for phase in ('candidates', 'distances', 'sort', 'offers', 'serialize')}
+
+nearby_candidates = registry.counter(
+    'nearby_query_candidates', 'Businesses returned by the coarse spatial filter').labels()
+nearby_matches = registry.counter(
+    'nearby_query_matches', 'Businesses within the search radius after the exact distance check').labels()
+
+
+def register_cache(name, cache):
+    """
+    Expose hit/miss counters and the hit ratio of a cache with `hits` and
+    `misses` attributes
+    """
+    def requests():
+        return [({'cache': name, 'result': 'hit'}, cache.hits),
+                ({'cache': name, 'result': 'miss'}, cache.misses)]
+
+    def hit_ratio():
+        total = cache.hits + cache.misses
+        return [({'cache': name}, cache.hits / total if total else 0.0)]
+
+    registry.callback(f'cache_{name}_requests', f'Lookups in the {name} cache by result', requests, 'counter')
+    registry.callback(f'cache_{name}_hit_ratio', f'Share of {name} cache lookups that hit', hit_ratio)
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler: a background thread records the stack of every
+    other thread each `interval` seconds. Stacks are aggregated in the
+    collapsed format ("frame;frame;frame count") read by flame graph tools.
+    Costs nothing while stopped.
+    """
+
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = collections.Counter()
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        with self._lock:
+            if self.running:
+                return False
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}')
+                    frame = frame.f_back
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def profile(self, seconds):
+        """
+        Sample for `seconds` and return the collapsed stacks, most frequent
+        first. Returns None when a profile is already running
+        """
+        if not self.start():
+            return None
+        try:
+            self._stop.wait(seconds)
+        finally:
+            self.stop()
+        samples, self.samples = self.samples, collections.Counter()
+        return '\n'.join(f'{stack} {count}' for stack, count in samples.most_common()) + '\n'
+
+
+# On demand profiles through /debug/profile, enabled with PROFILING_ENABLED=1
+profiler = SamplingProfiler(float(os.environ.get('PROFILER_SAMPLE_INTERVAL', 0.005)))
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED') == '1'
+MAX_PROFILE_SECONDS = 60
@@ -1,8 +1,31 @@
+import logging
+import secrets
+import threading
+import time
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
-from app import businesses, offers
+from app import repository, owns_location, local_shard_map
+from sharding import load_owned_rows
+from auth import password_hasher
+
+# Interest categories from the preferences spec, with their display names
+OFFER_CATEGORIES = {
+    'FOOD_COFFEE': 'Comida & Café',
+    'FASHION_APPAREL': 'Moda',
+    'TECH_ELECTRONICS': 'Tecnología',
+    'HEALTH_BEAUTY': 'Belleza',
+    'GROCERY': 'Supermercado',
+    'HOME_DECOR': 'Hogar',
+    'ENTERTAINMENT': 'Entretenimiento',
+    'SERVICES': 'Servicios',
+    'SPORTS_FITNESS': 'Deportes',
+    'BOOKS_STATIONERY': 'Libros',
+    'OTHER': 'Otros',
+}
+DEFAULT_CATEGORY = 'OTHER'
 
 class Business(UserMixin):
+    __slots__ = ('id', 'email', 'name', 'password_hash', 'phone', 'address', 'latitude', 'longitude')
+    
     def __init__(self, id, email, name, password_hash, phone='', address='', latitude=0.0, longitude=0.0):
         self.id = str(id)
         self.email = email
@@ -14,61 +37,62 @@ class Business(UserMixin):
         self.longitude = float(longitude)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        matches, new_hash = password_hasher.verify(self.password_hash, password)
+        if new_hash is not None:
+            # Hashed under outdated parameters, store it with the current ones
+            self.password_hash = new_hash
+            repository.business_updated(self)
+        return matches
+    
+    def has_location(self):
+        return self.latitude != 0 and self.longitude != 0
     
     @staticmethod
     def create(email, name, password, phone='', address='', latitude=0.0, longitude=0.0):
-        from app import business_counter, businesses, database_available
-        
-        if database_available:
-            try:
-                from app import db
-                from models_db import DBBusiness
-                password_hash = generate_password_hash(password)
-                business = DBBusiness(
-                    email=email,
-                    name=name,
-                    password_hash=password_hash,
-                    phone=phone,
-                    address=address,
-                    latitude=float(latitude),
-                    longitude=float(longitude)
-                )
-                db.session.add(business)
-                db.session.commit()
-                return business
-            except Exception as e:
-                pass  # Fall back to in-memory
-        
-        # In-memory storage
-        global business_counter
-        business_counter += 1
-        
-        password_hash = generate_password_hash(password)
-        business = Business(business_counter, email, name, password_hash, phone, address, latitude, longitude)
-        businesses[str(business_counter)] = business
+        # Stored in the repository, which writes it through to the backend
+        password_hash = password_hasher.hash(password)
+        business = Business(repository.next_business_id(), email, name, password_hash, phone, address, latitude, longitude)
+        repository.add_business(business)
         return business
     
     @staticmethod
     def get(business_id):
-        return businesses.get(str(business_id))
+        return repository.get_business(business_id)
     
     @staticmethod
     def get_by_email(email):
-        for business in businesses.values():
-            if business.email == email:
-                return business
-        return None
+        return repository.get_business_by_email(email)
+    
+    @staticmethod
+    def get_all_with_location():
+        return repository.businesses_with_location()
+    
+    def update(self, name=None, phone=None, address=None, latitude=None, longitude=None):
+        if name is not None:
+            self.name = name
+        if phone is not None:
+            self.phone = phone
+        if address is not None:
+            self.address = address
+        if latitude is not None:
+            self.latitude = float(latitude)
+        if longitude is not None:
+            self.longitude = float(longitude)
+        repository.business_updated(self)
     
     def get_offers(self):
-        business_offers = []
-        for offer in offers.values():
-            if offer.business_id == self.id:
-                business_offers.append(offer)
-        return business_offers
+        return repository.business_offers(self.id)
+    
+    def get_active_offers(self):
+        return repository.active_business_offers(self.id)
+    
+    def count_active_offers(self):
+        return repository.active_offer_count(self.id)
 
 class Offer:
-    def __init__(self, id, business_id, title, description, discount_percentage, valid_until, is_active=True):
+    __slots__ = ('id', 'business_id', 'title', 'description', 'discount_percentage', 'valid_until', 'is_active', 'category')
+    
+    def __init__(self, id, business_id, title, description, discount_percentage, valid_until, is_active=True, category=DEFAULT_CATEGORY):
         self.id = str(id)
         self.business_id = str(business_id)
         self.title = title
@@ -76,53 +100,27 @@ class Offer:
         self.discount_percentage = int(discount_percentage)
         self.valid_until = valid_until
         self.is_active = is_active
+        self.category = category
     
     @staticmethod
-    def create(business_id, title, description, discount_percentage, valid_until):
-        from app import offer_counter, offers, database_available
-        
-        if database_available:
-            try:
-                from app import db
-                from models_db import DBOffer
-                offer = DBOffer(
-                    business_id=business_id,
-                    title=title,
-                    description=description,
-                    discount_percentage=int(discount_percentage),
-                    valid_until=valid_until,
-                    is_active=True
-                )
-                db.session.add(offer)
-                db.session.commit()
-                return offer
-            except Exception as e:
-                pass  # Fall back to in-memory
-        
-        # In-memory storage
-        global offer_counter
-        offer_counter += 1
-        
-        offer = Offer(offer_counter, business_id, title, description, discount_percentage, valid_until)
-        offers[str(offer_counter)] = offer
+    def create(business_id, title, description, discount_percentage, valid_until, category=DEFAULT_CATEGORY):
+        # Stored in the repository, which writes it through to the backend
+        offer = Offer(repository.next_offer_id(), business_id, title, description, discount_percentage, valid_until, category=category)
+        repository.add_offer(offer)
         return offer
     
     @staticmethod
     def get(offer_id):
-        return offers.get(str(offer_id))
+        return repository.get_offer(offer_id)
     
     @staticmethod
     def get_all_active():
-        active_offers = []
-        for offer in offers.values():
-            if offer.is_active:
-                active_offers.append(offer)
-        return active_offers
+        return repository.active_offers()
     
     def get_business(self):
         return Business.get(self.business_id)
     
-    def update(self, title=None, description=None, discount_percentage=None, valid_until=None, is_active=None):
+    def update(self, title=None, description=None, discount_percentage=None, valid_until=None, is_active=None, category=None):
         if title is not None:
             self.title = title
         if description is not None:
@@ -133,7 +131,118 @@ class Offer:
             self.valid_until = valid_until
         if is_active is not None:
             self.is_active = is_active
+        if category is not None:
+            self.category = category
+        repository.offer_updated(self)
     
     def delete(self):
-        if self.id in offers:
-            del offers[self.id]
+        repository.remove_offer(self)
+
+
+class PreferenceProfile:
+    """
+    Offer preferences of a map user, as collected by the onboarding flow:
+    interest categories, minimum discount and preferred distance
+    """
+    __slots__ = ('id', 'interests', 'min_discount', 'max_distance', 'favorite_businesses', 'excluded_businesses')
+    
+    def __init__(self, id, interests=(), min_discount=5, max_distance=1000, favorite_businesses=(), excluded_businesses=()):
+        self.id = str(id)
+        self.interests = frozenset(interests)
+        self.min_discount = int(min_discount)
+        self.max_distance = int(max_distance)
+        self.favorite_businesses = frozenset(str(b) for b in favorite_businesses)
+        self.excluded_businesses = frozenset(str(b) for b in excluded_businesses)
+    
+    @staticmethod
+    def save(profile_id, **preferences):
+        profile = PreferenceProfile(profile_id or secrets.token_urlsafe(12), **preferences)
+        repository.save_profile(profile)
+        return profile
+    
+    @staticmethod
+    def get(profile_id):
+        # Saved through any worker sharing the backend, read the latest
+        row = repository.backend.load_profile(str(profile_id))
+        if row is not None:
+            return PreferenceProfile(*row)
+        return repository.get_profile(profile_id)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'interests': sorted(self.interests),
+            'min_discount': self.min_discount,
+            'max_distance': self.max_distance,
+            'favorite_businesses': sorted(self.favorite_businesses),
+            'excluded_businesses': sorted(self.excluded_businesses)
+        }
+
+
+def load_repository():
+    """
+    Fill the in-memory repository from its storage backend; a shard node
+    reads only the businesses in its own cells, and their offers
+    """
+    backend = repository.backend
+    # Read first: writes landing during the load are applied again by sync
+    repository.backend_revision = backend.change_revision()
+    if local_shard_map is None:
+        business_rows, offer_rows = backend.load_businesses(), backend.load_offers()
+    else:
+        business_rows, offer_rows = load_owned_rows(local_shard_map, backend)
+    repository.load([Business(*row) for row in business_rows], [Offer(*row) for row in offer_rows])
+
+
+_sync_lock = threading.Lock()
+
+
+def sync_repository():
+    """
+    Apply the records other processes wrote to the shared backend since the
+    last load or sync. A shard node takes the businesses that registered in
+    or moved into its cells, with all their offers, and keeps the ones it
+    already holds current wherever they are
+    """
+    backend = repository.backend
+    with _sync_lock:
+        changes = backend.changes_since(repository.backend_revision)
+        if changes is None:
+            # Too far behind the change log: start over from the backend
+            repository.clear()
+            load_repository()
+            return
+        revision, changed = changes
+        if not changed:
+            return
+
+        business_ids = [record_id for kind, record_id in changed if kind == 'business']
+        offer_ids = [record_id for kind, record_id in changed if kind == 'offer']
+        businesses = [Business(*row) for row in backend.business_rows(business_ids)]
+        offer_rows = backend.offer_rows(offer_ids)
+        removed_offer_ids = set(offer_ids) - {row[0] for row in offer_rows}
+        if owns_location is not None:
+            arrived = {business.id for business in businesses if business.id not in repository.businesses
+                       and owns_location(business.latitude, business.longitude)}
+            businesses = [business for business in businesses
+                          if business.id in arrived or business.id in repository.businesses]
+            held = arrived | repository.businesses.keys()
+            offer_rows = [row for row in offer_rows if row[1] in held]
+            offer_rows.extend(row for row in backend.business_offer_rows(arrived) if row[0] not in offer_ids)
+        repository.refresh(businesses, [Offer(*row) for row in offer_rows], removed_offer_ids)
+        repository.backend_revision = revision
+
+
+def start_repository_sync(interval):
+    """
+    Sync from the backend every `interval` seconds on a background thread
+    """
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                sync_repository()
+            except Exception as e:
+                logging.error(f"Error syncing records from the storage backend: {e}")
+
+    threading.Thread(target=run, name='repository-sync', daemon=True).start()
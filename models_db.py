@@ -4,9 +4,7 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from sqlalchemy import Column, Integer, String, Float, Boolean, Text, ForeignKey
 from sqlalchemy.orm import relationship
 
-def get_db():
-    from app import db
-    return db
+from database import get_db
 
 class DBBusiness(UserMixin, get_db().Model):
     __tablename__ = 'businesses'
@@ -39,6 +37,7 @@ class DBOffer(get_db().Model):
     discount_percentage = Column(Integer, nullable=False)
     valid_until = Column(String(10), nullable=False)
     is_active = Column(Boolean, default=True)
+    category = Column(String(30), nullable=False, default='OTHER')
     
     def get_business(self):
         return self.business
\ No newline at end of file
@@ -0,0 +1,106 @@
+import heapq
+
+from models import Business, OFFER_CATEGORIES
+from app import repository
+from geofence import get_nearby_businesses
+
+# Scoring weights from the preferences spec (OfferMatchingEngine)
+INTEREST_SCORE = 2.0
+DISCOVERY_SCORE = 0.3
+MAX_DISCOUNT_SCORE = 2.0
+LOW_DISCOUNT_SCORE = 0.2
+FAVORITE_SCORE = 1.5
+EXCLUDED_SCORE = 0.1
+MAX_DISTANCE_SCORE = 2.0
+
+# Offers up to this multiple of the preferred distance are still considered
+SEARCH_DISTANCE_FACTOR = 1.5
+
+
+def category_score(category, profile):
+    return INTEREST_SCORE if category in profile.interests else DISCOVERY_SCORE
+
+
+def discount_score(discount_percentage, profile):
+    min_discount = max(profile.min_discount, 1)
+    if discount_percentage >= min_discount:
+        return min(discount_percentage / min_discount, MAX_DISCOUNT_SCORE)
+    return LOW_DISCOUNT_SCORE
+
+
+def distance_score(distance, profile):
+    max_distance = profile.max_distance
+    if distance <= max_distance * 0.3:
+        return 2.0
+    if distance <= max_distance:
+        return 1.0
+    if distance <= max_distance * 1.5:
+        return 0.5
+    return 0.1
+
+
+def personalization_score(business_id, profile):
+    if business_id in profile.excluded_businesses:
+        return EXCLUDED_SCORE
+    if business_id in profile.favorite_businesses:
+        return FAVORITE_SCORE
+    return 1.0
+
+
+def rank_nearby_offers(user_lat, user_lng, profile, limit=20, radius_meters=None):
+    """
+    Top `limit` active offers around the user for a preference profile,
+    scored as category * discount * distance * personalization.
+
+    Candidates come from the per (business, category) active offer lists of
+    the businesses in range. Categories are visited from the highest possible
+    score down and a min-heap holds the current top-k, so once the heap is
+    full whole categories, and the farther businesses within a category, are
+    skipped as soon as their best possible score cannot beat the k-th offer.
+    Returns list of tuples: (offer, business, distance, score), best first
+    """
+    if limit <= 0:
+        return []
+    if radius_meters is None:
+        radius_meters = profile.max_distance * SEARCH_DISTANCE_FACTOR
+
+    # Closest first, so distance scores only decrease along this list
+    nearby = get_nearby_businesses(user_lat, user_lng, radius_meters)
+    if not nearby:
+        return []
+
+    max_personalization = FAVORITE_SCORE if profile.favorite_businesses else 1.0
+    categories = sorted(OFFER_CATEGORIES, key=lambda c: category_score(c, profile), reverse=True)
+
+    heap = []
+    sequence = 0
+    for category in categories:
+        category_bound = category_score(category, profile) * MAX_DISCOUNT_SCORE * max_personalization
+        if len(heap) == limit and category_bound * MAX_DISTANCE_SCORE <= heap[0][0]:
+            break
+
+        for business_id, distance in nearby:
+            base = category_score(category, profile) * distance_score(distance, profile)
+            if len(heap) == limit and base * MAX_DISCOUNT_SCORE * max_personalization <= heap[0][0]:
+                break
+
+            category_offers = repository.active_category_offers(business_id, category)
+            if not category_offers:
+                continue
+
+            weight = base * personalization_score(business_id, profile)
+            for offer in category_offers:
+                score = weight * discount_score(offer.discount_percentage, profile)
+                sequence += 1
+                entry = (score, -sequence, offer, business_id, distance)
+                if len(heap) < limit:
+                    heapq.heappush(heap, entry)
+                elif score > heap[0][0]:
+                    heapq.heapreplace(heap, entry)
+
+    ranked = []
+    for score, _, offer, business_id, distance in sorted(heap, reverse=True):
+        business = Business.get(business_id)
+        if business:
+            ranked.append((offer, business, distance, score))
+    return ranked
@@ -0,0 +1,409 @@
+import bisect
+import threading
+from collections import OrderedDict
+
+from spatial_index import create_spatial_index, CoordinateArray
+from clustering import ClusterIndex
+from storage import MemoryBackend, BUSINESS_COLUMNS, OFFER_COLUMNS
+
+
+# Preference profiles kept by a repository whose backend does not persist
+# them, least recently used dropped first
+MAX_MEMORY_PROFILES = 10000
+
+
+class Repository:
+    """
+    In-memory store for businesses and offers.
+    Besides the primary dicts it keeps the secondary indexes the routes query
+    on every request (email -> business, business -> offers, active offers
+    per business and the spatial index), updated on every create, update
+    and delete so no lookup needs to scan the whole store.
+    Every write goes through to the storage backend first, and load() fills
+    the store back from it on startup.
+    """
+
+    def __init__(self, backend=None, change_log_limit=100000):
+        self.backend = backend or MemoryBackend()
+        self.businesses = {}
+        self.offers = {}
+        self.business_index = create_spatial_index()
+        self.business_coordinates = CoordinateArray()
+        # Per zoom level cluster aggregates for the map viewport
+        self.business_clusters = ClusterIndex()
+
+        self._business_by_email = {}
+        # business_id -> {offer_id: offer}, dicts keep creation order
+        self._offers_by_business = {}
+        self._active_by_business = {}
+        self._active_offers = {}
+        # (business_id, category) -> {offer_id: offer} for active offers
+        self._active_by_business_category = {}
+        self._offer_category_keys = {}
+
+        # Map user preference profiles by id, least recently used first;
+        # only used when the backend is private to this process
+        self.profiles = OrderedDict()
+
+        self._business_counter = 0
+        self._offer_counter = 0
+        self._lock = threading.RLock()
+
+        # Bumped on every write; caches use it to detect stale data
+        self.version = 0
+        self._listeners = []
+        self._change_listeners = []
+        self._write_listeners = []
+        # Backend change log revision applied to the store (shared backends)
+        self.backend_revision = 0
+
+        # Append-only (revision, kind, id) feed behind changes_since, trimmed
+        # to change_log_limit entries; older revisions need a full resync
+        self.change_log_limit = change_log_limit
+        self._change_revisions = []
+        self._change_items = []
+        self._change_log_start = 0
+
+    def add_listener(self, callback):
+        """
+        Register a callable invoked after every write to the store
+        """
+        self._listeners.append(callback)
+
+    def add_change_listener(self, callback):
+        """
+        Register a callable invoked after every write with the tuple of
+        (kind, id) records it touched; an empty tuple means any record may
+        have changed (clear, load)
+        """
+        self._change_listeners.append(callback)
+
+    def add_write_listener(self, callback):
+        """
+        Register a callable invoked after writes made through this process,
+        not after refreshes with records other processes wrote, with the
+        tuple of (kind, id) records touched like add_change_listener
+        """
+        self._write_listeners.append(callback)
+
+    def _changed(self, *changes, local=True):
+        self.version += 1
+        for change in changes:
+            self._change_revisions.append(self.version)
+            self._change_items.append(change)
+        if len(self._change_revisions) > self.change_log_limit:
+            drop = len(self._change_revisions) - self.change_log_limit // 2
+            self._change_log_start = self._change_revisions[drop - 1]
+            del self._change_revisions[:drop]
+            del self._change_items[:drop]
+        for callback in self._change_listeners:
+            callback(changes)
+        for callback in self._listeners:
+            callback()
+        if local:
+            for callback in self._write_listeners:
+                callback(changes)
+
+    def changes_since(self, revision):
+        """
+        Ids of the businesses and offers written after the given revision,
+        as {'business': set(ids), 'offer': set(ids)}.
+        Returns None when the revision is older than the retained log and the
+        caller has to resync from scratch.
+        """
+        with self._lock:
+            if revision < self._change_log_start or revision > self.version:
+                return None
+            changed = {'business': set(), 'offer': set()}
+            start = bisect.bisect_right(self._change_revisions, revision)
+            for kind, item_id in self._change_items[start:]:
+                changed[kind].add(item_id)
+            return changed
+
+    def clear(self):
+        """
+        Drop every record, in place so module-level aliases stay valid.
+        The storage backend is left untouched
+        """
+        with self._lock:
+            for business_id in list(self.business_coordinates.ids):
+                self.business_index.remove(business_id)
+                self.business_coordinates.remove(business_id)
+                self.business_clusters.remove(business_id)
+            self.businesses.clear()
+            self.offers.clear()
+            self._business_by_email.clear()
+            self._offers_by_business.clear()
+            self._active_by_business.clear()
+            self._active_offers.clear()
+            self._active_by_business_category.clear()
+            self._offer_category_keys.clear()
+            self._change_revisions.clear()
+            self._change_items.clear()
+            self._changed()
+            self._change_log_start = self.version
+
+    def load(self, businesses, offers):
+        """
+        Fill the store with records read back from the backend, without
+        writing them through again. Id counters continue after the highest
+        numeric id loaded
+        """
+        with self._lock:
+            self._store_businesses(businesses)
+            for offer in offers:
+                self._store_offer(offer)
+            self._business_counter = max([self._business_counter] + [int(i) for i in self.businesses if i.isdigit()])
+            self._offer_counter = max([self._offer_counter] + [int(i) for i in self.offers if i.isdigit()])
+            self._changed()
+
+    def refresh(self, businesses, offers, removed_offer_ids=()):
+        """
+        Apply records other processes wrote to the shared backend, without
+        writing them through again. Records already loaded are updated in
+        place, so objects held elsewhere (session users) stay current
+        """
+        with self._lock:
+            changes = []
+            for business in businesses:
+                current = self.businesses.get(business.id)
+                if current is None:
+                    self._store_businesses([business])
+                else:
+                    if self._business_by_email.get(current.email) is current:
+                        del self._business_by_email[current.email]
+                    for column in BUSINESS_COLUMNS:
+                        setattr(current, column, getattr(business, column))
+                    self._business_by_email[current.email] = current
+                    self._index_business_location(current)
+                changes.append(('business', business.id))
+            for offer in offers:
+                current = self.offers.get(offer.id)
+                if current is None:
+                    self._store_offer(offer)
+                else:
+                    for column in OFFER_COLUMNS:
+                        setattr(current, column, getattr(offer, column))
+                    self._index_offer_state(current)
+                changes.extend((('offer', offer.id), ('business', offer.business_id)))
+            for offer_id in removed_offer_ids:
+                offer = self.offers.get(offer_id)
+                if offer is not None:
+                    self._unstore_offer(offer)
+                    changes.extend((('offer', offer.id), ('business', offer.business_id)))
+            if changes:
+                self._changed(*changes, local=False)
+
+    # Businesses
+
+    def next_business_id(self):
+        return self.next_business_ids(1)[0]
+
+    def next_business_ids(self, count):
+        """
+        count ids for new businesses, from the backend when it is shared
+        with other processes
+        """
+        ids = self.backend.allocate_ids('business', count)
+        if ids is not None:
+            return ids
+        with self._lock:
+            first = self._business_counter + 1
+            self._business_counter += count
+            return [str(value) for value in range(first, self._business_counter + 1)]
+
+    def add_business(self, business):
+        self.add_businesses([business])
+
+    def add_businesses(self, businesses):
+        """
+        Add many businesses with a single backend write and version bump
+        """
+        with self._lock:
+            self.backend.insert_businesses(businesses)
+            self._store_businesses(businesses)
+            self._changed(*(('business', business.id) for business in businesses))
+
+    def _store_businesses(self, businesses):
+        located = []
+        for business in businesses:
+            self.businesses[business.id] = business
+            self._business_by_email[business.email] = business
+            if business.has_location():
+                located.append(business)
+            else:
+                self._index_business_location(business)
+
+        # One pass over the packed coordinates for the whole batch
+        for business in located:
+            self.business_index.insert(business.id, business.latitude, business.longitude)
+            self.business_clusters.insert(business.id, business.latitude, business.longitude)
+        self.business_coordinates.set_many([business.id for business in located],
+                                           [business.latitude for business in located],
+                                           [business.longitude for business in located])
+
+    def business_updated(self, business):
+        with self._lock:
+            self.backend.save_business(business)
+            self._index_business_location(business)
+            self._changed(('business', business.id))
+
+    def _index_business_location(self, business):
+        # Businesses without coordinates are never returned by geo queries
+        if business.has_location():
+            self.business_index.insert(business.id, business.latitude, business.longitude)
+            self.business_coordinates.set(business.id, business.latitude, business.longitude)
+            self.business_clusters.insert(business.id, business.latitude, business.longitude)
+        else:
+            self.business_index.remove(business.id)
+            self.business_coordinates.remove(business.id)
+            self.business_clusters.remove(business.id)
+
+    def get_business(self, business_id):
+        return self.businesses.get(str(business_id))
+
+    def get_business_by_email(self, email):
+        return self._business_by_email.get(email)
+
+    def businesses_with_location(self):
+        return [business for business in self.businesses.values() if business.has_location()]
+
+    # Offers
+
+    def next_offer_id(self):
+        return self.next_offer_ids(1)[0]
+
+    def next_offer_ids(self, count):
+        """
+        count ids for new offers, from the backend when it is shared
+        with other processes
+        """
+        ids = self.backend.allocate_ids('offer', count)
+        if ids is not None:
+            return ids
+        with self._lock:
+            first = self._offer_counter + 1
+            self._offer_counter += count
+            return [str(value) for value in range(first, self._offer_counter + 1)]
+
+    def add_offer(self, offer):
+        self.add_offers([offer])
+
+    def add_offers(self, offers):
+        """
+        Add many offers with a single backend write and version bump
+        """
+        with self._lock:
+            self.backend.insert_offers(offers)
+            changes = []
+            for offer in offers:
+                self._store_offer(offer)
+                changes.append(('offer', offer.id))
+            changes.extend(('business', business_id) for business_id in {offer.business_id for offer in offers})
+            self._changed(*changes)
+
+    def _store_offer(self, offer):
+        self.offers[offer.id] = offer
+        self._offers_by_business.setdefault(offer.business_id, {})[offer.id] = offer
+        self._index_offer_state(offer)
+
+    def offer_updated(self, offer):
+        with self._lock:
+            self.backend.save_offer(offer)
+            self._index_offer_state(offer)
+            self._changed(('offer', offer.id), ('business', offer.business_id))
+
+    def remove_offer(self, offer):
+        with self._lock:
+            if offer.id not in self.offers:
+                return
+            self.backend.delete_offer(offer.id)
+            self._unstore_offer(offer)
+            self._changed(('offer', offer.id), ('business', offer.business_id))
+
+    def _unstore_offer(self, offer):
+        del self.offers[offer.id]
+        business_offers = self._offers_by_business.get(offer.business_id)
+        if business_offers is not None:
+            business_offers.pop(offer.id, None)
+            if not business_offers:
+                del self._offers_by_business[offer.business_id]
+        self._deactivate(offer)
+
+    def _index_offer_state(self, offer):
+        if offer.is_active:
+            self._active_offers[offer.id] = offer
+            self._active_by_business.setdefault(offer.business_id, {})[offer.id] = offer
+            key = (offer.business_id, offer.category)
+            if self._offer_category_keys.get(offer.id) != key:
+                self._remove_from_category(offer.id)
+                self._active_by_business_category.setdefault(key, {})[offer.id] = offer
+                self._offer_category_keys[offer.id] = key
+        else:
+            self._deactivate(offer)
+
+    def _deactivate(self, offer):
+        self._active_offers.pop(offer.id, None)
+        active = self._active_by_business.get(offer.business_id)
+        if active is not None:
+            active.pop(offer.id, None)
+            if not active:
+                del self._active_by_business[offer.business_id]
+        self._remove_from_category(offer.id)
+
+    def _remove_from_category(self, offer_id):
+        key = self._offer_category_keys.pop(offer_id, None)
+        bucket = self._active_by_business_category.get(key)
+        if bucket is not None:
+            bucket.pop(offer_id, None)
+            if not bucket:
+                del self._active_by_business_category[key]
+
+    def get_offer(self, offer_id):
+        return self.offers.get(str(offer_id))
+
+    def business_offers(self, business_id):
+        return list(self._offers_by_business.get(business_id, {}).values())
+
+    def active_business_offers(self, business_id):
+        return list(self._active_by_business.get(business_id, {}).values())
+
+    def active_offer_count(self, business_id):
+        return len(self._active_by_business.get(business_id, ()))
+
+    def active_category_offers(self, business_id, category):
+        return self._active_by_business_category.get((business_id, category), {}).values()
+
+    def active_offers(self):
+        """
+        Live view over the active offers, no list is built per call
+        """
+        return self._active_offers.values()
+
+    # Preference profiles
+
+    def save_profile(self, profile):
+        """
+        Write a profile through to the backend. A shared backend is the only
+        copy, so every worker reads the latest one; otherwise the last
+        MAX_MEMORY_PROFILES used are kept here
+        """
+        with self._lock:
+            self.backend.save_profile(profile)
+            if self.backend.shared:
+                return
+            self.profiles[profile.id] = profile
+            self.profiles.move_to_end(profile.id)
+            while len(self.profiles) > MAX_MEMORY_PROFILES:
+                self.profiles.popitem(last=False)
+
+    def get_profile(self, profile_id):
+        """
+        A profile kept in memory; shared backends are read with
+        backend.load_profile instead
+        """
+        with self._lock:
+            profile = self.profiles.get(str(profile_id))
+            if profile is not None:
+                self.profiles.move_to_end(profile.id)
+            return profile
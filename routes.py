@@ -1,9 +1,46 @@
-from flask import render_template, request, redirect, url_for, flash, jsonify
+from flask import render_template, request, redirect, url_for, flash, jsonify, Response, g, abort
 from flask_login import login_user, logout_user, login_required, current_user
-from models import Business, Offer
-from geofence import get_nearby_offers
-from app import app
+from models import Business, Offer, PreferenceProfile, OFFER_CATEGORIES, DEFAULT_CATEGORY
+from geofence import get_nearby_offers_batch
+from app import app, repository, analytics, database_probe
+from api import (InvalidQuery, parse_location, parse_shape, parse_trajectory, nearby_offers_key,
+                 nearby_offers_body, businesses_response, changes_payload, recommended_offers_payload,
+                 parse_viewport, viewport_etag, viewport_body, parse_search, search_offers_etag, search_offers_body)
+from serialization import iter_batch_json
+from auth import PasswordHashingBusy
+from storage import DuplicateRecord
+from analytics import MAX_REPORTED_OFFERS, STATS_WINDOW_HOURS
+from bulk_import import (import_businesses, import_offers, iter_records, detect_format, IMPORT_FORMATS,
+                         DEFAULT_BATCH_SIZE)
+from geofence_stream import (geofence_sessions, parse_geofence_radius, sse_message, GEOFENCE_HEARTBEAT_SECONDS,
+                             GEOFENCE_SYNC_STREAMS)
+from metrics import registry, request_duration, profiler, PROFILING_ENABLED, MAX_PROFILE_SECONDS
+import hmac
+import io
 import logging
+import os
+import queue
+import threading
+import time
+
+# Bearer token for POST /api/import/businesses; the endpoint is off unset
+IMPORT_API_TOKEN = os.environ.get('IMPORT_API_TOKEN')
+# Open geofence streams of this process, see GEOFENCE_SYNC_STREAMS
+geofence_stream_slots = threading.BoundedSemaphore(GEOFENCE_SYNC_STREAMS)
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_duration(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        # The URL rule keeps label cardinality bounded (no ids or query args)
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_duration.observe(time.perf_counter() - start, route=route,
+                                 method=request.method, status=response.status_code)
+    return response
 
 @app.route('/')
 def index():
@@ -38,7 +75,15 @@ def register():
             latitude = longitude = 0.0
         
         # Create business
-        business = Business.create(email, name, password, phone, address, latitude, longitude)
+        try:
+            business = Business.create(email, name, password, phone, address, latitude, longitude)
+        except PasswordHashingBusy:
+            flash('El servidor está ocupado, intenta de nuevo en unos segundos.', 'error')
+            return render_template('register.html'), 503
+        except DuplicateRecord:
+            # Registered through another worker sharing the storage backend
+            flash('Ya existe un negocio registrado con este email.', 'error')
+            return render_template('register.html')
         login_user(business)
         flash('¡Registro exitoso! Bienvenido a la plataforma.', 'success')
         return redirect(url_for('dashboard'))
@@ -56,7 +101,13 @@ def login():
             return render_template('login.html')
         
         business = Business.get_by_email(email)
-        if business and business.check_password(password):
+        try:
+            authenticated = business is not None and business.check_password(password)
+        except PasswordHashingBusy:
+            flash('El servidor está ocupado, intenta de nuevo en unos segundos.', 'error')
+            return render_template('login.html'), 503
+        
+        if authenticated:
             login_user(business)
             flash('¡Inicio de sesión exitoso!', 'success')
             return redirect(url_for('dashboard'))
@@ -76,7 +127,9 @@ def logout():
 @login_required
 def dashboard():
     offers = current_user.get_offers()
-    return render_template('dashboard.html', offers=offers)
+    offer_stats = analytics.offer_totals([offer.id for offer in offers])
+    return render_template('dashboard.html', offers=offers, categories=OFFER_CATEGORIES, offer_stats=offer_stats,
+                           stats_days=STATS_WINDOW_HOURS // 24)
 
 @app.route('/create_offer', methods=['POST'])
 @login_required
@@ -85,11 +138,16 @@ def create_offer():
     description = request.form.get('description', '').strip()
     discount_percentage = request.form.get('discount_percentage', 0)
     valid_until = request.form.get('valid_until', '')
+    category = request.form.get('category', DEFAULT_CATEGORY)
     
     if not title or not description or not discount_percentage or not valid_until:
         flash('Todos los campos son requeridos.', 'error')
         return redirect(url_for('dashboard'))
     
+    if category not in OFFER_CATEGORIES:
+        flash('Categoría inválida.', 'error')
+        return redirect(url_for('dashboard'))
+    
     try:
         discount_percentage = int(discount_percentage)
         if discount_percentage < 1 or discount_percentage > 90:
@@ -99,14 +157,14 @@ def create_offer():
         flash('Porcentaje de descuento inválido.', 'error')
         return redirect(url_for('dashboard'))
     
-    offer = Offer.create(current_user.id, title, description, discount_percentage, valid_until)
+    offer = Offer.create(current_user.id, title, description, discount_percentage, valid_until, category)
     flash('¡Oferta creada exitosamente!', 'success')
     return redirect(url_for('dashboard'))
 
 @app.route('/edit_offer/<offer_id>', methods=['POST'])
 @login_required
 def edit_offer(offer_id):
-    offer = Offer.query.get(offer_id)
+    offer = Offer.get(offer_id)
     if not offer or offer.business_id != current_user.id:
         flash('Oferta no encontrada.', 'error')
         return redirect(url_for('dashboard'))
@@ -116,11 +174,16 @@ def edit_offer(offer_id):
     discount_percentage = request.form.get('discount_percentage', offer.discount_percentage)
     valid_until = request.form.get('valid_until', offer.valid_until)
     is_active = request.form.get('is_active') == 'on'
+    category = request.form.get('category', offer.category)
     
     if not title or not description:
         flash('Título y descripción son requeridos.', 'error')
         return redirect(url_for('dashboard'))
     
+    if category not in OFFER_CATEGORIES:
+        flash('Categoría inválida.', 'error')
+        return redirect(url_for('dashboard'))
+    
     try:
         discount_percentage = int(discount_percentage)
         if discount_percentage < 1 or discount_percentage > 90:
@@ -131,14 +194,14 @@ def edit_offer(offer_id):
         return redirect(url_for('dashboard'))
     
     offer.update(title=title, description=description, discount_percentage=discount_percentage, 
-                valid_until=valid_until, is_active=is_active)
+                valid_until=valid_until, is_active=is_active, category=category)
     flash('Oferta actualizada exitosamente.', 'success')
     return redirect(url_for('dashboard'))
 
 @app.route('/delete_offer/<offer_id>')
 @login_required
 def delete_offer(offer_id):
-    offer = Offer.query.get(offer_id)
+    offer = Offer.get(offer_id)
     if not offer or offer.business_id != current_user.id:
         flash('Oferta no encontrada.', 'error')
         return redirect(url_for('dashboard'))
@@ -151,64 +214,375 @@ def delete_offer(offer_id):
 def user_map():
     return render_template('user_map.html')
 
+# Maximum number of user positions accepted by /api/nearby_offers/batch
+MAX_BATCH_QUERIES = 5000
+
+def conditional_json_response(body, etag):
+    """
+    JSON response carrying an ETag, answered with 304 when the client
+    already holds the same representation
+    """
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
 @app.route('/api/nearby_offers')
 def api_nearby_offers():
     try:
-        latitude = float(request.args.get('lat', 0))
-        longitude = float(request.args.get('lng', 0))
-        radius = int(float(request.args.get('radius', 1000)))  # Default 1km radius
-        
-        if latitude == 0 or longitude == 0:
-            return jsonify({'error': 'Ubicación inválida'}), 400
+        key, etag = nearby_offers_key(*parse_location(request.args), parse_shape(request.args),
+                                      parse_trajectory(request.args))
+        if request.if_none_match.contains(etag):
+            return conditional_json_response(b'', etag)
         
-        nearby_offers = get_nearby_offers(latitude, longitude, radius)
+        return conditional_json_response(nearby_offers_body(key), etag)
+    
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logging.error(f"Error getting nearby offers: {e}")
+        return jsonify({'error': 'Error interno del servidor'}), 500
+
+@app.route('/api/search_offers')
+def api_search_offers():
+    try:
+        search = parse_search(request.args)
+        etag = search_offers_etag(search)
+        if request.if_none_match.contains(etag):
+            return conditional_json_response(b'', etag)
+
+        return conditional_json_response(search_offers_body(search), etag)
+
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logging.error(f"Error searching offers: {e}")
+        return jsonify({'error': 'Error interno del servidor'}), 500
+
+@app.route('/api/nearby_offers/batch', methods=['POST'])
+def api_nearby_offers_batch():
+    """
+    Nearby offers for many users in one request.
+    Body: {"queries": [{"user_id": ..., "lat": ..., "lng": ..., "radius": ...}, ...]}
+    ?shape=normalized lists each result's businesses once, as in /api/nearby_offers
+    """
+    data = request.get_json(silent=True)
+    queries = data.get('queries') if isinstance(data, dict) else data
+    if not isinstance(queries, list):
+        return jsonify({'error': 'Se esperaba una lista de consultas'}), 400
+    if len(queries) > MAX_BATCH_QUERIES:
+        return jsonify({'error': f'Máximo {MAX_BATCH_QUERIES} consultas por solicitud'}), 413
+    
+    try:
+        shape = parse_shape(request.args)
+        results = [None] * len(queries)
+        points = []
+        positions = []
+        for i, query in enumerate(queries):
+            user_id = query.get('user_id') if isinstance(query, dict) else None
+            try:
+                if not isinstance(query, dict):
+                    raise InvalidQuery('Ubicación inválida')
+                points.append(parse_location(query))
+            except InvalidQuery as e:
+                results[i] = {'user_id': user_id, 'error': str(e)}
+                continue
+            positions.append((i, user_id))
         
-        offers_data = []
-        for offer, business, distance in nearby_offers:
-            offers_data.append({
-                'id': offer.id,
-                'title': offer.title,
-                'description': offer.description,
-                'discount_percentage': offer.discount_percentage,
-                'valid_until': offer.valid_until,
-                'business_name': business.name,
-                'business_address': business.address,
-                'business_phone': business.phone,
-                'business_lat': business.latitude,
-                'business_lng': business.longitude,
-                'distance': round(distance, 2)
-            })
+        impressions = []
+        for (i, user_id), nearby_offers in zip(positions, get_nearby_offers_batch(points)):
+            results[i] = (user_id, nearby_offers)
+            impressions.extend(offer.id for offer, _, _ in nearby_offers)
+        # One event for the whole batch, an offer counts once per result listing it
+        analytics.record_impressions(tuple(impressions))
         
-        return jsonify({
-            'offers': offers_data,
-            'count': len(offers_data)
-        })
+        # Large batches are streamed as they are encoded
+        return Response(iter_batch_json(results, shape), mimetype='application/json')
     
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        logging.error(f"Error getting nearby offers: {e}")
+        logging.error(f"Error getting batch nearby offers: {e}")
         return jsonify({'error': 'Error interno del servidor'}), 500
 
 @app.route('/api/businesses')
 def api_businesses():
     try:
-        businesses_data = []
-        from app import businesses as all_businesses
-        businesses = [b for b in all_businesses.values() if b.latitude != 0 and b.longitude != 0]
+        body, etag = businesses_response(repository.version)
+        if request.if_none_match.contains(etag):
+            return conditional_json_response(b'', etag)
         
-        for business in businesses:
-            active_offers = [offer for offer in business.get_offers() if offer.is_active]
-            businesses_data.append({
-                'id': business.id,
-                'name': business.name,
-                'address': business.address,
-                'phone': business.phone,
-                'latitude': business.latitude,
-                'longitude': business.longitude,
-                'offers_count': len(active_offers)
-            })
-        
-        return jsonify({'businesses': businesses_data})
+        return conditional_json_response(body, etag)
     
     except Exception as e:
         logging.error(f"Error getting businesses: {e}")
         return jsonify({'error': 'Error interno del servidor'}), 500
+
+@app.route('/api/businesses/viewport')
+def api_businesses_viewport():
+    """
+    Business clusters, or individual businesses at high zoom, inside
+    ?bbox=west,south,east,north for ?zoom=
+    """
+    try:
+        viewport = parse_viewport(request.args)
+        etag = viewport_etag(viewport)
+        if request.if_none_match.contains(etag):
+            return conditional_json_response(b'', etag)
+        
+        return conditional_json_response(viewport_body(viewport), etag)
+    
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logging.error(f"Error getting map viewport: {e}")
+        return jsonify({'error': 'Error interno del servidor'}), 500
+
+@app.route('/api/changes')
+def api_changes():
+    try:
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        return jsonify({'error': 'Revisión inválida'}), 400
+    
+    try:
+        return jsonify(changes_payload(since))
+    
+    except Exception as e:
+        logging.error(f"Error getting changes: {e}")
+        return jsonify({'error': 'Error interno del servidor'}), 500
+
+@app.route('/api/geofence/stream')
+def api_geofence_stream():
+    """
+    Server-Sent Events channel pushing geofence enter/exit transitions.
+    The first event carries the session id the client must send along
+    with its position updates to /api/geofence/position.
+    An open stream holds a worker thread, so past GEOFENCE_SYNC_STREAMS
+    streams clients are turned away and poll instead; the async mode
+    (asgi.py) has no such limit.
+    """
+    if not geofence_stream_slots.acquire(blocking=False):
+        return jsonify({'error': 'Servicio no disponible'}), 503
+    session = geofence_sessions.create(parse_geofence_radius(request.args))
+    
+    def stream():
+        try:
+            yield sse_message('session', {'session_id': session.id, 'radius': session.radius_meters})
+            while True:
+                try:
+                    event = session.events.get(timeout=GEOFENCE_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    session.last_seen = time.monotonic()
+                    yield ": keepalive\n\n"
+                    continue
+                yield sse_message(event['type'], event)
+        finally:
+            geofence_sessions.remove(session.id)
+    
+    response = Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # Runs even when the client leaves before the stream starts
+    response.call_on_close(geofence_stream_slots.release)
+    return response
+
+@app.route('/api/geofence/position', methods=['POST'])
+def api_geofence_position():
+    data = request.get_json(silent=True) or {}
+    session_id = data.get('session_id')
+    if not isinstance(session_id, str):
+        return jsonify({'error': 'Sesión no encontrada'}), 404
+    
+    try:
+        latitude, longitude, _ = parse_location(data)
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        session = geofence_sessions.get(session_id)
+        if not session:
+            # The stream may be open on another worker sharing the backend
+            if geofence_sessions.relay(session_id, latitude, longitude):
+                return jsonify({'relayed': True}), 202
+            return jsonify({'error': 'Sesión no encontrada'}), 404
+        events = session.update_position(latitude, longitude)
+        return jsonify({'inside': len(session.inside), 'events': len(events)})
+    
+    except Exception as e:
+        logging.error(f"Error updating geofence position: {e}")
+        return jsonify({'error': 'Error interno del servidor'}), 500
+
+@app.route('/api/analytics/proximity', methods=['POST'])
+def api_analytics_proximity():
+    """
+    Proximity notifications shown on a device, reported in batches as
+    {"offer_ids": [...]}
+    """
+    data = request.get_json(silent=True) or {}
+    offer_ids = data.get('offer_ids')
+    if not isinstance(offer_ids, list):
+        return jsonify({'error': 'Parámetros inválidos'}), 400
+    
+    offer_ids = tuple(offer_id for offer_id in map(str, offer_ids[:MAX_REPORTED_OFFERS])
+                      if repository.get_offer(offer_id))
+    analytics.record_proximity_hits(offer_ids)
+    return jsonify({'recorded': len(offer_ids)})
+
+# Distance choices offered by the onboarding flow, in meters
+PREFERENCE_DISTANCES = (500, 1000, 3000, 5000)
+# Favorite or excluded businesses a profile may list
+MAX_PROFILE_BUSINESSES = 200
+
+def import_request_records():
+    """
+    (line, record) pairs streamed from the request body; the format comes
+    from ?format= or the Content-Type
+    """
+    fmt = request.args.get('format') or detect_format(None, request.content_type)
+    if fmt not in IMPORT_FORMATS:
+        raise InvalidQuery('Formato inválido')
+    try:
+        batch_size = min(max(int(request.args.get('batch_size', DEFAULT_BATCH_SIZE)), 1), 10000)
+    except ValueError:
+        raise InvalidQuery('Tamaño de lote inválido')
+    stream = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+    return iter_records(stream, fmt), batch_size
+
+@app.route('/api/import/businesses', methods=['POST'])
+def api_import_businesses():
+    """
+    Bulk import businesses from a CSV or JSON lines body.
+    Requires Authorization: Bearer <IMPORT_API_TOKEN>
+    """
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    if not IMPORT_API_TOKEN or not hmac.compare_digest(token, IMPORT_API_TOKEN):
+        return jsonify({'error': 'No autorizado'}), 403
+    
+    try:
+        records, batch_size = import_request_records()
+        return jsonify(import_businesses(records, batch_size).to_dict())
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except PasswordHashingBusy as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        logging.error(f"Error importing businesses: {e}")
+        return jsonify({'error': 'Error interno del servidor'}), 500
+
+@app.route('/api/import/offers', methods=['POST'])
+@login_required
+def api_import_offers():
+    """
+    Bulk import offers of the logged-in business from a CSV or JSON lines body
+    """
+    try:
+        records, batch_size = import_request_records()
+        return jsonify(import_offers(records, batch_size, business_id=current_user.id).to_dict())
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logging.error(f"Error importing offers: {e}")
+        return jsonify({'error': 'Error interno del servidor'}), 500
+
+@app.route('/api/preferences', methods=['POST'])
+def api_save_preferences():
+    """
+    Create or replace a preference profile.
+    Body: {"profile_id"?, "interests": [...], "min_discount", "max_distance",
+           "favorite_businesses"?, "excluded_businesses"?}
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Datos inválidos'}), 400
+    
+    interests = data.get('interests') or []
+    if not isinstance(interests, list) or any(category not in OFFER_CATEGORIES for category in interests):
+        return jsonify({'error': 'Categorías inválidas'}), 400
+    if len(set(interests)) < 2:
+        return jsonify({'error': 'Selecciona al menos 2 categorías'}), 400
+    
+    try:
+        min_discount = int(data.get('min_discount', 5))
+        max_distance = int(data.get('max_distance', 1000))
+    except (TypeError, ValueError, OverflowError):
+        return jsonify({'error': 'Preferencias inválidas'}), 400
+    if min_discount < 0 or min_discount > 90:
+        return jsonify({'error': 'El descuento mínimo debe estar entre 0% y 90%.'}), 400
+    if max_distance not in PREFERENCE_DISTANCES:
+        return jsonify({'error': 'Distancia inválida'}), 400
+    
+    business_lists = [data.get('favorite_businesses') or [], data.get('excluded_businesses') or []]
+    for business_ids in business_lists:
+        if not isinstance(business_ids, list) or len(business_ids) > MAX_PROFILE_BUSINESSES \
+                or not all(isinstance(business_id, (str, int)) for business_id in business_ids):
+            return jsonify({'error': 'Negocios inválidos'}), 400
+    
+    profile_id = data.get('profile_id')
+    if profile_id is not None and not isinstance(profile_id, str):
+        return jsonify({'error': 'Datos inválidos'}), 400
+    if profile_id and not PreferenceProfile.get(profile_id):
+        return jsonify({'error': 'Perfil no encontrado'}), 404
+    
+    profile = PreferenceProfile.save(
+        profile_id,
+        interests=interests,
+        min_discount=min_discount,
+        max_distance=max_distance,
+        favorite_businesses=business_lists[0],
+        excluded_businesses=business_lists[1]
+    )
+    return jsonify(profile.to_dict())
+
+@app.route('/api/preferences/<profile_id>')
+def api_get_preferences(profile_id):
+    profile = PreferenceProfile.get(profile_id)
+    if not profile:
+        return jsonify({'error': 'Perfil no encontrado'}), 404
+    return jsonify(profile.to_dict())
+
+@app.route('/api/recommended_offers')
+def api_recommended_offers():
+    profile = PreferenceProfile.get(request.args.get('profile_id', ''))
+    if not profile:
+        return jsonify({'error': 'Perfil no encontrado'}), 404
+    
+    try:
+        return jsonify(recommended_offers_payload(request.args, profile))
+    
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logging.error(f"Error ranking offers: {e}")
+        return jsonify({'error': 'Error interno del servidor'}), 500
+
+@app.route('/metrics')
+def metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/healthz')
+def healthz():
+    """
+    Liveness for load balancers, always 200: the optional database is only
+    probed and reported, requests never depend on it
+    """
+    return jsonify({'status': 'ok', 'database': database_probe.status})
+
+@app.route('/debug/profile')
+def debug_profile():
+    """
+    Sample every thread for ?seconds=N (default 10) and return the collapsed
+    stacks, ready for flamegraph.pl or speedscope
+    """
+    if not PROFILING_ENABLED:
+        abort(404)
+    try:
+        seconds = min(float(request.args.get('seconds', 10)), MAX_PROFILE_SECONDS)
+    except ValueError:
+        return jsonify({'error': 'Duración inválida'}), 400
+
+    stacks = profiler.profile(seconds)
+    if stacks is None:
+        return jsonify({'error': 'Ya hay un perfilado en curso'}), 409
+    return Response(stacks, mimetype='text/plain')
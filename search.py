@@ -0,0 +1,171 @@
+"""
+Inverted index over the titles and descriptions of active offers.
+
+Text is lowercased and accent-folded ("Café" and "cafe" are the same
+term), Spanish stopwords are dropped and plurals are folded onto their
+singular with a few suffix rules, so "cafés", "panes" or "2x1" match what
+users type. The index follows the repository change feed: every offer
+create, update or delete re-indexes just that offer.
+
+The last query term is matched as a prefix, so results show up while the
+user is still typing.
+"""
+import bisect
+import re
+import threading
+import unicodedata
+
+TOKEN_PATTERN = re.compile(r'[^\W_]+')
+# Common Spanish words, accent-folded like the indexed text
+STOPWORDS = frozenset("""
+    a al algo con contra cual de del desde donde e el ella en entre es esta este esto hasta la las le les lo los
+    mas me mi mis muy ni no o os para pero por que se sea ser si sin sobre son su sus te tu tus u un una unas
+    uno unos y ya
+""".split())
+VOWELS = frozenset('aeiou')
+# Consonants after which a plural ends in -es (flor-es, pan-es, mes-es).
+# The singular's own final e is dropped too, so postre/postres meet at postr
+PLURAL_ES_AFTER = frozenset('dlnrsjz')
+# Shortest last query term expanded as a prefix
+MIN_PREFIX_LENGTH = 2
+
+
+def fold(text):
+    """
+    Lowercase text without accents or diacritics (ñ becomes n)
+    """
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+
+def stem(token):
+    """
+    Fold a Spanish plural onto its singular form; digits and short words
+    are kept as they are
+    """
+    if len(token) <= 3 or not token.isalpha():
+        return token
+    if token.endswith('s') and token[-2] in VOWELS:
+        token = token[:-1]
+    if len(token) > 3 and token.endswith('e') and token[-2] in PLURAL_ES_AFTER:
+        token = token[:-1]
+    return token
+
+
+def tokenize(text):
+    """
+    Searchable terms of a text, in order, with repeats
+    """
+    return [stem(token) for token in TOKEN_PATTERN.findall(fold(text or '')) if token not in STOPWORDS]
+
+
+def query_terms(query):
+    """
+    Distinct terms of a search query, in order
+    """
+    return list(dict.fromkeys(tokenize(query)))
+
+
+def offer_terms(offer):
+    return frozenset(tokenize(offer.title)) | frozenset(tokenize(offer.description))
+
+
+class OfferTextIndex:
+    """
+    Term -> ids of the active offers containing it, with a sorted list of
+    the terms for prefix lookups. Inactive offers are left out, like the
+    active-offer indexes of the repository
+    """
+
+    def __init__(self, repository):
+        self.repository = repository
+        self._postings = {}
+        self._terms = []
+        # offer_id -> terms it is indexed under, to undo on update or delete
+        self._offer_terms = {}
+        self._lock = threading.Lock()
+        repository.add_change_listener(self._on_change)
+
+    def _on_change(self, changes):
+        with self._lock:
+            if not changes:
+                self._rebuild()
+                return
+            for kind, item_id in changes:
+                if kind == 'offer':
+                    self._index(item_id, self.repository.get_offer(item_id))
+
+    def _index(self, offer_id, offer):
+        terms = offer_terms(offer) if offer is not None and offer.is_active else frozenset()
+        previous = self._offer_terms.get(offer_id, frozenset())
+        if terms == previous:
+            return
+
+        for term in previous - terms:
+            postings = self._postings[term]
+            postings.discard(offer_id)
+            if not postings:
+                del self._postings[term]
+                del self._terms[bisect.bisect_left(self._terms, term)]
+        for term in terms - previous:
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = set()
+                bisect.insort(self._terms, term)
+            postings.add(offer_id)
+
+        if terms:
+            self._offer_terms[offer_id] = terms
+        else:
+            self._offer_terms.pop(offer_id, None)
+
+    def _rebuild(self):
+        self._postings = {}
+        self._offer_terms = {}
+        for offer in self.repository.active_offers():
+            terms = offer_terms(offer)
+            if terms:
+                self._offer_terms[offer.id] = terms
+                for term in terms:
+                    self._postings.setdefault(term, set()).add(offer.id)
+        self._terms = sorted(self._postings)
+
+    def _prefix_postings(self, prefix):
+        terms = self._terms
+        start = bisect.bisect_left(terms, prefix)
+        end = bisect.bisect_left(terms, prefix + '\uffff', start)
+        if end - start == 1:
+            return self._postings[terms[start]]
+        matches = set()
+        for term in terms[start:end]:
+            matches.update(self._postings[term])
+        return matches
+
+    def match(self, terms):
+        """
+        Ids of the active offers containing every one of the query_terms,
+        the last one as a prefix. Returns a new set
+        """
+        if not terms:
+            return set()
+
+        with self._lock:
+            postings = [self._postings.get(term, ()) for term in terms[:-1]]
+            last = terms[-1]
+            postings.append(self._prefix_postings(last) if len(last) >= MIN_PREFIX_LENGTH
+                            else self._postings.get(last, ()))
+            # Start from the rarest term so every step shrinks the result
+            postings.sort(key=len)
+            matches = set(postings[0])
+            for offer_ids in postings[1:]:
+                if not matches:
+                    break
+                matches.intersection_update(offer_ids)
+            return matches
+
+    @property
+    def term_count(self):
+        return len(self._terms)
+
+    def __len__(self):
+        return len(self._offer_terms)
@@ -0,0 +1,184 @@
+"""
+JSON encoding of offer and business payloads from cached fragments.
+
+Each offer and business is encoded once into a fragment of "key": value
+pairs, kept until the repository reports a write to that record. Responses
+are then assembled by concatenating fragments instead of building a dict per
+row and encoding it again, so a popular business is encoded once no matter
+how many of its offers a response lists.
+"""
+import json
+import threading
+
+_encode = json.JSONEncoder(ensure_ascii=True, separators=(',', ':')).encode
+
+# Response shapes of /api/nearby_offers: one object per offer with the
+# business fields repeated, or businesses listed once and referenced by id
+NEARBY_SHAPES = ('flat', 'normalized')
+
+
+def _members(pairs):
+    return ','.join(f'{_encode(key)}:{_encode(value)}' for key, value in pairs)
+
+
+class FragmentCache:
+    """
+    Encoded fragments per record, keyed by (kind, id) as in the repository
+    change log, then by encoder.
+    A generation counter guards against a fragment encoded from a record
+    that was written meanwhile being stored after its invalidation.
+    """
+
+    def __init__(self):
+        self._fragments = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, kind, record, encode):
+        encoded = self._fragments.get((kind, record.id))
+        fragment = encoded.get(encode) if encoded else None
+        if fragment is None:
+            generation = self._generation
+            fragment = encode(record)
+            with self._lock:
+                if generation == self._generation:
+                    self._fragments.setdefault((kind, record.id), {})[encode] = fragment
+        return fragment
+
+    def invalidate(self, changes):
+        """
+        Repository change listener; no changes means everything may differ
+        """
+        with self._lock:
+            self._generation += 1
+            if not changes:
+                self._fragments.clear()
+            for change in changes:
+                self._fragments.pop(change, None)
+
+    def __len__(self):
+        return len(self._fragments)
+
+
+fragments = FragmentCache()
+
+
+# Fragment encoders. Each returns the members of an object without braces
+
+def offer_fields(offer):
+    return _members((
+        ('id', offer.id),
+        ('title', offer.title),
+        ('description', offer.description),
+        ('discount_percentage', offer.discount_percentage),
+        ('valid_until', offer.valid_until),
+        ('category', offer.category),
+    ))
+
+
+def offer_reference_fields(offer):
+    return _members((
+        ('id', offer.id),
+        ('business_id', offer.business_id),
+        ('title', offer.title),
+        ('description', offer.description),
+        ('discount_percentage', offer.discount_percentage),
+        ('valid_until', offer.valid_until),
+        ('category', offer.category),
+    ))
+
+
+def business_offer_fields(business):
+    return _members((
+        ('business_name', business.name),
+        ('business_address', business.address),
+        ('business_phone', business.phone),
+        ('business_lat', business.latitude),
+        ('business_lng', business.longitude),
+    ))
+
+
+def business_fields(business):
+    return _members((
+        ('id', business.id),
+        ('name', business.name),
+        ('address', business.address),
+        ('phone', business.phone),
+        ('latitude', business.latitude),
+        ('longitude', business.longitude),
+    ))
+
+
+def business_list_fields(business):
+    return business_fields(business) + f',"offers_count":{business.count_active_offers()}'
+
+
+# Response writers, yielding str chunks
+
+def iter_nearby_offers_json(matches, shape='flat', leading=None):
+    """
+    Encode (offer, business, distance) matches as the /api/nearby_offers
+    body, chunk by chunk. `leading` is an optional dict of members written
+    before the offers (e.g. the user_id of a batch result)
+    """
+    yield '{' + (_members(leading.items()) + ',' if leading else '')
+    if shape == 'normalized':
+        yield from _iter_normalized(matches)
+        return
+
+    yield '"offers":['
+    for i, (offer, business, distance) in enumerate(matches):
+        yield (',{' if i else '{') + fragments.get('offer', offer, offer_fields) + ',' \
+            + fragments.get('business', business, business_offer_fields) \
+            + f',"distance":{_encode(round(distance, 2))}}}'
+    yield f'],"count":{len(matches)}}}'
+
+
+def _iter_normalized(matches):
+    businesses = {}
+    yield '"offers":['
+    for i, (offer, business, distance) in enumerate(matches):
+        businesses.setdefault(business.id, (business, distance))
+        yield (',{' if i else '{') + fragments.get('offer', offer, offer_reference_fields) + '}'
+    yield '],"businesses":['
+    for i, (business, distance) in enumerate(businesses.values()):
+        yield (',{' if i else '{') + fragments.get('business', business, business_fields) \
+            + f',"distance":{_encode(round(distance, 2))}}}'
+    yield f'],"count":{len(matches)}}}'
+
+
+def iter_batch_json(results, shape='flat'):
+    """
+    Encode /api/nearby_offers/batch results: dicts are written as they are
+    (errors), (user_id, matches) pairs as nearby bodies tagged with user_id
+    """
+    yield '{"results":['
+    for i, result in enumerate(results):
+        if i:
+            yield ','
+        if isinstance(result, dict):
+            yield _encode(result)
+        else:
+            user_id, matches = result
+            yield from iter_nearby_offers_json(matches, shape, {'user_id': user_id})
+    yield f'],"count":{len(results)}}}'
+
+
+def iter_businesses_json(businesses):
+    yield '{"businesses":['
+    for i, business in enumerate(businesses):
+        yield (',{' if i else '{') + fragments.get('business', business, business_list_fields) + '}'
+    yield ']}'
+
+
+def iter_viewport_json(zoom, revision, clusters, businesses):
+    """
+    Encode a map viewport: (lat, lng, count) clusters and/or businesses
+    """
+    yield f'{{"zoom":{zoom},"revision":{revision},"clusters":['
+    for i, (lat, lng, count) in enumerate(clusters):
+        yield f'{"," if i else ""}{{"lat":{_encode(round(lat, 6))},"lng":{_encode(round(lng, 6))},"count":{count}}}'
+    yield '],"businesses":['
+    for i, business in enumerate(businesses):
+        yield (',{' if i else '{') + fragments.get('business', business, business_list_fields) + '}'
+    yield ']}'
@@ -0,0 +1,195 @@
+"""
+Router in front of geo-sharded nodes (see sharding.py).
+
+Answers /api/nearby_offers and /api/search_offers by sending the query to
+the nodes whose cells overlap the search circle, in parallel, and merging
+their closest-first results. A query that falls inside a single shard is
+passed through untouched. It does not load the app or any data, only the
+shard map, so it starts instantly and any number can run side by side:
+
+    SHARD_NODES=http://10.0.0.1:5000,http://10.0.0.2:5000 gunicorn -w 2 shard_router:application
+    SHARD_NODES=... python shard_router.py --port 8000
+
+Pages, logins and writes are not routed here; send them to any node.
+"""
+import argparse
+import heapq
+import json
+import logging
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from socketserver import ThreadingMixIn
+from urllib.error import HTTPError, URLError
+from urllib.parse import parse_qsl, urlencode
+from urllib.request import urlopen
+from wsgiref.simple_server import WSGIServer, make_server
+
+from sharding import create_shard_map
+
+SHARD_TIMEOUT_SECONDS = float(os.environ.get('SHARD_TIMEOUT', 2))
+SHARD_FANOUT_THREADS = int(os.environ.get('SHARD_FANOUT_THREADS', 16))
+ROUTED_PATHS = ('/api/nearby_offers', '/api/search_offers')
+# Results per search without ?limit=, as api.MAX_SEARCH_RESULTS
+DEFAULT_SEARCH_LIMIT = 100
+# The shards answer at most this radius (api.MAX_RADIUS_METERS), so wider
+# queries fan out no further than that
+MAX_RADIUS_METERS = int(os.environ.get('MAX_RADIUS_METERS', 50000))
+# Trajectory prefetch is left out: every shard would widen the query around
+# its own data, and the merged region would not be valid for any of them
+DROPPED_PARAMS = ('heading', 'speed', 'history')
+
+
+class ShardUnavailable(RuntimeError):
+    """
+    Raised when no shard a query needs answered
+    """
+
+
+def merge_nearby_responses(responses, shape='flat', limit=None):
+    """
+    Merge decoded /api/nearby_offers bodies, each closest first, into one
+    body of the same shape, dropping repeated offers and businesses
+    """
+    merged = {key: value for key, value in responses[0].items() if key not in ('offers', 'businesses', 'count')}
+
+    if shape != 'normalized':
+        offers, seen = [], set()
+        for offer in heapq.merge(*(response['offers'] for response in responses), key=lambda offer: offer['distance']):
+            if offer['id'] not in seen:
+                seen.add(offer['id'])
+                offers.append(offer)
+        offers = offers[:limit]
+        merged.update(offers=offers, count=len(offers))
+        return merged
+
+    offers_by_business = {}
+    for response in responses:
+        for offer in response['offers']:
+            offers_by_business.setdefault(offer['business_id'], {}).setdefault(offer['id'], offer)
+    businesses, offers = [], []
+    for business in heapq.merge(*(response['businesses'] for response in responses),
+                                key=lambda business: business['distance']):
+        business_offers = offers_by_business.pop(business['id'], None)
+        if business_offers is None or (limit is not None and len(offers) >= limit):
+            continue
+        businesses.append(business)
+        offers.extend(business_offers.values())
+    offers = offers[:limit]
+    merged.update(offers=offers, businesses=businesses, count=len(offers))
+    return merged
+
+
+class ShardRouter:
+    def __init__(self, shard_map, timeout=SHARD_TIMEOUT_SECONDS, threads=SHARD_FANOUT_THREADS):
+        self.shard_map = shard_map
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='shard-fanout')
+
+    def _fetch(self, shard, path, query):
+        url = f"{self.shard_map.nodes[shard].rstrip('/')}{path}?{query}"
+        try:
+            with urlopen(url, timeout=self.timeout) as response:
+                return response.status, response.read()
+        except HTTPError as e:
+            return e.code, e.read()
+
+    def route(self, path, args):
+        """
+        Fan a radius query out to the shards it overlaps.
+        Returns (status, JSON body bytes)
+        """
+        try:
+            latitude, longitude = float(args.get('lat', 0)), float(args.get('lng', 0))
+            radius = float(args.get('radius', 1000))
+            if not (-90 <= latitude <= 90 and -180 <= longitude <= 180 and math.isfinite(radius)):
+                raise ValueError(radius)
+        except ValueError:
+            return 400, json.dumps({'error': 'Ubicación inválida'}).encode()
+        limit = None
+        if path == '/api/search_offers':
+            try:
+                limit = min(int(args.get('limit', DEFAULT_SEARCH_LIMIT)), DEFAULT_SEARCH_LIMIT)
+            except ValueError:
+                # The shards reject it with their own message
+                pass
+
+        shards = self.shard_map.shards_for_circle(latitude, longitude, min(max(radius, 0), MAX_RADIUS_METERS))
+        query = urlencode([(key, value) for key, value in args.items() if key not in DROPPED_PARAMS])
+        futures = [self.executor.submit(self._fetch, shard, path, query) for shard in shards]
+
+        bodies, failed = [], []
+        for shard, future in zip(shards, futures):
+            try:
+                status, body = future.result()
+            except (URLError, OSError) as e:
+                logging.warning(f"Shard {shard} unavailable: {e}")
+                failed.append(shard)
+                continue
+            if status == 200:
+                bodies.append(body)
+            elif 400 <= status < 500:
+                # Invalid query: every shard would answer the same
+                return status, body
+            else:
+                logging.warning(f"Shard {shard} answered {status}")
+                failed.append(shard)
+
+        if not bodies:
+            raise ShardUnavailable(f"No shard answered for shards {shards}")
+        if len(bodies) == 1 and not failed:
+            return 200, bodies[0]
+
+        merged = merge_nearby_responses([json.loads(body) for body in bodies], args.get('shape', 'flat'), limit)
+        if failed:
+            # Offers from the failed shards are missing
+            merged['partial'] = True
+        return 200, json.dumps(merged, separators=(',', ':')).encode()
+
+
+shard_map = create_shard_map()
+router = ShardRouter(shard_map) if shard_map is not None else None
+
+
+def json_response(start_response, status, body):
+    start_response(f"{status} {HTTPStatus(status).phrase}", [
+        ('Content-Type', 'application/json'),
+        ('Content-Length', str(len(body))),
+    ])
+    return [body]
+
+
+def application(environ, start_response):
+    if router is None:
+        raise RuntimeError("SHARD_NODES is not set")
+
+    path = environ.get('PATH_INFO', '')
+    if environ['REQUEST_METHOD'] != 'GET' or path not in ROUTED_PATHS:
+        return json_response(start_response, 404, json.dumps({'error': 'No encontrado'}).encode())
+
+    args = dict(parse_qsl(environ.get('QUERY_STRING', '')))
+    try:
+        status, body = router.route(path, args)
+    except ShardUnavailable as e:
+        logging.error(str(e))
+        status, body = 502, json.dumps({'error': 'Servicio no disponible'}).encode()
+    return json_response(start_response, status, body)
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the shard router with the standard library server.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    with make_server(args.host, args.port, application, server_class=ThreadingWSGIServer) as server:
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
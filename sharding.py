@@ -0,0 +1,187 @@
+"""
+Geographic partitioning of businesses and offers across nodes.
+
+The world is cut into square cells of SHARD_CELL_DEGREES (1 degree, about
+111km, holds a metropolitan area) and every cell belongs to one of the
+nodes listed in SHARD_NODES. Cells are assigned by rendezvous hashing on
+the node URLs, so adding a node only moves the cells the new node takes
+over, and removing one only moves the cells it held. A node started with
+SHARD_ID loads only the businesses in its own cells, with their offers;
+shard_router.py sends each radius query to the nodes whose cells overlap
+the search circle and merges their sorted results.
+
+Nodes share one storage backend, which hands out record ids. Pages and
+writes may go to any node: every node follows the backend's change log,
+so a business registered or moved through another node shows up on the
+node owning its cell within SHARD_SYNC_SECONDS. On startup and on every
+snapshot publish a node reads only its own cells, through the backend's
+spatial index.
+
+The only shared backend so far is a SQLite file, which every node opens
+directly: all nodes must run on the same host (SQLite locking does not
+work over network file systems). Spreading shards over several machines
+needs a networked storage backend.
+
+Businesses without a location are kept by every node: they never show up
+in geo queries, but their owners can log in anywhere.
+"""
+import functools
+import hashlib
+import math
+import os
+
+from spatial_index import METERS_PER_DEGREE
+
+SHARD_CELL_DEGREES = float(os.environ.get('SHARD_CELL_DEGREES', 1.0))
+# Past this many cells in a search box every shard is asked instead
+MAX_SHARD_CELLS = 4096
+# How often a shard node picks up businesses and offers written through
+# other nodes (registrations and moves into its cells, edits)
+SHARD_SYNC_SECONDS = float(os.environ.get('SHARD_SYNC_SECONDS', 1.0))
+
+
+class ShardMap:
+    """
+    Cell -> shard assignment for a list of node URLs, and the shard of this
+    process (None for a router or an unsharded node)
+    """
+
+    def __init__(self, nodes, local_shard=None, cell_degrees=SHARD_CELL_DEGREES):
+        if not nodes:
+            raise ValueError("A shard map needs at least one node")
+        if local_shard is not None and not 0 <= local_shard < len(nodes):
+            raise ValueError(f"Shard {local_shard} is not in the {len(nodes)} configured nodes")
+        self.nodes = list(nodes)
+        self.local_shard = local_shard
+        self.cell_degrees = float(cell_degrees)
+        self.rows = int(math.ceil(180.0 / self.cell_degrees))
+        self.columns = int(math.ceil(360.0 / self.cell_degrees))
+        self.cell_shard = functools.lru_cache(maxsize=65536)(self._assign)
+
+    def _row(self, lat):
+        return min(max(int((lat + 90.0) // self.cell_degrees), 0), self.rows - 1)
+
+    def _column(self, lng):
+        return int(((lng + 180.0) % 360.0) // self.cell_degrees) % self.columns
+
+    def _assign(self, row, column):
+        # Rendezvous hashing: the shard with the highest score for the cell.
+        # Scores come from the node URL, not its position in the list, so
+        # removing a node only moves the cells it held
+        return max(range(len(self.nodes)),
+                   key=lambda shard: hashlib.blake2b(f"{row}:{column}:{self.nodes[shard]}".encode(),
+                                                     digest_size=8).digest())
+
+    def shard_for(self, lat, lng):
+        return self.cell_shard(self._row(lat), self._column(lng))
+
+    def owns(self, lat, lng):
+        """
+        Whether this node keeps a business at (lat, lng); unsharded nodes
+        keep everything
+        """
+        if self.local_shard is None or lat == 0 or lng == 0:
+            return True
+        return self.shard_for(lat, lng) == self.local_shard
+
+    def _box(self, first_row, last_row, first_column, last_column):
+        # (min_lat, max_lat, min_lng, max_lng) of a half-open range of cells
+        degrees = self.cell_degrees
+        return (first_row * degrees - 90.0, min(last_row * degrees - 90.0, 90.0),
+                first_column * degrees - 180.0, min(last_column * degrees - 180.0, 180.0))
+
+    def owned_boxes(self, occupied):
+        """
+        (min_lat, max_lat, min_lng, max_lng) boxes of this node's cells that
+        hold businesses. occupied(*box) says whether any business lies in a
+        box; the world is halved recursively and empty halves are dropped
+        whole, so the number of calls follows the occupied cells, not the
+        size of the world. Boxes include their edges, so callers keep only
+        the rows owns() accepts
+        """
+        boxes = []
+        pending = [(0, self.rows, 0, self.columns)]
+        while pending:
+            first_row, last_row, first_column, last_column = pending.pop()
+            box = self._box(first_row, last_row, first_column, last_column)
+            if not occupied(*box):
+                continue
+            if last_row - first_row == 1 and last_column - first_column == 1:
+                if self.cell_shard(first_row, first_column) == self.local_shard:
+                    boxes.append(box)
+                    if first_column == 0:
+                        # Longitude 180 falls in column 0, on the far edge of the map
+                        boxes.append((box[0], box[1], 180.0, 180.0))
+                continue
+            if last_row - first_row >= last_column - first_column:
+                middle = (first_row + last_row) // 2
+                pending.extend([(first_row, middle, first_column, last_column),
+                                (middle, last_row, first_column, last_column)])
+            else:
+                middle = (first_column + last_column) // 2
+                pending.extend([(first_row, last_row, first_column, middle),
+                                (first_row, last_row, middle, last_column)])
+        return boxes
+
+    def _column_ranges(self, lng, dlng):
+        if dlng >= 180.0:
+            return [(0, self.columns - 1)]
+        west, east = lng - dlng, lng + dlng
+        if west < -180.0:
+            return [(self._column(west + 360.0), self.columns - 1), (0, self._column(east))]
+        if east >= 180.0:
+            return [(self._column(west), self.columns - 1), (0, self._column(east - 360.0))]
+        return [(self._column(west), self._column(east))]
+
+    def shards_for_circle(self, lat, lng, radius_meters):
+        """
+        Sorted ids of the shards owning a cell that overlaps the bounding
+        box of the search circle
+        """
+        dlat = radius_meters / METERS_PER_DEGREE
+        min_lat, max_lat = max(lat - dlat, -90.0), min(lat + dlat, 90.0)
+        cos_lat = math.cos(math.radians(max(abs(min_lat), abs(max_lat))))
+        if cos_lat < 1e-9 or min_lat <= -90.0 or max_lat >= 90.0:
+            dlng = 180.0
+        else:
+            dlng = dlat / cos_lat
+
+        rows = range(self._row(min_lat), self._row(max_lat) + 1)
+        column_ranges = self._column_ranges(lng, dlng)
+        if len(rows) * sum(last - first + 1 for first, last in column_ranges) > MAX_SHARD_CELLS:
+            return list(range(len(self.nodes)))
+
+        shards = set()
+        for row in rows:
+            for first, last in column_ranges:
+                for column in range(first, last + 1):
+                    shards.add(self.cell_shard(row, column))
+                    if len(shards) == len(self.nodes):
+                        return list(range(len(self.nodes)))
+        return sorted(shards)
+
+
+def load_owned_rows(shard_map, backend):
+    """
+    (business rows, offer rows) kept by a shard node: the businesses in its
+    cells and those without a location, with all their offers. The backend
+    is read box by box through its spatial index (see owned_boxes), so the
+    cost follows this node's share of the data, not the whole table
+    """
+    boxes = shard_map.owned_boxes(backend.has_located_businesses)
+    businesses = {row[0]: row for row in backend.located_business_rows(boxes) if shard_map.owns(row[6], row[7])}
+    businesses.update((row[0], row) for row in backend.unlocated_business_rows())
+    return list(businesses.values()), backend.business_offer_rows(businesses)
+
+
+def create_shard_map():
+    """
+    ShardMap for the SHARD_NODES (comma-separated base URLs, one per shard)
+    and SHARD_ID environment variables, or None when sharding is disabled
+    (the default)
+    """
+    nodes = [url.strip() for url in os.environ.get('SHARD_NODES', '').split(',') if url.strip()]
+    if not nodes:
+        return None
+    local_shard = os.environ.get('SHARD_ID')
+    return ShardMap(nodes, int(local_shard) if local_shard else None)
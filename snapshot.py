@@ -0,0 +1,317 @@
+"""
+Read-optimized snapshot of business locations and active offer references,
+shared by every worker process through a memory-mapped file.
+
+A snapshot file holds columnar arrays: business ids and their coordinates
+(radians and cos(latitude), sorted by latitude) plus the ids of each
+business's active offers as offsets into one flat array. Workers map the
+file read-only and run the geofence distance pass directly over the
+mapped pages, so the coordinates exist once in the page cache however many
+workers there are.
+
+One process at a time publishes (an exclusive lock on `<path>.lock`): it
+writes the next generation to a temporary file and renames it over the
+current one. A reader that notices the new file maps it; a query in flight
+keeps the mapping it started with, so it never sees a half-written
+snapshot.
+
+Only the distance pass of /api/nearby_offers reads the mapping. Each
+worker still loads every business and offer into its own repository, with
+its spatial, coordinate, search and cluster indexes, and serves record
+bodies, the batch endpoint, text search and geofence sessions from them.
+Memory per worker therefore still grows with the data set; what the
+snapshot keeps flat is the coordinate data the geofence path scans.
+"""
+import fcntl
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+from sharding import load_owned_rows
+from spatial_index import EARTH_RADIUS_METERS, METERS_PER_DEGREE
+
+MAGIC = b'GEOSNAP1'
+# magic, generation, length of the JSON array table
+HEADER = struct.Struct('<8sQQ')
+ALIGNMENT = 64
+# Quiet period after a write before publishing, so bursts coalesce, and
+# the longest a steady stream of writes can hold a publish back
+PUBLISH_DELAY_SECONDS = 0.2
+MAX_PUBLISH_DELAY_SECONDS = 2.0
+
+
+def build_columns(businesses, active_offers):
+    """
+    Snapshot arrays from (id, lat, lng) business tuples and (offer id,
+    business id) pairs of active offers. Businesses are sorted by latitude
+    so a radius query only scans a latitude band
+    """
+    businesses = sorted(businesses, key=lambda business: business[1])
+    offers_by_business = {}
+    for offer_id, business_id in active_offers:
+        offers_by_business.setdefault(business_id, []).append(offer_id)
+
+    lat_rad = np.radians(np.array([business[1] for business in businesses], dtype=np.float64))
+    lng_rad = np.radians(np.array([business[2] for business in businesses], dtype=np.float64))
+    offer_ids = []
+    offer_offsets = np.zeros(len(businesses) + 1, dtype=np.int64)
+    for i, business in enumerate(businesses):
+        offer_ids.extend(offers_by_business.get(business[0], ()))
+        offer_offsets[i + 1] = len(offer_ids)
+
+    return {
+        'business_ids': np.array([business[0].encode() for business in businesses], dtype=np.bytes_),
+        'lat_rad': lat_rad,
+        'lng_rad': lng_rad,
+        'cos_lat': np.cos(lat_rad),
+        'offer_offsets': offer_offsets,
+        'offer_ids': np.array([offer_id.encode() for offer_id in offer_ids], dtype=np.bytes_),
+    }
+
+
+def write_snapshot(path, columns, generation):
+    """
+    Write the arrays to a temporary file and atomically rename it to path
+    """
+    table = {}
+    offset = 0
+    for name, array in columns.items():
+        table[name] = [array.dtype.str, offset, len(array)]
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    encoded_table = json.dumps(table).encode()
+    data_start = -(-(HEADER.size + len(encoded_table)) // ALIGNMENT) * ALIGNMENT
+
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, generation, len(encoded_table)) + encoded_table)
+        for name, array in columns.items():
+            f.seek(data_start + table[name][1])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(data_start + offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+def read_generation(path):
+    try:
+        with open(path, 'rb') as f:
+            magic, generation, _ = HEADER.unpack(f.read(HEADER.size))
+    except (OSError, struct.error):
+        return 0
+    return generation if magic == MAGIC else 0
+
+
+class SnapshotView:
+    """
+    One published generation, with numpy arrays viewing the mapped file
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.generation, table_length = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError(f"Not a snapshot file: {path}")
+        table = json.loads(self._map[HEADER.size:HEADER.size + table_length])
+        data_start = -(-(HEADER.size + table_length) // ALIGNMENT) * ALIGNMENT
+        for name, (dtype, offset, length) in table.items():
+            setattr(self, name, np.frombuffer(self._map, dtype=dtype, count=length, offset=data_start + offset))
+
+    def nearby(self, lat, lng, radius_meters):
+        """
+        Businesses with active offers within the radius, closest first.
+        Returns (business id, distance, offer ids) tuples
+        """
+        # Latitude band of the search circle; the arrays are sorted by it
+        dlat = math.radians(radius_meters / METERS_PER_DEGREE)
+        lat_rad = math.radians(lat)
+        first = np.searchsorted(self.lat_rad, lat_rad - dlat, side='left')
+        last = np.searchsorted(self.lat_rad, lat_rad + dlat, side='right')
+        if first == last:
+            return []
+
+        band_lat = self.lat_rad[first:last]
+        a = np.sin((band_lat - lat_rad) / 2) ** 2 \
+            + math.cos(lat_rad) * self.cos_lat[first:last] * np.sin((self.lng_rad[first:last] - math.radians(lng)) / 2) ** 2
+        distances = 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+        inside = np.flatnonzero(distances <= radius_meters)
+        inside = inside[np.argsort(distances[inside], kind='stable')]
+
+        offsets = self.offer_offsets
+        nearby = []
+        for i in inside:
+            slot = first + i
+            start, end = offsets[slot], offsets[slot + 1]
+            if start != end:
+                nearby.append((self.business_ids[slot].decode(), float(distances[i]),
+                               [offer_id.decode() for offer_id in self.offer_ids[start:end]]))
+        return nearby
+
+    def __len__(self):
+        return len(self.business_ids)
+
+
+class SharedSnapshot:
+    """
+    Reader side: the latest published snapshot at `path`, remapped when the
+    file is replaced. Listeners run once per newly seen generation, so
+    per-process caches built from older data can be dropped
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._view = None
+        self._stat = None
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def current(self):
+        """
+        The latest snapshot view, or None before the first publish
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return self._view
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if key == self._stat:
+            return self._view
+
+        with self._lock:
+            if key != self._stat:
+                previous = self._view
+                self._view = SnapshotView(self.path)
+                self._stat = key
+                if previous is None or previous.generation != self._view.generation:
+                    for callback in self._listeners:
+                        callback()
+        return self._view
+
+    @property
+    def generation(self):
+        view = self.current()
+        return view.generation if view is not None else 0
+
+
+class SnapshotPublisher:
+    """
+    Writer side: republishes the snapshot after writes made through this
+    process. A background thread waits for writes to go quiet, then takes
+    the cross-process lock and writes the next generation. The snapshot is
+    built from the shared storage backend, so writes made by any worker are
+    included.
+    Until that publish lands, the businesses this process wrote (or whose
+    offers it wrote) are reported by pending_businesses(), so readers can
+    answer for them from the live records instead of the mapped generation
+    """
+
+    def __init__(self, repository, path, delay=PUBLISH_DELAY_SECONDS, shard_map=None):
+        self.repository = repository
+        self.path = path
+        # Shard map of a shard node, whose snapshot holds only its own cells
+        self.shard_map = shard_map
+        self.delay = delay
+        self.publishes = 0
+        self._dirty = threading.Event()
+        self._thread = None
+        # business id -> sequence number of its latest local write
+        self._pending = {}
+        self._writes = 0
+        self._pending_lock = threading.Lock()
+        repository.add_write_listener(self._written)
+
+    def _written(self, changes):
+        with self._pending_lock:
+            self._writes += 1
+            for kind, record_id in changes:
+                if kind == 'business':
+                    self._pending[record_id] = self._writes
+        self._dirty.set()
+
+    def pending_businesses(self):
+        """
+        Ids of the businesses written through this process that the latest
+        generation it published may not reflect yet
+        """
+        with self._pending_lock:
+            return set(self._pending)
+
+    def _source(self):
+        backend = self.repository.backend
+        if self.shard_map is not None:
+            business_rows, offer_rows = load_owned_rows(self.shard_map, backend)
+        else:
+            business_rows, offer_rows = backend.load_businesses(), backend.load_offers()
+        businesses = [(row[0], row[6], row[7]) for row in business_rows if row[6] != 0 and row[7] != 0]
+        active_offers = [(row[0], row[1]) for row in offer_rows if row[6]]
+        return businesses, active_offers
+
+    def publish(self):
+        """
+        Build and publish the next generation; returns its number
+        """
+        with open(f"{self.path}.lock", 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # Writes are in the backend before their listeners run, so
+                # every write counted here is in the rows read below
+                with self._pending_lock:
+                    covered = self._writes
+                generation = read_generation(self.path) + 1
+                write_snapshot(self.path, build_columns(*self._source()), generation)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        with self._pending_lock:
+            self._pending = {business_id: write for business_id, write in self._pending.items() if write > covered}
+        self.publishes += 1
+        return generation
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._dirty.set()
+        self._thread = threading.Thread(target=self._run, name='snapshot-publisher', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._dirty.wait()
+            # Let a burst of writes finish before publishing once
+            deadline = time.monotonic() + MAX_PUBLISH_DELAY_SECONDS
+            while True:
+                self._dirty.clear()
+                time.sleep(self.delay)
+                if not self._dirty.is_set() or time.monotonic() >= deadline:
+                    break
+            try:
+                self.publish()
+            except Exception as e:
+                logging.error(f"Error publishing shared snapshot: {e}")
+
+
+def create_shared_snapshot(repository, path=None, shard_map=None):
+    """
+    (reader, publisher) for the SHARED_SNAPSHOT_PATH file, or (None, None)
+    when shared snapshots are disabled (the default) or the storage backend
+    is private to this process. shard_map keeps a shard node's snapshot to
+    its own cells
+    """
+    path = path or os.environ.get('SHARED_SNAPSHOT_PATH')
+    if not path:
+        return None, None
+    if not repository.backend.shared:
+        # Every worker would publish its own private records over the others'
+        logging.warning("SHARED_SNAPSHOT_PATH ignored: the storage backend is not shared between workers")
+        return None, None
+    return SharedSnapshot(path), SnapshotPublisher(repository, path, shard_map=shard_map)
@@ -0,0 +1,247 @@
+import math
+import os
+
+import numpy as np
+
+# Mean earth radius in meters (same value used by geofence.haversine_distance)
+EARTH_RADIUS_METERS = 6371000
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_METERS / 180
+
+
+class SpatialIndex:
+    """
+    Base class for spatial indexes over point locations.
+    Implementations only narrow the search down to candidate ids; callers are
+    expected to run the exact distance check on the returned candidates.
+    """
+
+    def insert(self, item_id, lat, lng):
+        raise NotImplementedError
+
+    def remove(self, item_id):
+        raise NotImplementedError
+
+    def query_radius(self, lat, lng, radius_meters):
+        raise NotImplementedError
+
+    def update(self, item_id, lat, lng):
+        self.remove(item_id)
+        self.insert(item_id, lat, lng)
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+class GridIndex(SpatialIndex):
+    """
+    Buckets points into fixed-size latitude/longitude cells.
+    A radius query visits only the cells overlapping the bounding box of the
+    search circle, so its cost depends on local density, not on the total
+    number of indexed points.
+    """
+
+    def __init__(self, cell_size_meters=500):
+        self.cell_size_meters = float(cell_size_meters)
+        self.cell_degrees = self.cell_size_meters / METERS_PER_DEGREE
+        self.columns = int(math.ceil(360.0 / self.cell_degrees))
+        self.rows = int(math.ceil(180.0 / self.cell_degrees))
+        self._cells = {}
+        self._locations = {}
+
+    def _row(self, lat):
+        return min(int((lat + 90.0) // self.cell_degrees), self.rows - 1)
+
+    def _column(self, lng):
+        return int(((lng + 180.0) % 360.0) // self.cell_degrees) % self.columns
+
+    def cell_for(self, lat, lng):
+        return (self._row(lat), self._column(lng))
+
+    def insert(self, item_id, lat, lng):
+        if item_id in self._locations:
+            self.remove(item_id)
+        cell = self.cell_for(lat, lng)
+        self._cells.setdefault(cell, set()).add(item_id)
+        self._locations[item_id] = (lat, lng, cell)
+
+    def remove(self, item_id):
+        location = self._locations.pop(item_id, None)
+        if location is None:
+            return
+        cell = location[2]
+        bucket = self._cells.get(cell)
+        if bucket is not None:
+            bucket.discard(item_id)
+            if not bucket:
+                del self._cells[cell]
+
+    def location(self, item_id):
+        location = self._locations.get(item_id)
+        return location[:2] if location else None
+
+    def _column_ranges(self, lng, dlng):
+        """
+        Column spans covering [lng - dlng, lng + dlng], split in two when the
+        range crosses the antimeridian.
+        """
+        if dlng >= 180.0:
+            return [(0, self.columns - 1)]
+        first = self._column(lng - dlng)
+        last = self._column(lng + dlng)
+        if first <= last:
+            return [(first, last)]
+        return [(first, self.columns - 1), (0, last)]
+
+    def query_radius(self, lat, lng, radius_meters):
+        """
+        Return the ids stored in every cell overlapping the search circle
+        """
+        dlat = radius_meters / METERS_PER_DEGREE
+        min_lat = max(lat - dlat, -90.0)
+        max_lat = min(lat + dlat, 90.0)
+
+        # Longitude degrees shrink towards the poles, use the widest latitude
+        widest = max(abs(min_lat), abs(max_lat))
+        cos_lat = math.cos(math.radians(widest))
+        if cos_lat < 1e-9 or max_lat >= 90.0 or min_lat <= -90.0:
+            dlng = 180.0
+        else:
+            dlng = dlat / cos_lat
+
+        first_row, last_row = self._row(min_lat), self._row(max_lat)
+        column_ranges = self._column_ranges(lng, dlng)
+        visited = (last_row - first_row + 1) * sum(b - a + 1 for a, b in column_ranges)
+
+        candidates = []
+        if visited > len(self._cells):
+            # Huge radius: walking the occupied cells is cheaper than the box
+            for (row, column), bucket in self._cells.items():
+                if first_row <= row <= last_row and any(a <= column <= b for a, b in column_ranges):
+                    candidates.extend(bucket)
+            return candidates
+
+        cells = self._cells
+        for row in range(first_row, last_row + 1):
+            for first_column, last_column in column_ranges:
+                for column in range(first_column, last_column + 1):
+                    bucket = cells.get((row, column))
+                    if bucket:
+                        candidates.extend(bucket)
+        return candidates
+
+    def __len__(self):
+        return len(self._locations)
+
+
+class CoordinateArray:
+    """
+    Point coordinates packed into contiguous float64 arrays, with radians and
+    cos(latitude) precomputed so batch haversine runs without per-item trig.
+    Removal swaps the last slot into the hole to keep the arrays dense.
+    """
+
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.ids = []
+        self._slots = {}
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        lat_rad = np.empty(capacity, dtype=np.float64)
+        lng_rad = np.empty(capacity, dtype=np.float64)
+        cos_lat = np.empty(capacity, dtype=np.float64)
+        if self.size:
+            lat_rad[:self.size] = self.lat_rad[:self.size]
+            lng_rad[:self.size] = self.lng_rad[:self.size]
+            cos_lat[:self.size] = self.cos_lat[:self.size]
+        self.lat_rad, self.lng_rad, self.cos_lat = lat_rad, lng_rad, cos_lat
+
+    def set(self, item_id, lat, lng):
+        slot = self._slots.get(item_id)
+        if slot is None:
+            if self.size == len(self.lat_rad):
+                self._allocate(max(1024, len(self.lat_rad) * 2))
+            slot = self.size
+            self.size += 1
+            self._slots[item_id] = slot
+            self.ids.append(item_id)
+        lat_rad = math.radians(lat)
+        self.lat_rad[slot] = lat_rad
+        self.lng_rad[slot] = math.radians(lng)
+        self.cos_lat[slot] = math.cos(lat_rad)
+
+    def set_many(self, item_ids, lats, lngs):
+        """
+        set() for many points, with one growth of the arrays and the trig
+        computed as array operations
+        """
+        slots = np.empty(len(item_ids), dtype=np.intp)
+        new_ids = [item_id for item_id in dict.fromkeys(item_ids) if item_id not in self._slots]
+        if self.size + len(new_ids) > len(self.lat_rad):
+            self._allocate(max(1024, len(self.lat_rad) * 2, self.size + len(new_ids)))
+        for item_id in new_ids:
+            self._slots[item_id] = self.size
+            self.ids.append(item_id)
+            self.size += 1
+        for i, item_id in enumerate(item_ids):
+            slots[i] = self._slots[item_id]
+
+        lat_rad = np.radians(np.asarray(lats, dtype=np.float64))
+        self.lat_rad[slots] = lat_rad
+        self.lng_rad[slots] = np.radians(np.asarray(lngs, dtype=np.float64))
+        self.cos_lat[slots] = np.cos(lat_rad)
+
+    def remove(self, item_id):
+        slot = self._slots.pop(item_id, None)
+        if slot is None:
+            return
+        last = self.size - 1
+        if slot != last:
+            moved_id = self.ids[last]
+            self.lat_rad[slot] = self.lat_rad[last]
+            self.lng_rad[slot] = self.lng_rad[last]
+            self.cos_lat[slot] = self.cos_lat[last]
+            self.ids[slot] = moved_id
+            self._slots[moved_id] = slot
+        self.ids.pop()
+        self.size = last
+
+    def slots_for(self, item_ids):
+        """
+        Slots of the given ids as an index array, skipping unknown ids
+        """
+        slots = self._slots
+        return np.fromiter((slots[i] for i in item_ids if i in slots), dtype=np.intp)
+
+    def columns(self, slots=None):
+        """
+        (lat_rad, lng_rad, cos_lat) for the given slots, or for every point
+        """
+        if slots is None:
+            size = self.size
+            return self.lat_rad[:size], self.lng_rad[:size], self.cos_lat[:size]
+        return self.lat_rad[slots], self.lng_rad[slots], self.cos_lat[slots]
+
+    def __contains__(self, item_id):
+        return item_id in self._slots
+
+    def __len__(self):
+        return self.size
+
+
+# Available implementations, selectable through the SPATIAL_INDEX env variable
+SPATIAL_INDEXES = {
+    'grid': GridIndex,
+}
+
+
+def create_spatial_index(kind=None, **options):
+    """
+    Build the configured spatial index (defaults to a 500m grid)
+    """
+    kind = kind or os.environ.get('SPATIAL_INDEX', 'grid')
+    if kind not in SPATIAL_INDEXES:
+        raise ValueError(f"Unknown spatial index: {kind}")
+    if kind == 'grid' and 'cell_size_meters' not in options:
+        options['cell_size_meters'] = float(os.environ.get('SPATIAL_INDEX_CELL_METERS', 500))
+    return SPATIAL_INDEXES[kind](**options)
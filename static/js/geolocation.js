@@ -174,6 +174,76 @@ class GeolocationManager {
 // Create global instance
 window.geoManager = new GeolocationManager();
 
+// Recent positions, sent to /api/nearby_offers so the server can prefetch
+// offers along the predicted path
+class PositionHistory {
+    constructor(maxPoints = 5, maxAgeMs = 2 * 60 * 1000) {
+        this.maxPoints = maxPoints;
+        this.maxAgeMs = maxAgeMs;
+        this.points = [];
+    }
+    
+    add(lat, lng, timestamp = Date.now()) {
+        const last = this.points[this.points.length - 1];
+        if (last && timestamp <= last.t) return;
+        this.points.push({ lat, lng, t: timestamp });
+        this.points = this.points.filter(point => timestamp - point.t <= this.maxAgeMs).slice(-this.maxPoints);
+    }
+    
+    // ?history= value (lat,lng,ms;... oldest first), or null with fewer than two points
+    toParam() {
+        if (this.points.length < 2) return null;
+        return this.points.map(point => `${point.lat.toFixed(6)},${point.lng.toFixed(6)},${point.t}`).join(';');
+    }
+}
+
+window.PositionHistory = PositionHistory;
+
+// Proximity notifications shown, reported to the server in batches for the
+// business analytics. A notification repeated for the same offer within
+// dedupeMs (the map re-notifies on every poll while in range) counts once
+class ProximityHitReporter {
+    constructor(delayMs = 5000, maxBatch = 100, dedupeMs = 5 * 60 * 1000) {
+        this.delayMs = delayMs;
+        this.maxBatch = maxBatch;
+        this.dedupeMs = dedupeMs;
+        this.pending = [];
+        this.reported = new Map(); // offer id -> time of its last report
+        this.timer = null;
+        window.addEventListener('pagehide', () => this.flush());
+    }
+    
+    add(offerId) {
+        const now = Date.now();
+        if (now - (this.reported.get(offerId) || 0) < this.dedupeMs) return;
+        this.reported.set(offerId, now);
+        this.pending.push(offerId);
+        if (this.pending.length >= this.maxBatch) {
+            this.flush();
+        } else if (!this.timer) {
+            this.timer = setTimeout(() => this.flush(), this.delayMs);
+        }
+    }
+    
+    flush() {
+        clearTimeout(this.timer);
+        this.timer = null;
+        if (this.pending.length === 0) return;
+        const body = JSON.stringify({ offer_ids: this.pending.splice(0, this.maxBatch) });
+        fetch('/api/analytics/proximity', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body,
+            keepalive: true
+        }).catch(error => console.error('Error reporting proximity hits:', error));
+        if (this.pending.length > 0) {
+            this.flush();
+        }
+    }
+}
+
+window.proximityHits = new ProximityHitReporter();
+
 // Notification manager for proximity alerts
 class ProximityNotificationManager {
     constructor() {
@@ -222,6 +292,8 @@ class ProximityNotificationManager {
             silent: false
         });
         
+        window.proximityHits.add(offer.id);
+        
         // Auto-close after 10 seconds
         setTimeout(() => {
             notification.close();
@@ -1,17 +1,43 @@
 // Global variables
 let userMap;
 let userMarker;
-let businessMarkers = [];
+let businessMarkers = new Map(); // business id -> { marker, business }
+let clusterLayer = null; // cluster markers of the current viewport
+let viewportRequest = 0; // sequence number of the latest viewport fetch
 let currentLocation = null;
+let lastRevision = 0; // last /api/changes revision applied
+let lastOffersLocation = null; // position of the last nearby offers fetch
+let lastOffersRadius = null;
+let displayedOffers = [];
+let positionHistory = new PositionHistory();
+let prefetch = null; // { lat, lng, valid_radius, radius, offers } from the last trajectory fetch
+
+// Skip refetching nearby offers while the user moved less than this (meters)
+const OFFERS_REFRESH_DISTANCE = 25;
 let searchRadius = 1000; // meters
+let searchQuery = ''; // text filter, offers are searched with /api/search_offers while set
+let offersRequest = 0; // sequence number of the latest offers fetch
+let searchInputTimer = null;
+
+// Wait after the last keystroke before searching (ms)
+const SEARCH_INPUT_DELAY = 300;
 let autoUpdateInterval;
 let notificationsEnabled = false;
+let geofenceStream = null; // EventSource pushing geofence enter/exit events
+let geofenceSessionId = null;
+let lastGeofencePosition = null;
+let positionWatchId = null;
+
+// Radius of the server-side geofences and the minimum move worth reporting (meters)
+const GEOFENCE_RADIUS = 100;
+const GEOFENCE_MIN_MOVE = 10;
 
 // Initialize map when page loads
 document.addEventListener('DOMContentLoaded', function() {
     initializeMap();
     setupEventListeners();
     requestLocationAndUpdate();
+    startGeofenceStream();
 });
 
 function initializeMap() {
@@ -37,6 +63,11 @@ function initializeMap() {
         iconSize: [15, 15],
         iconAnchor: [7, 7]
     });
+    
+    // Markers come from the server per viewport, clustered below high zoom
+    clusterLayer = L.layerGroup().addTo(userMap);
+    userMap.on('moveend', loadViewport);
+    loadViewport();
 }
 
 function setupEventListeners() {
@@ -53,6 +84,18 @@ function setupEventListeners() {
         }
     });
     
+    // Text search, sent once the user pauses typing
+    document.getElementById('offerSearch').addEventListener('input', function() {
+        clearTimeout(searchInputTimer);
+        searchInputTimer = setTimeout(() => {
+            searchQuery = this.value.trim();
+            prefetch = null;
+            if (currentLocation) {
+                updateNearbyOffers();
+            }
+        }, SEARCH_INPUT_DELAY);
+    });
+    
     // Auto-update toggle
     const autoUpdateToggle = document.getElementById('autoUpdate');
     autoUpdateToggle.addEventListener('change', function() {
@@ -127,68 +170,342 @@ function updateUserLocation(lat, lng) {
     document.getElementById('locationDetails').textContent = 
         `Lat: ${lat.toFixed(6)}, Lng: ${lng.toFixed(6)}`;
     
-    // Load nearby offers
-    updateNearbyOffers();
+    positionHistory.add(lat, lng);
     
-    // Load all businesses
-    loadBusinessMarkers();
+    // Inside the prefetched region the offers are filtered locally;
+    // otherwise reload only once the user actually moved
+    if (insidePrefetch(lat, lng)) {
+        showPrefetchedOffers();
+    } else if (prefetch || !lastOffersLocation || lastOffersRadius !== searchRadius ||
+        GeolocationManager.calculateDistance(lat, lng, lastOffersLocation.lat, lastOffersLocation.lng) > OFFERS_REFRESH_DISTANCE) {
+        updateNearbyOffers();
+    }
+    
+    // Apply business changes since the last sync
+    syncChanges();
+    
+    sendGeofencePosition(lat, lng);
 }
 
 function updateNearbyOffers() {
     if (!currentLocation) return;
     
-    const url = `/api/nearby_offers?lat=${currentLocation.lat}&lng=${currentLocation.lng}&radius=${searchRadius}`;
+    const requestId = ++offersRequest;
+    let url;
+    if (searchQuery) {
+        url = `/api/search_offers?q=${encodeURIComponent(searchQuery)}&lat=${currentLocation.lat}&lng=${currentLocation.lng}&radius=${searchRadius}&shape=normalized`;
+    } else {
+        url = `/api/nearby_offers?lat=${currentLocation.lat}&lng=${currentLocation.lng}&radius=${searchRadius}&shape=normalized`;
+        const history = positionHistory.toParam();
+        if (history) {
+            url += `&history=${history}`;
+        }
+    }
+    
+    lastOffersLocation = { ...currentLocation };
+    lastOffersRadius = searchRadius;
     
     fetch(url)
         .then(response => response.json())
         .then(data => {
+            // A newer fetch (moved, or the search changed) supersedes this one
+            if (requestId !== offersRequest) return;
             if (data.error) {
                 console.error('Error:', data.error);
                 return;
             }
             
-            displayOffers(data.offers);
+            if (data.prefetch) {
+                prefetch = { ...data.prefetch, radius: searchRadius, offers: expandNearbyOffers(data) };
+                showPrefetchedOffers();
+                return;
+            }
             
-            // Check for proximity notifications
-            checkProximityNotifications(data.offers);
+            prefetch = null;
+            showNearbyOffers(expandNearbyOffers(data));
         })
         .catch(error => {
             console.error('Error fetching offers:', error);
         });
 }
 
-function loadBusinessMarkers() {
-    // Clear existing business markers
-    businessMarkers.forEach(marker => userMap.removeLayer(marker));
-    businessMarkers = [];
+function showNearbyOffers(offers) {
+    displayedOffers = offers;
+    displayOffers(offers);
     
-    fetch('/api/businesses')
+    // Without a geofence stream, check proximity on the polled offers
+    if (!geofenceSessionId) {
+        checkProximityNotifications(offers);
+    }
+}
+
+// Whether the prefetched offers still cover every offer in range of a position
+function insidePrefetch(lat, lng) {
+    return prefetch !== null && prefetch.radius === searchRadius &&
+        GeolocationManager.calculateDistance(lat, lng, prefetch.lat, prefetch.lng) <= prefetch.valid_radius;
+}
+
+// Prefetched distances are from the prefetch center, recompute them from the user
+function showPrefetchedOffers() {
+    const offers = prefetch.offers
+        .map(offer => ({
+            ...offer,
+            distance: Math.round(GeolocationManager.calculateDistance(
+                currentLocation.lat, currentLocation.lng, offer.business_lat, offer.business_lng) * 100) / 100
+        }))
+        .filter(offer => offer.distance <= searchRadius)
+        .sort((a, b) => a.distance - b.distance);
+    showNearbyOffers(offers);
+}
+
+// The normalized response lists each business once; join it back into
+// the flat offer objects the list and notifications use
+function expandNearbyOffers(data) {
+    const businesses = new Map(data.businesses.map(business => [business.id, business]));
+    return data.offers.map(offer => {
+        const business = businesses.get(offer.business_id);
+        return {
+            ...offer,
+            business_name: business.name,
+            business_address: business.address,
+            business_phone: business.phone,
+            business_lat: business.latitude,
+            business_lng: business.longitude,
+            distance: business.distance
+        };
+    });
+}
+
+// Clusters, or the businesses themselves when zoomed in, for the visible
+// area; the payload stays bounded however many businesses exist
+function loadViewport() {
+    const requestId = ++viewportRequest;
+    const bounds = userMap.getBounds();
+    const west = wrapLongitude(bounds.getWest());
+    const east = wrapLongitude(bounds.getEast());
+    const bbox = bounds.getEast() - bounds.getWest() >= 360
+        ? `-180,${bounds.getSouth()},180,${bounds.getNorth()}`
+        : `${west},${bounds.getSouth()},${east},${bounds.getNorth()}`;
+    
+    fetch(`/api/businesses/viewport?bbox=${bbox}&zoom=${userMap.getZoom()}`)
         .then(response => response.json())
         .then(data => {
+            // A newer pan or zoom already asked for another viewport
+            if (requestId !== viewportRequest) return;
             if (data.error) {
                 console.error('Error:', data.error);
                 return;
             }
             
-            data.businesses.forEach(business => {
-                const marker = L.marker([business.latitude, business.longitude], { 
-                    icon: businessIcon 
-                })
-                .addTo(userMap)
-                .bindPopup(`
-                    <strong>${business.name}</strong><br>
-                    ${business.address}<br>
-                    <small>${business.offers_count} ofertas activas</small>
-                `);
-                
-                businessMarkers.push(marker);
-            });
+            renderViewport(data);
+            if (lastRevision === 0) {
+                lastRevision = data.revision;
+            }
         })
         .catch(error => {
-            console.error('Error fetching businesses:', error);
+            console.error('Error fetching map viewport:', error);
         });
 }
 
+function wrapLongitude(lng) {
+    return ((lng + 180) % 360 + 360) % 360 - 180;
+}
+
+function renderViewport(data) {
+    clusterLayer.clearLayers();
+    data.clusters.forEach(cluster => {
+        if (cluster.count === 1) {
+            L.marker([cluster.lat, cluster.lng], { icon: businessIcon }).addTo(clusterLayer);
+            return;
+        }
+        L.marker([cluster.lat, cluster.lng], { icon: clusterIcon(cluster.count) })
+            .addTo(clusterLayer)
+            .on('click', () => userMap.setView([cluster.lat, cluster.lng], data.zoom + 2));
+    });
+    
+    // Individual businesses only come at high zoom
+    const listed = new Set(data.businesses.map(business => business.id));
+    businessMarkers.forEach((entry, id) => {
+        if (!listed.has(id)) {
+            removeBusinessMarker(id);
+        }
+    });
+    data.businesses.forEach(business => upsertBusinessMarker(business));
+}
+
+function clusterIcon(count) {
+    const size = count < 100 ? 30 : count < 1000 ? 38 : 46;
+    return L.divIcon({
+        className: 'business-cluster',
+        html: `<div style="background: rgba(40,167,69,0.85); color: white; width: ${size}px; height: ${size}px; line-height: ${size}px; border-radius: 50%; border: 2px solid white; text-align: center; font-size: 12px; font-weight: bold;">${count}</div>`,
+        iconSize: [size, size],
+        iconAnchor: [size / 2, size / 2]
+    });
+}
+
+function syncChanges() {
+    // The first viewport response sets the revision to sync from, so the
+    // client never asks for a full snapshot of every business
+    if (lastRevision === 0) return;
+    
+    fetch(`/api/changes?since=${lastRevision}`)
+        .then(response => response.json())
+        .then(data => {
+            if (data.error) {
+                console.error('Error:', data.error);
+                return;
+            }
+            
+            applyBusinessChanges(data.businesses, data.reset);
+            applyOfferChanges(data.offers, data.businesses, data.reset);
+            lastRevision = data.revision;
+        })
+        .catch(error => {
+            console.error('Error fetching changes:', error);
+        });
+}
+
+function applyBusinessChanges(changes, reset) {
+    // Clusters are aggregated server-side, reload the viewport on any change
+    if (reset || changes.removed.length > 0 || changes.upserted.length > 0) {
+        loadViewport();
+    }
+}
+
+function businessPopup(business) {
+    return `
+        <strong>${business.name}</strong><br>
+        ${business.address}<br>
+        <small>${business.offers_count} ofertas activas</small>
+    `;
+}
+
+function upsertBusinessMarker(business) {
+    const entry = businessMarkers.get(business.id);
+    if (entry) {
+        entry.marker.setLatLng([business.latitude, business.longitude]);
+        entry.marker.setPopupContent(businessPopup(business));
+        entry.business = business;
+        return;
+    }
+    
+    const marker = L.marker([business.latitude, business.longitude], { 
+        icon: businessIcon 
+    })
+    .addTo(userMap)
+    .bindPopup(businessPopup(business));
+    
+    businessMarkers.set(business.id, { marker, business });
+}
+
+function removeBusinessMarker(id) {
+    const entry = businessMarkers.get(id);
+    if (entry) {
+        userMap.removeLayer(entry.marker);
+        businessMarkers.delete(id);
+    }
+}
+
+function applyOfferChanges(offerChanges, businessChanges, reset) {
+    if (!currentLocation) return;
+    
+    if (reset) {
+        updateNearbyOffers();
+        return;
+    }
+    
+    const inRange = (lat, lng) => lat !== null && lng !== null &&
+        GeolocationManager.calculateDistance(currentLocation.lat, currentLocation.lng, lat, lng) <= searchRadius;
+    const listed = new Set(displayedOffers.map(offer => offer.id));
+    const listedBusinesses = new Set(displayedOffers.map(offer => offer.business_id));
+    const touched = offerChanges.upserted.filter(offer =>
+        listed.has(offer.id) || inRange(offer.business_lat, offer.business_lng));
+    
+    // Upserts carry their business position, the rest of the business comes
+    // from the changed businesses or the offers already held. Refetch only
+    // when that is not enough: a text search decides what matches, and a
+    // business that moved into range brings offers the delta does not list
+    const businesses = heldBusinesses(businessChanges);
+    if (touched.some(offer => searchQuery || !businesses.has(offer.business_id)) ||
+        businessChanges.upserted.some(business => business.offers_count > 0 &&
+            !listedBusinesses.has(business.id) && inRange(business.latitude, business.longitude))) {
+        updateNearbyOffers();
+        return;
+    }
+    
+    // Prefetched offers are measured from the prefetch center, the listed
+    // ones from where they were fetched
+    if (prefetch) {
+        prefetch.offers = patchOffers(prefetch.offers, offerChanges, businessChanges, businesses,
+            prefetch.lat, prefetch.lng, prefetch.valid_radius + prefetch.radius);
+        if (insidePrefetch(currentLocation.lat, currentLocation.lng)) {
+            showPrefetchedOffers();
+            return;
+        }
+    }
+    if (!lastOffersLocation) return;
+    const offers = patchOffers(displayedOffers, offerChanges, businessChanges, businesses,
+        lastOffersLocation.lat, lastOffersLocation.lng, searchRadius);
+    if (offers.length !== displayedOffers.length || offers.some((offer, i) => offer !== displayedOffers[i])) {
+        showNearbyOffers(offers);
+    }
+}
+
+// Business details by id: from the businesses changed in this delta,
+// else from the offers listed or prefetched
+function heldBusinesses(businessChanges) {
+    const businesses = new Map();
+    const held = prefetch ? displayedOffers.concat(prefetch.offers) : displayedOffers;
+    held.forEach(offer => businesses.set(offer.business_id, {
+        name: offer.business_name,
+        address: offer.business_address,
+        phone: offer.business_phone
+    }));
+    businessChanges.upserted.forEach(business => businesses.set(business.id, business));
+    return businesses;
+}
+
+// The flat offers list after a delta: removed offers and the offers of
+// removed businesses dropped, upserts replaced or added, every offer
+// joined to its business, measured from lat/lng and kept within radius.
+// Offers the delta leaves alone are returned as the same objects
+function patchOffers(offers, offerChanges, businessChanges, businesses, lat, lng, radius) {
+    const removedOffers = new Set(offerChanges.removed);
+    const removedBusinesses = new Set(businessChanges.removed);
+    const changedBusinesses = new Set(businessChanges.upserted.map(business => business.id));
+    const upserted = new Map(offerChanges.upserted.map(offer => [offer.id, offer]));
+    
+    const patched = offers
+        .filter(offer => !removedOffers.has(offer.id) && !upserted.has(offer.id) &&
+            !removedBusinesses.has(offer.business_id))
+        .map(offer => changedBusinesses.has(offer.business_id)
+            ? joinBusiness(offer, businesses.get(offer.business_id), lat, lng)
+            : offer);
+    upserted.forEach(offer => {
+        const business = businesses.get(offer.business_id);
+        if (business && offer.business_lat !== null && offer.business_lng !== null) {
+            patched.push(joinBusiness(offer, business, lat, lng));
+        }
+    });
+    return patched
+        .filter(offer => offer.distance <= radius)
+        .sort((a, b) => a.distance - b.distance);
+}
+
+function joinBusiness(offer, business, lat, lng) {
+    const businessLat = business.latitude ?? offer.business_lat;
+    const businessLng = business.longitude ?? offer.business_lng;
+    return {
+        ...offer,
+        business_name: business.name,
+        business_address: business.address,
+        business_phone: business.phone,
+        business_lat: businessLat,
+        business_lng: businessLng,
+        distance: Math.round(GeolocationManager.calculateDistance(lat, lng, businessLat, businessLng) * 100) / 100
+    };
+}
+
 function displayOffers(offers) {
     const offersContainer = document.getElementById('offersList');
     const offersCount = document.getElementById('offersCount');
@@ -244,6 +561,94 @@ function displayOffers(offers) {
     });
 }
 
+function startGeofenceStream() {
+    if (!('EventSource' in window)) return;
+    
+    openGeofenceStream();
+    
+    // Geofence updates are cheap, report positions as they arrive
+    if (navigator.geolocation && positionWatchId === null) {
+        positionWatchId = navigator.geolocation.watchPosition(
+            position => sendGeofencePosition(position.coords.latitude, position.coords.longitude),
+            error => console.log('Geofence watch error:', error),
+            { enableHighAccuracy: true, maximumAge: 10000 }
+        );
+    }
+}
+
+function openGeofenceStream() {
+    geofenceStream = new EventSource(`/api/geofence/stream?radius=${GEOFENCE_RADIUS}`);
+    
+    // Sent on every (re)connection, each connection gets a fresh session
+    geofenceStream.addEventListener('session', function(event) {
+        geofenceSessionId = JSON.parse(event.data).session_id;
+        lastGeofencePosition = null;
+        if (currentLocation) {
+            sendGeofencePosition(currentLocation.lat, currentLocation.lng);
+        }
+    });
+    
+    geofenceStream.addEventListener('enter', function(event) {
+        const business = JSON.parse(event.data);
+        if (!notificationsEnabled) return;
+        
+        business.offers.forEach(offer => showNotification({
+            ...offer,
+            business_name: business.business_name,
+            business_lat: business.business_lat,
+            business_lng: business.business_lng
+        }));
+    });
+    
+    geofenceStream.onerror = function() {
+        // EventSource reconnects on its own and announces a new session;
+        // a refused stream (server busy) is closed for good, keep polling
+        geofenceSessionId = null;
+        if (geofenceStream.readyState === EventSource.CLOSED) {
+            geofenceStream = null;
+            if (positionWatchId !== null) {
+                navigator.geolocation.clearWatch(positionWatchId);
+                positionWatchId = null;
+            }
+        }
+    };
+}
+
+// The server no longer knows the session (its stream was dropped or the
+// worker serving it is gone): open a new stream, which reports the
+// position again once its session is announced
+function reopenGeofenceStream() {
+    if (!geofenceStream) return;
+    geofenceStream.close();
+    geofenceSessionId = null;
+    openGeofenceStream();
+}
+
+function sendGeofencePosition(lat, lng) {
+    if (!geofenceSessionId) return;
+    if (lastGeofencePosition && GeolocationManager.calculateDistance(
+            lat, lng, lastGeofencePosition.lat, lastGeofencePosition.lng) < GEOFENCE_MIN_MOVE) {
+        return;
+    }
+    
+    lastGeofencePosition = { lat, lng };
+    const sessionId = geofenceSessionId;
+    fetch('/api/geofence/position', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ session_id: sessionId, lat, lng })
+    })
+    .then(response => {
+        // Ignore answers about a session already replaced
+        if (response.status === 404 && sessionId === geofenceSessionId) {
+            reopenGeofenceStream();
+        }
+    })
+    .catch(error => {
+        console.error('Error sending geofence position:', error);
+    });
+}
+
 function checkProximityNotifications(offers) {
     if (!notificationsEnabled || !currentLocation) return;
     
@@ -261,6 +666,7 @@ function showNotification(offer) {
             icon: '/static/favicon.ico',
             tag: `offer-${offer.id}` // Prevent duplicate notifications
         });
+        window.proximityHits.add(offer.id);
         
         notification.onclick = function() {
             window.focus();
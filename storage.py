@@ -0,0 +1,679 @@
+import json
+import math
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from spatial_index import METERS_PER_DEGREE
+
+# Column order of the rows handed to Business(*row) and Offer(*row)
+BUSINESS_COLUMNS = ('id', 'email', 'name', 'password_hash', 'phone', 'address', 'latitude', 'longitude')
+OFFER_COLUMNS = ('id', 'business_id', 'title', 'description', 'discount_percentage', 'valid_until',
+                 'is_active', 'category')
+PROFILE_COLUMNS = ('id', 'interests', 'min_discount', 'max_distance', 'favorite_businesses', 'excluded_businesses')
+# Profile columns holding sets, stored as JSON arrays
+PROFILE_SET_COLUMNS = ('interests', 'favorite_businesses', 'excluded_businesses')
+# Table holding the records of each id sequence
+SEQUENCE_TABLES = {'business': 'businesses', 'offer': 'offers'}
+# Entries kept in the record_changes log; a process further behind reloads
+CHANGE_LOG_RETAIN = int(os.environ.get('CHANGE_LOG_RETAIN', 100000))
+# Ids bound per IN (...) query, below SQLite's limit on host parameters
+MAX_QUERY_VARIABLES = 900
+# Relayed geofence positions kept; readers poll far more often than this fills
+GEOFENCE_POSITIONS_RETAIN = 10000
+
+
+class DuplicateRecord(ValueError):
+    """
+    Raised when a new record's id or email is already stored, possibly by
+    another process sharing the backend
+    """
+
+
+def business_row(business):
+    return tuple(getattr(business, column) for column in BUSINESS_COLUMNS)
+
+
+def offer_row(offer):
+    return tuple(getattr(offer, column) for column in OFFER_COLUMNS)
+
+
+def profile_row(profile):
+    return tuple(json.dumps(sorted(getattr(profile, column))) if column in PROFILE_SET_COLUMNS
+                 else getattr(profile, column) for column in PROFILE_COLUMNS)
+
+
+def bounding_box(lat, lng, radius_meters):
+    """
+    (min_lat, max_lat, min_lng, max_lng) enclosing the search circle,
+    clamped to the valid range (the box does not wrap the antimeridian)
+    """
+    dlat = radius_meters / METERS_PER_DEGREE
+    min_lat, max_lat = max(lat - dlat, -90.0), min(lat + dlat, 90.0)
+    cos_lat = math.cos(math.radians(max(abs(min_lat), abs(max_lat))))
+    if cos_lat < 1e-9 or min_lat <= -90.0 or max_lat >= 90.0:
+        return min_lat, max_lat, -180.0, 180.0
+    dlng = dlat / cos_lat
+    return min_lat, max_lat, max(lng - dlng, -180.0), min(lng + dlng, 180.0)
+
+
+class StorageBackend:
+    """
+    Base class for the durable store behind the in-memory repository.
+    The repository writes every change through to the backend and loads its
+    contents on startup. Rows use the BUSINESS_COLUMNS / OFFER_COLUMNS order.
+    """
+
+    # Whether get_nearby_offers should run its coarse spatial filter here
+    spatial_queries = False
+    # Whether other processes see the same data (shared snapshots are then
+    # built from the backend instead of this process's repository)
+    shared = False
+
+    def load_businesses(self):
+        return []
+
+    def load_offers(self):
+        return []
+
+    def business_rows(self, business_ids):
+        """
+        Rows of the given businesses, for records written by other processes
+        """
+        return []
+
+    def offer_rows(self, offer_ids):
+        return []
+
+    def business_offer_rows(self, business_ids):
+        """
+        Rows of every offer of the given businesses
+        """
+        return []
+
+    def has_located_businesses(self, min_lat, max_lat, min_lng, max_lng):
+        """
+        Whether any business with a location lies inside the box
+        """
+        return any(min_lat <= row[6] <= max_lat and min_lng <= row[7] <= max_lng
+                   for row in self.load_businesses() if row[6] != 0 and row[7] != 0)
+
+    def located_business_rows(self, boxes):
+        """
+        Rows of the businesses with a location inside any of the
+        (min_lat, max_lat, min_lng, max_lng) boxes, each business once
+        """
+        return [row for row in self.load_businesses() if row[6] != 0 and row[7] != 0 and any(
+            min_lat <= row[6] <= max_lat and min_lng <= row[7] <= max_lng
+            for min_lat, max_lat, min_lng, max_lng in boxes)]
+
+    def unlocated_business_rows(self):
+        """
+        Rows of the businesses without a location
+        """
+        return [row for row in self.load_businesses() if row[6] == 0 or row[7] == 0]
+
+    def allocate_ids(self, kind, count=1):
+        """
+        count new ids for 'business' or 'offer' records, unique across every
+        process sharing the backend, or None when ids are this process's
+        own to hand out
+        """
+        return None
+
+    def insert_businesses(self, businesses):
+        """
+        Write new businesses; an id already stored is an error, never
+        overwritten
+        """
+
+    def save_business(self, business):
+        """
+        Write an existing business back after an update
+        """
+
+    def insert_offers(self, offers):
+        pass
+
+    def save_offer(self, offer):
+        pass
+
+    def delete_offer(self, offer_id):
+        pass
+
+    def save_profile(self, profile):
+        pass
+
+    def load_profile(self, profile_id):
+        """
+        Row of a preference profile in PROFILE_COLUMNS order, sets as lists,
+        or None
+        """
+        return None
+
+    def change_revision(self):
+        """
+        Revision of the latest write in the backend's change log
+        """
+        return 0
+
+    def changes_since(self, revision):
+        """
+        (latest revision, set of (kind, id)) of the records written after
+        revision by any process, or None when the log no longer reaches
+        back that far
+        """
+        return revision, set()
+
+    def nearby_offer_rows(self, lat, lng, radius_meters):
+        """
+        Active offers of the businesses inside the bounding box of the search
+        circle, as (business row, offer row) pairs. Callers run the exact
+        distance check.
+        """
+        raise NotImplementedError
+
+    def touch_geofence_sessions(self, session_ids):
+        """
+        Record that this process serves the streams of these geofence
+        sessions, so other processes relay their positions
+        """
+
+    def drop_geofence_session(self, session_id):
+        pass
+
+    def relay_geofence_position(self, session_id, lat, lng, max_age_seconds):
+        """
+        Queue a position for a session whose stream another process serves.
+        Returns False when no process touched the session within
+        max_age_seconds
+        """
+        return False
+
+    def geofence_positions_since(self, position_id):
+        """
+        (latest position id, [(session id, lat, lng), ...]) relayed after
+        position_id, oldest first
+        """
+        return position_id, []
+
+    def close(self):
+        pass
+
+
+class MemoryBackend(StorageBackend):
+    """
+    No durable storage: data lives only in the repository and is lost on
+    restart. The default, suitable for development.
+    """
+
+
+class ConnectionPool:
+    """
+    Fixed set of SQLite connections shared between threads.
+    Connections are created lazily up to `size`; callers block until one
+    is returned when all are in use.
+    """
+
+    def __init__(self, connect, size=4):
+        self._connect = connect
+        self._idle = queue.LifoQueue()
+        self._slots = threading.Semaphore(size)
+        self._connections = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+                with self._lock:
+                    self._connections.append(conn)
+            try:
+                yield conn
+            finally:
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._idle = queue.LifoQueue()
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    SQLite store with a spatial index on business locations.
+    Uses an R*Tree virtual table when the SQLite build has the module and
+    falls back to a (latitude, longitude) B-tree index otherwise; either way
+    nearby queries only read the rows inside the search bounding box.
+    """
+
+    def __init__(self, path='geoofertas.db', pool_size=4, spatial_queries=True):
+        self.path = path
+        # A private in-memory database exists per connection, so share one
+        if path == ':memory:':
+            pool_size = 1
+        self.pool = ConnectionPool(self._connect, pool_size)
+        self.spatial_queries = spatial_queries
+        self.shared = path != ':memory:'
+        self.rtree = False
+        self._create_schema()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA foreign_keys=ON')
+        return conn
+
+    def _create_schema(self):
+        with self.pool.connection() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS businesses (
+                    id TEXT PRIMARY KEY,
+                    email TEXT NOT NULL UNIQUE,
+                    name TEXT NOT NULL,
+                    password_hash TEXT NOT NULL,
+                    phone TEXT,
+                    address TEXT,
+                    latitude REAL NOT NULL DEFAULT 0,
+                    longitude REAL NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS businesses_location ON businesses (latitude, longitude);
+                CREATE INDEX IF NOT EXISTS businesses_unlocated ON businesses (id)
+                    WHERE latitude = 0 OR longitude = 0;
+
+                CREATE TABLE IF NOT EXISTS offers (
+                    id TEXT PRIMARY KEY,
+                    business_id TEXT NOT NULL REFERENCES businesses (id),
+                    title TEXT NOT NULL,
+                    description TEXT NOT NULL,
+                    discount_percentage INTEGER NOT NULL,
+                    valid_until TEXT NOT NULL,
+                    is_active INTEGER NOT NULL DEFAULT 1,
+                    category TEXT NOT NULL DEFAULT 'OTHER'
+                );
+                CREATE INDEX IF NOT EXISTS offers_active_by_business ON offers (business_id, is_active);
+
+                -- Last id handed out per record kind, shared by every process
+                CREATE TABLE IF NOT EXISTS id_sequences (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                );
+
+                CREATE TABLE IF NOT EXISTS preference_profiles (
+                    id TEXT PRIMARY KEY,
+                    interests TEXT NOT NULL,
+                    min_discount INTEGER NOT NULL,
+                    max_distance INTEGER NOT NULL,
+                    favorite_businesses TEXT NOT NULL,
+                    excluded_businesses TEXT NOT NULL
+                );
+
+                -- Geofence sessions with an open stream in some process, and the
+                -- positions posted to other processes for them
+                CREATE TABLE IF NOT EXISTS geofence_sessions (
+                    id TEXT PRIMARY KEY,
+                    seen_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS geofence_positions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT NOT NULL,
+                    latitude REAL NOT NULL,
+                    longitude REAL NOT NULL
+                );
+
+                -- Records written by any process, so the others can reload them
+                CREATE TABLE IF NOT EXISTS record_changes (
+                    revision INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    record_id TEXT NOT NULL
+                );
+            """)
+            # Existing databases continue after their highest stored id; from
+            # then on deleting a record never makes its id available again
+            for kind, table in SEQUENCE_TABLES.items():
+                conn.execute(f"""
+                    INSERT OR IGNORE INTO id_sequences (name, value)
+                    SELECT ?, COALESCE(MAX(CAST(id AS INTEGER)), 0) FROM {table} WHERE id NOT GLOB '*[^0-9]*'
+                """, (kind,))
+            try:
+                # R*Tree keyed on the businesses rowid, one degenerate box per point
+                conn.execute("""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS business_locations
+                    USING rtree(id, min_lat, max_lat, min_lng, max_lng)
+                """)
+                self.rtree = True
+            except sqlite3.OperationalError:
+                self.rtree = False
+
+    @contextmanager
+    def transaction(self):
+        with self.pool.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    @contextmanager
+    def inserting(self):
+        """
+        Transaction for new records, with unique key violations raised as
+        DuplicateRecord
+        """
+        try:
+            with self.transaction() as conn:
+                yield conn
+        except sqlite3.IntegrityError as e:
+            if 'UNIQUE' in str(e):
+                raise DuplicateRecord(str(e)) from e
+            raise
+
+    # Loading
+
+    def load_businesses(self):
+        with self.pool.connection() as conn:
+            return conn.execute(f"SELECT {', '.join(BUSINESS_COLUMNS)} FROM businesses ORDER BY rowid").fetchall()
+
+    def load_offers(self):
+        with self.pool.connection() as conn:
+            rows = conn.execute(f"SELECT {', '.join(OFFER_COLUMNS)} FROM offers ORDER BY rowid").fetchall()
+        return [row[:6] + (bool(row[6]),) + row[7:] for row in rows]
+
+    def _rows_matching(self, query, values):
+        """
+        Rows of `query`, whose single IN list is written as {}, over values
+        split into chunks below SQLite's variable limit
+        """
+        values = list(values)
+        rows = []
+        with self.pool.connection() as conn:
+            for start in range(0, len(values), MAX_QUERY_VARIABLES):
+                chunk = values[start:start + MAX_QUERY_VARIABLES]
+                rows.extend(conn.execute(query.format(', '.join('?' * len(chunk))), chunk).fetchall())
+        return rows
+
+    def business_rows(self, business_ids):
+        return self._rows_matching(f"SELECT {', '.join(BUSINESS_COLUMNS)} FROM businesses WHERE id IN ({{}})",
+                                   business_ids)
+
+    def offer_rows(self, offer_ids):
+        rows = self._rows_matching(f"SELECT {', '.join(OFFER_COLUMNS)} FROM offers WHERE id IN ({{}})", offer_ids)
+        return [row[:6] + (bool(row[6]),) + row[7:] for row in rows]
+
+    def business_offer_rows(self, business_ids):
+        rows = self._rows_matching(f"SELECT {', '.join(OFFER_COLUMNS)} FROM offers WHERE business_id IN ({{}})",
+                                   business_ids)
+        return [row[:6] + (bool(row[6]),) + row[7:] for row in rows]
+
+    # Region queries, read through the spatial index
+
+    def _box_filter(self):
+        if self.rtree:
+            return """
+                FROM business_locations r
+                JOIN businesses b ON b.rowid = r.id
+                WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lng >= ? AND r.min_lng <= ?
+            """
+        return """
+            FROM businesses b
+            WHERE b.latitude BETWEEN ? AND ? AND b.longitude BETWEEN ? AND ?
+              AND b.latitude != 0 AND b.longitude != 0
+        """
+
+    def has_located_businesses(self, min_lat, max_lat, min_lng, max_lng):
+        with self.pool.connection() as conn:
+            return conn.execute(f"SELECT 1 {self._box_filter()} LIMIT 1",
+                                (min_lat, max_lat, min_lng, max_lng)).fetchone() is not None
+
+    def located_business_rows(self, boxes):
+        business_columns = ', '.join(f'b.{column}' for column in BUSINESS_COLUMNS)
+        rows = {}
+        with self.pool.connection() as conn:
+            for box in boxes:
+                for row in conn.execute(f"SELECT {business_columns} {self._box_filter()}", box):
+                    rows[row[0]] = row
+        return list(rows.values())
+
+    def unlocated_business_rows(self):
+        with self.pool.connection() as conn:
+            return conn.execute(f"""
+                SELECT {', '.join(BUSINESS_COLUMNS)} FROM businesses WHERE latitude = 0 OR longitude = 0
+            """).fetchall()
+
+    # Ids
+
+    def allocate_ids(self, kind, count=1):
+        with self.transaction() as conn:
+            conn.execute("UPDATE id_sequences SET value = value + ? WHERE name = ?", (count, kind))
+            last = conn.execute("SELECT value FROM id_sequences WHERE name = ?", (kind,)).fetchone()[0]
+        return [str(value) for value in range(last - count + 1, last + 1)]
+
+    def _advance_sequence(self, conn, kind, record_ids):
+        # Records stored with ids of their own keep allocations past them
+        numeric = [int(record_id) for record_id in record_ids if record_id.isdigit()]
+        if numeric:
+            conn.execute("UPDATE id_sequences SET value = MAX(value, ?) WHERE name = ?", (max(numeric), kind))
+
+    # Writes, batched with executemany in one transaction. New records use a
+    # plain INSERT so an id collision raises instead of replacing a row
+
+    def insert_businesses(self, businesses):
+        rows = [business_row(business) for business in businesses]
+        if not rows:
+            return
+        with self.inserting() as conn:
+            conn.executemany(f"""
+                INSERT INTO businesses ({', '.join(BUSINESS_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+            if self.rtree:
+                self._index_locations(conn, rows)
+            self._advance_sequence(conn, 'business', [row[0] for row in rows])
+            self._log_changes(conn, 'business', [row[0] for row in rows])
+
+    def save_business(self, business):
+        row = business_row(business)
+        with self.transaction() as conn:
+            conn.execute("""
+                INSERT INTO businesses (id, email, name, password_hash, phone, address, latitude, longitude)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    email = excluded.email, name = excluded.name, password_hash = excluded.password_hash,
+                    phone = excluded.phone, address = excluded.address,
+                    latitude = excluded.latitude, longitude = excluded.longitude
+            """, row)
+            if self.rtree:
+                self._index_locations(conn, [row])
+            self._log_changes(conn, 'business', [row[0]])
+
+    def _index_locations(self, conn, rows):
+        located = [(row[6], row[6], row[7], row[7], row[0]) for row in rows if row[6] != 0 and row[7] != 0]
+        unlocated = [(row[0],) for row in rows if row[6] == 0 or row[7] == 0]
+        if located:
+            conn.executemany("""
+                INSERT OR REPLACE INTO business_locations (id, min_lat, max_lat, min_lng, max_lng)
+                SELECT rowid, ?, ?, ?, ? FROM businesses WHERE id = ?
+            """, located)
+        if unlocated:
+            conn.executemany("""
+                DELETE FROM business_locations WHERE id = (SELECT rowid FROM businesses WHERE id = ?)
+            """, unlocated)
+
+    def insert_offers(self, offers):
+        rows = [offer_row(offer) for offer in offers]
+        if not rows:
+            return
+        with self.inserting() as conn:
+            conn.executemany(f"""
+                INSERT INTO offers ({', '.join(OFFER_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+            self._advance_sequence(conn, 'offer', [row[0] for row in rows])
+            self._log_changes(conn, 'offer', [row[0] for row in rows])
+
+    def save_offer(self, offer):
+        with self.transaction() as conn:
+            conn.execute("""
+                INSERT INTO offers (id, business_id, title, description, discount_percentage, valid_until,
+                                    is_active, category)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    title = excluded.title, description = excluded.description,
+                    discount_percentage = excluded.discount_percentage, valid_until = excluded.valid_until,
+                    is_active = excluded.is_active, category = excluded.category
+            """, offer_row(offer))
+            self._log_changes(conn, 'offer', [offer.id])
+
+    def delete_offer(self, offer_id):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM offers WHERE id = ?", (offer_id,))
+            self._log_changes(conn, 'offer', [offer_id])
+
+    # Preference profiles
+
+    def save_profile(self, profile):
+        with self.transaction() as conn:
+            conn.execute(f"""
+                INSERT OR REPLACE INTO preference_profiles ({', '.join(PROFILE_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?)
+            """, profile_row(profile))
+
+    def load_profile(self, profile_id):
+        with self.pool.connection() as conn:
+            row = conn.execute(f"SELECT {', '.join(PROFILE_COLUMNS)} FROM preference_profiles WHERE id = ?",
+                               (profile_id,)).fetchone()
+        if row is None:
+            return None
+        return tuple(json.loads(value) if column in PROFILE_SET_COLUMNS else value
+                     for column, value in zip(PROFILE_COLUMNS, row))
+
+    # Change log
+
+    def _log_changes(self, conn, kind, record_ids):
+        conn.executemany("INSERT INTO record_changes (kind, record_id) VALUES (?, ?)",
+                         [(kind, record_id) for record_id in record_ids])
+        revision = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+        # Trim now and then rather than on every write
+        if revision % 1000 < len(record_ids):
+            conn.execute("DELETE FROM record_changes WHERE revision <= ?", (revision - CHANGE_LOG_RETAIN,))
+
+    def change_revision(self):
+        with self.pool.connection() as conn:
+            return conn.execute("SELECT COALESCE(MAX(revision), 0) FROM record_changes").fetchone()[0]
+
+    def changes_since(self, revision):
+        with self.pool.connection() as conn:
+            conn.execute('BEGIN')
+            try:
+                oldest = conn.execute("SELECT MIN(revision) FROM record_changes").fetchone()[0]
+                if oldest is not None and oldest > revision + 1:
+                    return None
+                rows = conn.execute(
+                    "SELECT revision, kind, record_id FROM record_changes WHERE revision > ? ORDER BY revision",
+                    (revision,)
+                ).fetchall()
+            finally:
+                conn.execute('COMMIT')
+        if not rows:
+            return revision, set()
+        return rows[-1][0], {(kind, record_id) for _, kind, record_id in rows}
+
+    # Spatial query
+
+    def nearby_offer_rows(self, lat, lng, radius_meters):
+        min_lat, max_lat, min_lng, max_lng = bounding_box(lat, lng, radius_meters)
+        business_columns = ', '.join(f'b.{column}' for column in BUSINESS_COLUMNS)
+        offer_columns = ', '.join(f'o.{column}' for column in OFFER_COLUMNS)
+        if self.rtree:
+            source = """
+                FROM business_locations r
+                JOIN businesses b ON b.rowid = r.id
+                JOIN offers o ON o.business_id = b.id AND o.is_active = 1
+                WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lng >= ? AND r.min_lng <= ?
+            """
+        else:
+            source = """
+                FROM businesses b
+                JOIN offers o ON o.business_id = b.id AND o.is_active = 1
+                WHERE b.latitude BETWEEN ? AND ? AND b.longitude BETWEEN ? AND ?
+                  AND b.latitude != 0 AND b.longitude != 0
+            """
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                f"SELECT {business_columns}, {offer_columns} {source} ORDER BY b.rowid, o.rowid",
+                (min_lat, max_lat, min_lng, max_lng)
+            ).fetchall()
+
+        split = len(BUSINESS_COLUMNS)
+        return [(row[:split], row[split:split + 6] + (True,) + row[split + 7:]) for row in rows]
+
+    # Geofence position relay
+
+    def touch_geofence_sessions(self, session_ids):
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany("INSERT OR REPLACE INTO geofence_sessions (id, seen_at) VALUES (?, ?)",
+                             [(session_id, now) for session_id in session_ids])
+
+    def drop_geofence_session(self, session_id):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM geofence_sessions WHERE id = ?", (session_id,))
+            conn.execute("DELETE FROM geofence_positions WHERE session_id = ?", (session_id,))
+
+    def relay_geofence_position(self, session_id, lat, lng, max_age_seconds):
+        with self.transaction() as conn:
+            live = conn.execute("SELECT 1 FROM geofence_sessions WHERE id = ? AND seen_at >= ?",
+                                (session_id, time.time() - max_age_seconds)).fetchone()
+            if live is None:
+                return False
+            conn.execute("INSERT INTO geofence_positions (session_id, latitude, longitude) VALUES (?, ?, ?)",
+                         (session_id, lat, lng))
+            # Positions are read within a poll interval, keep only the recent ones
+            conn.execute("DELETE FROM geofence_positions WHERE id <= last_insert_rowid() - ?",
+                         (GEOFENCE_POSITIONS_RETAIN,))
+        return True
+
+    def geofence_positions_since(self, position_id):
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                "SELECT id, session_id, latitude, longitude FROM geofence_positions WHERE id > ? ORDER BY id",
+                (position_id,)
+            ).fetchall()
+        if not rows:
+            return position_id, []
+        return rows[-1][0], [row[1:] for row in rows]
+
+    def close(self):
+        self.pool.close()
+
+
+# Available backends, selectable through the STORAGE_BACKEND env variable
+STORAGE_BACKENDS = {
+    'memory': MemoryBackend,
+    'sqlite': SQLiteBackend,
+}
+
+
+def create_storage_backend(kind=None, **options):
+    """
+    Build the configured storage backend (defaults to memory only)
+    """
+    kind = kind or os.environ.get('STORAGE_BACKEND', 'memory')
+    if kind not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown storage backend: {kind}")
+    if kind == 'sqlite':
+        options.setdefault('path', os.environ.get('SQLITE_PATH', 'geoofertas.db'))
+        options.setdefault('pool_size', int(os.environ.get('SQLITE_POOL_SIZE', 4)))
+        options.setdefault('spatial_queries', os.environ.get('SQLITE_SPATIAL_QUERIES', '1') != '0')
+    return STORAGE_BACKENDS[kind](**options)
@@ -0,0 +1,18 @@
+"""
+Fixtures for the modules that read the app's repository (ranking, expiry,
+search, analytics). The app is only imported by the tests that ask for it.
+"""
+import pytest
+
+
+@pytest.fixture
+def app_repository():
+    """
+    The app's in-memory repository, emptied before and after each test
+    """
+    import main  # noqa: F401, sets up the app before its modules are used
+    from app import repository
+
+    repository.clear()
+    yield repository
+    repository.clear()
@@ -0,0 +1,37 @@
+"""
+Stand-ins for the models records, shared by the tests. Importing models
+loads the whole app, which the repository and snapshot tests do not need.
+"""
+
+BUENOS_AIRES = (-34.6037, -58.3816)
+
+
+class Business:
+    def __init__(self, id, email, name='Negocio', password_hash='x', phone='', address='', latitude=0.0,
+                 longitude=0.0):
+        self.id, self.email, self.name, self.password_hash = str(id), email, name, password_hash
+        self.phone, self.address = phone, address
+        self.latitude, self.longitude = float(latitude), float(longitude)
+
+    def has_location(self):
+        return self.latitude != 0 and self.longitude != 0
+
+
+class Offer:
+    def __init__(self, id, business_id, title='Oferta', description='Descripción', discount_percentage=10,
+                 valid_until='2030-12-31', is_active=True, category='OTHER'):
+        self.id, self.business_id, self.title, self.description = str(id), str(business_id), title, description
+        self.discount_percentage, self.valid_until = int(discount_percentage), valid_until
+        self.is_active, self.category = is_active, category
+
+
+class Profile:
+    def __init__(self, id, interests=(), min_discount=5, max_distance=1000, favorite_businesses=(),
+                 excluded_businesses=()):
+        self.id, self.interests = str(id), frozenset(interests)
+        self.min_discount, self.max_distance = min_discount, max_distance
+        self.favorite_businesses, self.excluded_businesses = frozenset(favorite_businesses), frozenset(excluded_businesses)
+
+
+def located_business(business_id, email=None, latitude=BUENOS_AIRES[0], longitude=BUENOS_AIRES[1]):
+    return Business(business_id, email or f'b{business_id}@example.com', latitude=latitude, longitude=longitude)
@@ -0,0 +1,78 @@
+"""
+The analytics ring buffer: reading across the wrap-around, overwritten
+events counted as dropped, and slots claimed but not yet written.
+"""
+import threading
+
+from analytics import EventBuffer
+
+
+def test_events_are_drained_in_order_across_the_wrap_around():
+    buffer = EventBuffer(capacity=4)
+    drained = []
+    for start in range(0, 30, 3):
+        for event in range(start, start + 3):
+            buffer.append(event)
+        drained.extend(buffer.drain())
+
+    assert drained == list(range(30))
+    assert buffer.dropped == 0
+    assert buffer.flushed == 30
+    assert buffer.drain() == []
+
+
+def test_overwritten_events_are_dropped_and_the_newest_kept():
+    buffer = EventBuffer(capacity=4)
+    for event in range(10):
+        buffer.append(event)
+
+    assert buffer.drain() == [6, 7, 8, 9]
+    assert buffer.dropped == 6
+    assert buffer.flushed == 4
+
+
+def test_draining_resumes_after_an_overwrite():
+    buffer = EventBuffer(capacity=4)
+    buffer.append(0)
+    buffer.append(1)
+    assert buffer.drain() == [0, 1]
+
+    for event in range(2, 13):
+        buffer.append(event)
+    assert buffer.drain() == [9, 10, 11, 12]
+    assert buffer.dropped == 7
+
+    buffer.append(13)
+    assert buffer.drain() == [13]
+    assert buffer.flushed + buffer.dropped == 14
+
+
+def test_a_claimed_slot_not_yet_written_is_read_on_the_next_drain():
+    buffer = EventBuffer(capacity=8)
+    buffer.append('a')
+    # A writer that took its sequence number but has not stored the event
+    sequence = next(buffer._sequence)
+    buffer.append('c')
+
+    assert buffer.drain() == ['a']
+    buffer._slots[sequence % buffer.capacity] = (sequence, 'b')
+    assert buffer.drain() == ['b', 'c']
+    assert buffer.dropped == 0
+
+
+def test_concurrent_writers_lose_nothing_while_the_buffer_keeps_up():
+    buffer = EventBuffer(capacity=1 << 16)
+    writers = [threading.Thread(target=lambda w=w: [buffer.append((w, i)) for i in range(5000)]) for w in range(8)]
+    drained = []
+    for writer in writers:
+        writer.start()
+    while any(writer.is_alive() for writer in writers):
+        drained.extend(buffer.drain())
+    for writer in writers:
+        writer.join()
+    drained.extend(buffer.drain())
+
+    assert len(drained) == 8 * 5000
+    assert buffer.dropped == 0
+    for w in range(8):
+        assert [i for writer, i in drained if writer == w] == list(range(5000))
@@ -0,0 +1,62 @@
+"""
+When a stored password hash is replaced at login: other method
+parameters, another salt length, or a format from older releases.
+"""
+import hashlib
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+from auth import PasswordHasher, method_parameters, DEFAULT_PBKDF2_ITERATIONS
+
+
+@pytest.fixture
+def hasher():
+    hasher = PasswordHasher('pbkdf2:sha256:1000', salt_length=16)
+    yield hasher
+    hasher._executor.shutdown()
+
+
+def test_current_parameters_need_no_rehash(hasher):
+    assert not hasher.needs_rehash(hasher.hash('secreto'))
+    assert not hasher.needs_rehash(generate_password_hash('secreto', 'pbkdf2:sha256:1000', 16))
+
+
+def test_changed_iterations_need_a_rehash(hasher):
+    assert hasher.needs_rehash(generate_password_hash('secreto', 'pbkdf2:sha256:2000', 16))
+    assert hasher.needs_rehash(generate_password_hash('secreto', 'pbkdf2:sha512:1000', 16))
+    assert hasher.needs_rehash(generate_password_hash('secreto', 'scrypt:16384:8:1', 16))
+
+
+def test_changed_salt_length_needs_a_rehash(hasher):
+    assert hasher.needs_rehash(generate_password_hash('secreto', 'pbkdf2:sha256:1000', 8))
+    assert hasher.needs_rehash(generate_password_hash('secreto', 'pbkdf2:sha256:1000', 32))
+
+
+def test_defaults_left_out_of_the_method_string_are_the_same_parameters():
+    assert method_parameters('scrypt') == method_parameters('scrypt:32768:8:1')
+    assert method_parameters('pbkdf2') == ('pbkdf2', 'sha256', str(DEFAULT_PBKDF2_ITERATIONS))
+
+    hasher = PasswordHasher('scrypt', salt_length=16)
+    try:
+        assert not hasher.needs_rehash(generate_password_hash('secreto', 'scrypt:32768:8:1', 16))
+    finally:
+        hasher._executor.shutdown()
+
+
+def test_legacy_hashes_are_verified_then_rehashed(hasher):
+    # werkzeug before 2.3 wrote pbkdf2:sha256:<iterations> with short salts;
+    # older releases plain sha256$salt$digest, which no longer verifies
+    legacy = 'pbkdf2:sha256:260000$' + 'abcdefgh' + '$' + hashlib.pbkdf2_hmac(
+        'sha256', b'secreto', b'abcdefgh', 260000).hex()
+    matches, new_hash = hasher.verify(legacy, 'secreto')
+
+    assert matches
+    assert new_hash is not None and not hasher.needs_rehash(new_hash)
+    assert hasher.verify(new_hash, 'secreto') == (True, None)
+    assert hasher.needs_rehash('sha256$abcdefgh$' + hashlib.sha256(b'abcdefghsecreto').hexdigest())
+    assert hasher.needs_rehash('5f4dcc3b5aa765d61d8327deb882cf99')
+
+
+def test_wrong_password_is_never_rehashed(hasher):
+    assert hasher.verify(generate_password_hash('secreto', 'pbkdf2:sha256:2000', 8), 'otro') == (False, None)
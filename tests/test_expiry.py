@@ -0,0 +1,86 @@
+"""
+Offers lapsing at the end of their valid_until day, and what an expiry
+takes them out of: the active offer indexes, text search, nearby results
+and the cached nearby responses.
+"""
+import datetime
+
+import pytest
+
+from records import BUENOS_AIRES
+
+DAY = datetime.date(2031, 3, 10)
+# Midnight after DAY in server local time, when an offer valid until DAY lapses
+BOUNDARY = datetime.datetime.combine(DAY + datetime.timedelta(days=1), datetime.time.min).timestamp()
+
+
+@pytest.fixture
+def expiry(app_repository):
+    import expiry
+    return expiry
+
+
+@pytest.fixture
+def offers(app_repository):
+    from models import Business, Offer
+
+    app_repository.add_businesses([Business('1', 'b1@example.com', 'Negocio', 'x', '', '', *BUENOS_AIRES)])
+    offers = [Offer('1', '1', 'Medialunas', 'Docena', 20, DAY.isoformat()),
+              Offer('2', '1', 'Medialunas', 'Media docena', 10, (DAY + datetime.timedelta(days=1)).isoformat()),
+              Offer('3', '1', 'Medialunas', 'Sin fecha', 10, '')]
+    app_repository.add_offers(offers)
+    return offers
+
+
+def test_an_offer_is_live_until_the_end_of_its_day(expiry, offers):
+    offer = offers[0]
+
+    assert expiry.parse_valid_until(DAY.isoformat()) == BOUNDARY
+    assert expiry.offer_is_live(offer, now=BOUNDARY - 0.001)
+    assert not expiry.offer_is_live(offer, now=BOUNDARY)
+    assert expiry.offer_is_live(offers[2], now=BOUNDARY + 10 ** 9)
+    assert expiry.parse_valid_until('10/03/2031') is None
+
+
+def test_scheduler_deactivates_offers_at_the_day_boundary(expiry, app_repository, offers):
+    scheduler = expiry.ExpiryScheduler(app_repository)
+    scheduler._reschedule_all()
+
+    assert scheduler.next_expiry() == BOUNDARY
+    assert scheduler.expire_due(now=BOUNDARY - 1) == 0
+    assert scheduler.expire_due(now=BOUNDARY) == 1
+    assert not app_repository.get_offer('1').is_active
+    assert app_repository.get_offer('2').is_active
+    assert scheduler.next_expiry() == BOUNDARY + 24 * 3600
+
+
+def test_extended_offers_are_not_expired_at_their_old_date(expiry, app_repository, offers):
+    scheduler = expiry.ExpiryScheduler(app_repository)
+    scheduler._reschedule_all()
+    offers[0].update(valid_until=(DAY + datetime.timedelta(days=5)).isoformat())
+
+    assert scheduler.expire_due(now=BOUNDARY) == 0
+    assert app_repository.get_offer('1').is_active
+
+
+def test_expired_offers_leave_indexes_and_cached_responses(expiry, app_repository, offers):
+    from app import offer_text_index, nearby_offers_cache
+    from api import nearby_offers_key, nearby_offers_body
+    from geofence import get_nearby_offers
+    from search import query_terms
+
+    key, _ = nearby_offers_key(*BUENOS_AIRES, 500)
+    assert b'"Docena"' in nearby_offers_body(key)
+    assert nearby_offers_cache.get(key) is not None
+
+    scheduler = expiry.ExpiryScheduler(app_repository)
+    scheduler._reschedule_all()
+    scheduler.expire_due(now=BOUNDARY)
+
+    assert nearby_offers_cache.get(key) is None
+    assert '1' not in {offer.id for offer in app_repository.active_offers()}
+    assert app_repository.active_offer_count('1') == 2
+    assert '1' not in {offer.id for offer in app_repository.active_category_offers('1', offers[0].category)}
+    assert '1' not in offer_text_index.match(tuple(query_terms('docena')))
+    assert '1' not in {offer.id for offer, _, _ in get_nearby_offers(*BUENOS_AIRES, 500)}
+    assert b'"Docena"' not in nearby_offers_body(key)
@@ -0,0 +1,56 @@
+"""
+Proximity checks on the packed business coordinates: the batch haversine
+against the scalar formula, and geofence enter/exit at the radius edges.
+"""
+import random
+
+import pytest
+
+from records import BUENOS_AIRES
+
+
+@pytest.fixture
+def businesses(app_repository):
+    from models import Business
+
+    rng = random.Random(2)
+    businesses = [Business(str(i), f'b{i}@example.com', 'Negocio', 'x', '', '',
+                           BUENOS_AIRES[0] + rng.uniform(-0.01, 0.01), BUENOS_AIRES[1] + rng.uniform(-0.01, 0.01))
+                  for i in range(1, 200)]
+    # Across the antimeridian and next to a pole
+    businesses += [Business('200', 'b200@example.com', 'Isla', 'x', '', '', -16.5, 179.9997),
+                   Business('201', 'b201@example.com', 'Base', 'x', '', '', -89.9, 45.0)]
+    app_repository.add_businesses(businesses)
+    return businesses
+
+
+def test_batch_distances_match_the_scalar_haversine(businesses):
+    from geofence import business_distances, haversine_distance
+
+    for lat, lng in [BUENOS_AIRES, (-16.5, -179.99), (-90.0, 0.0)]:
+        ids, distances = business_distances(lat, lng)
+        by_id = {business.id: business for business in businesses}
+        assert sorted(ids) == sorted(by_id)
+        for business_id, distance in zip(ids, distances):
+            business = by_id[business_id]
+            assert distance == pytest.approx(haversine_distance(lat, lng, business.latitude, business.longitude),
+                                             rel=1e-9, abs=1e-6)
+
+
+def test_geofence_enters_at_the_radius_and_exits_past_the_margin(businesses):
+    from geofence import destination_point
+    from geofence_stream import GeofenceSession
+
+    business = businesses[-2]
+    session = GeofenceSession('s', radius_meters=100, exit_margin_meters=30)
+
+    # About 30m west of the antimeridian: moving east crosses it
+    def move(meters):
+        return session.update_position(*destination_point(business.latitude, business.longitude, 90, meters))
+
+    assert move(101) == []
+    assert [event['type'] for event in move(99)] == ['enter']
+    assert move(120) == []
+    assert [event['type'] for event in move(131)] == ['exit']
+    assert destination_point(business.latitude, business.longitude, 90, 99)[1] < 0
+    assert [event['business_id'] for event in move(-50)] == [business.id]
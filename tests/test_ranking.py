@@ -0,0 +1,103 @@
+"""
+The heap top-k of rank_nearby_offers against scoring every candidate and
+sorting them all.
+"""
+import random
+
+import pytest
+
+from records import Offer, Profile, BUENOS_AIRES, located_business
+
+CATEGORIES = ['FOOD_COFFEE', 'FASHION_APPAREL', 'GROCERY', 'OTHER']
+
+
+@pytest.fixture
+def ranking(app_repository):
+    import ranking
+    return ranking
+
+
+def full_sort(ranking, profile, radius):
+    """
+    (offer id, score) of every active offer in range, best first
+    """
+    from geofence import get_nearby_businesses
+
+    scored = []
+    for business_id, distance in get_nearby_businesses(*BUENOS_AIRES, radius):
+        for category in CATEGORIES:
+            for offer in ranking.repository.active_category_offers(business_id, category):
+                score = (ranking.category_score(category, profile) * ranking.distance_score(distance, profile)
+                         * ranking.personalization_score(business_id, profile)
+                         * ranking.discount_score(offer.discount_percentage, profile))
+                scored.append((offer.id, score))
+    return sorted(scored, key=lambda item: item[1], reverse=True)
+
+
+def add_offers(repository, rng, businesses, offers, discounts):
+    repository.add_businesses([
+        located_business(str(i), latitude=BUENOS_AIRES[0] + rng.uniform(-0.01, 0.01),
+                         longitude=BUENOS_AIRES[1] + rng.uniform(-0.01, 0.01))
+        for i in range(businesses)
+    ])
+    repository.add_offers([
+        Offer(str(i), str(rng.randrange(businesses)), discount_percentage=rng.choice(discounts),
+              category=rng.choice(CATEGORIES), is_active=rng.random() > 0.1)
+        for i in range(offers)
+    ])
+
+
+def assert_top_k(ranked, expected, limit):
+    scores = [score for _, _, _, score in ranked]
+    assert len(ranked) == min(limit, len(expected))
+    assert scores == pytest.approx([score for _, score in expected[:limit]])
+    # Among tied scores any offer may be kept, but only offers that tie
+    cutoff = scores[-1] if scores else None
+    assert {offer.id for offer, _, _, _ in ranked} >= {offer_id for offer_id, score in expected
+                                                       if cutoff is not None and score > cutoff * (1 + 1e-9)}
+    assert {offer.id for offer, _, _, _ in ranked} <= {offer_id for offer_id, _ in expected}
+
+
+@pytest.mark.parametrize('limit', [1, 5, 20, 100])
+def test_top_k_matches_a_full_sort(ranking, app_repository, limit):
+    rng = random.Random(limit)
+    add_offers(app_repository, rng, businesses=30, offers=200, discounts=range(1, 91))
+    profile = Profile('p', interests={'FOOD_COFFEE'}, min_discount=10, max_distance=800,
+                      favorite_businesses={'3', '7'}, excluded_businesses={'5'})
+
+    ranked = ranking.rank_nearby_offers(*BUENOS_AIRES, profile, limit=limit)
+
+    assert_top_k(ranked, full_sort(ranking, profile, 1200), limit)
+
+
+def test_ties_keep_only_offers_at_the_cutoff_score(ranking, app_repository):
+    # Few distinct scores: one business, two categories, two discounts
+    app_repository.add_businesses([located_business('1')])
+    app_repository.add_offers([Offer(str(i), '1', discount_percentage=20 if i % 2 else 30,
+                                     category=CATEGORIES[i % 2]) for i in range(40)])
+    profile = Profile('p', interests={'FASHION_APPAREL'}, min_discount=10)
+
+    for limit in (1, 10, 19, 20, 21, 39):
+        ranked = ranking.rank_nearby_offers(*BUENOS_AIRES, profile, limit=limit)
+        assert_top_k(ranked, full_sort(ranking, profile, 1500), limit)
+
+
+def test_limit_above_the_candidates_returns_them_all(ranking, app_repository):
+    rng = random.Random(1)
+    add_offers(app_repository, rng, businesses=5, offers=12, discounts=[5, 15, 50])
+    profile = Profile('p', interests={'GROCERY'})
+
+    ranked = ranking.rank_nearby_offers(*BUENOS_AIRES, profile, limit=1000)
+    expected = full_sort(ranking, profile, 1500)
+
+    assert_top_k(ranked, expected, 1000)
+    assert len(ranked) == len(expected)
+
+
+def test_zero_or_negative_limit_returns_nothing(ranking, app_repository):
+    app_repository.add_businesses([located_business('1')])
+    app_repository.add_offers([Offer('1', '1')])
+    profile = Profile('p')
+
+    assert ranking.rank_nearby_offers(*BUENOS_AIRES, profile, limit=0) == []
+    assert ranking.rank_nearby_offers(*BUENOS_AIRES, profile, limit=-3) == []
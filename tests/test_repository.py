@@ -0,0 +1,337 @@
+"""
+Write-through, secondary indexes and change notifications of the in-memory
+Repository, against a recording backend and a real SQLite file.
+"""
+import pytest
+
+import repository as repository_module
+from repository import Repository
+from storage import StorageBackend, SQLiteBackend, DuplicateRecord, BUSINESS_COLUMNS, OFFER_COLUMNS
+from records import Business, Offer, Profile, BUENOS_AIRES, located_business
+
+
+class RecordingBackend(StorageBackend):
+    """
+    Backend that only records the calls the repository makes
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def insert_businesses(self, businesses):
+        self.calls.append(('insert_businesses', [business.id for business in businesses]))
+
+    def save_business(self, business):
+        self.calls.append(('save_business', business.id))
+
+    def insert_offers(self, offers):
+        self.calls.append(('insert_offers', [offer.id for offer in offers]))
+
+    def save_offer(self, offer):
+        self.calls.append(('save_offer', offer.id))
+
+    def delete_offer(self, offer_id):
+        self.calls.append(('delete_offer', offer_id))
+
+    def save_profile(self, profile):
+        self.calls.append(('save_profile', profile.id))
+
+
+@pytest.fixture
+def backend():
+    return RecordingBackend()
+
+
+@pytest.fixture
+def repository(backend):
+    return Repository(backend)
+
+
+@pytest.fixture
+def sqlite_path(tmp_path):
+    return str(tmp_path / 'geoofertas.db')
+
+
+# Write-through
+
+def test_writes_go_through_to_the_backend(repository, backend):
+    business = located_business('1')
+    repository.add_business(business)
+    offer = Offer('1', '1')
+    repository.add_offer(offer)
+    business.name = 'Otro nombre'
+    repository.business_updated(business)
+    offer.title = 'Otro título'
+    repository.offer_updated(offer)
+    repository.remove_offer(offer)
+
+    assert backend.calls == [
+        ('insert_businesses', ['1']),
+        ('insert_offers', ['1']),
+        ('save_business', '1'),
+        ('save_offer', '1'),
+        ('delete_offer', '1'),
+    ]
+
+
+def test_batch_adds_write_once(repository, backend):
+    repository.add_businesses([located_business(i) for i in ('1', '2', '3')])
+    repository.add_offers([Offer(i, '1') for i in ('1', '2')])
+
+    assert backend.calls == [('insert_businesses', ['1', '2', '3']), ('insert_offers', ['1', '2'])]
+
+
+def test_removing_an_unknown_offer_does_not_write(repository, backend):
+    repository.remove_offer(Offer('9', '1'))
+
+    assert backend.calls == []
+
+
+def test_failed_backend_write_leaves_the_store_untouched(sqlite_path):
+    repository = Repository(SQLiteBackend(sqlite_path))
+    repository.add_business(located_business('1'))
+    version = repository.version
+
+    with pytest.raises(DuplicateRecord):
+        repository.add_business(located_business('2', email='b1@example.com'))
+
+    assert repository.get_business('2') is None
+    assert repository.version == version
+
+
+def test_load_does_not_write_through_and_moves_the_counters(repository, backend):
+    repository.load([located_business('7')], [Offer('12', '7'), Offer('legacy', '7')])
+
+    assert backend.calls == []
+    assert repository.get_business('7') is not None
+    assert repository.next_business_id() == '8'
+    assert repository.next_offer_id() == '13'
+
+
+def test_sqlite_round_trip(sqlite_path):
+    repository = Repository(SQLiteBackend(sqlite_path))
+    business = Business(repository.next_business_id(), 'a@example.com', latitude=BUENOS_AIRES[0],
+                        longitude=BUENOS_AIRES[1])
+    repository.add_business(business)
+    kept, removed = Offer(repository.next_offer_id(), business.id), Offer(repository.next_offer_id(), business.id)
+    repository.add_offers([kept, removed])
+    business.phone = '555-1234'
+    repository.business_updated(business)
+    kept.is_active = False
+    repository.offer_updated(kept)
+    repository.remove_offer(removed)
+
+    reloaded = Repository(SQLiteBackend(sqlite_path))
+    reloaded.load([Business(*row) for row in reloaded.backend.load_businesses()],
+                  [Offer(*row) for row in reloaded.backend.load_offers()])
+
+    assert [reloaded.get_business(business.id).phone] == ['555-1234']
+    assert list(reloaded.offers) == [kept.id]
+    assert reloaded.get_offer(kept.id).is_active is False
+    assert list(reloaded.active_offers()) == []
+
+
+def test_sqlite_ids_are_unique_across_repositories(sqlite_path):
+    first, second = Repository(SQLiteBackend(sqlite_path)), Repository(SQLiteBackend(sqlite_path))
+    first.add_business(Business(first.next_business_id(), 'a@example.com'))
+    second.add_business(Business(second.next_business_id(), 'b@example.com'))
+
+    assert sorted(row[1] for row in first.backend.load_businesses()) == ['a@example.com', 'b@example.com']
+    with pytest.raises(DuplicateRecord):
+        first.add_business(Business('1', 'c@example.com'))
+
+
+def test_profiles_persist_in_a_shared_backend(sqlite_path):
+    repository = Repository(SQLiteBackend(sqlite_path))
+    repository.save_profile(Profile('p1', interests={'GROCERY', 'OTHER'}, min_discount=20,
+                                    favorite_businesses={'3', '1'}))
+
+    assert repository.profiles == {}
+    assert SQLiteBackend(sqlite_path).load_profile('p1') == ('p1', ['GROCERY', 'OTHER'], 20, 1000, ['1', '3'], [])
+    assert SQLiteBackend(sqlite_path).load_profile('p2') is None
+
+
+def test_memory_profiles_are_bounded(repository, backend, monkeypatch):
+    monkeypatch.setattr(repository_module, 'MAX_MEMORY_PROFILES', 2)
+    for profile_id in ('p1', 'p2', 'p3'):
+        repository.save_profile(Profile(profile_id))
+        repository.get_profile('p1')
+
+    assert backend.calls == [('save_profile', 'p1'), ('save_profile', 'p2'), ('save_profile', 'p3')]
+    assert repository.get_profile('p2') is None
+    assert [repository.get_profile(profile_id).id for profile_id in ('p1', 'p3')] == ['p1', 'p3']
+
+
+def test_geofence_positions_are_relayed_only_to_live_sessions(sqlite_path):
+    serving, posting = SQLiteBackend(sqlite_path), SQLiteBackend(sqlite_path)
+    position_id, _ = serving.geofence_positions_since(0)
+    serving.touch_geofence_sessions(['s1'])
+
+    assert posting.relay_geofence_position('s1', *BUENOS_AIRES, max_age_seconds=30)
+    assert not posting.relay_geofence_position('s2', *BUENOS_AIRES, max_age_seconds=30)
+    assert serving.geofence_positions_since(position_id)[1] == [('s1', *BUENOS_AIRES)]
+
+    serving.drop_geofence_session('s1')
+    assert not posting.relay_geofence_position('s1', *BUENOS_AIRES, max_age_seconds=30)
+
+
+# Secondary indexes
+
+def test_business_indexes_follow_updates(repository):
+    business = located_business('1')
+    repository.add_business(business)
+
+    assert repository.get_business_by_email('b1@example.com') is business
+    assert '1' in repository.business_index.query_radius(*BUENOS_AIRES, 500)
+    assert repository.business_coordinates.ids == ['1']
+
+    business.latitude = business.longitude = 0.0
+    repository.business_updated(business)
+
+    assert repository.businesses_with_location() == []
+    assert '1' not in repository.business_index.query_radius(*BUENOS_AIRES, 500)
+    assert repository.business_coordinates.ids == []
+
+
+def test_offer_indexes_follow_updates(repository):
+    repository.add_business(located_business('1'))
+    offer = Offer('1', '1', category='FOOD_COFFEE')
+    repository.add_offer(offer)
+
+    assert repository.business_offers('1') == [offer]
+    assert repository.active_business_offers('1') == [offer]
+    assert list(repository.active_category_offers('1', 'FOOD_COFFEE')) == [offer]
+
+    offer.category = 'GROCERY'
+    repository.offer_updated(offer)
+
+    assert list(repository.active_category_offers('1', 'FOOD_COFFEE')) == []
+    assert list(repository.active_category_offers('1', 'GROCERY')) == [offer]
+
+    offer.is_active = False
+    repository.offer_updated(offer)
+
+    assert repository.business_offers('1') == [offer]
+    assert repository.active_business_offers('1') == []
+    assert repository.active_offer_count('1') == 0
+    assert list(repository.active_category_offers('1', 'GROCERY')) == []
+    assert list(repository.active_offers()) == []
+
+
+def test_removed_offer_leaves_every_index(repository):
+    repository.add_business(located_business('1'))
+    offer, other = Offer('1', '1'), Offer('2', '1')
+    repository.add_offers([offer, other])
+    repository.remove_offer(offer)
+
+    assert repository.get_offer('1') is None
+    assert repository.business_offers('1') == [other]
+    assert repository.active_business_offers('1') == [other]
+    assert list(repository.active_category_offers('1', 'OTHER')) == [other]
+    assert list(repository.active_offers()) == [other]
+
+    repository.remove_offer(other)
+
+    assert repository.business_offers('1') == []
+    assert repository.active_offer_count('1') == 0
+
+
+# Version and listeners
+
+def test_every_write_bumps_the_version_once(repository):
+    versions = [repository.version]
+    business = located_business('1')
+    repository.add_businesses([business, located_business('2')])
+    versions.append(repository.version)
+    offer = Offer('1', '1')
+    repository.add_offer(offer)
+    versions.append(repository.version)
+    repository.business_updated(business)
+    versions.append(repository.version)
+    repository.offer_updated(offer)
+    versions.append(repository.version)
+    repository.remove_offer(offer)
+    versions.append(repository.version)
+
+    assert versions == list(range(versions[0], versions[0] + 6))
+
+
+def test_change_listeners_get_the_touched_records(repository):
+    changes = []
+    calls = []
+    repository.add_change_listener(changes.append)
+    repository.add_listener(lambda: calls.append(repository.version))
+
+    repository.add_business(located_business('1'))
+    offer = Offer('1', '1')
+    repository.add_offer(offer)
+    repository.remove_offer(offer)
+    repository.load([], [])
+
+    assert changes == [
+        (('business', '1'),),
+        (('offer', '1'), ('business', '1')),
+        (('offer', '1'), ('business', '1')),
+        (),
+    ]
+    assert len(calls) == 4
+
+
+def test_changes_since(repository):
+    repository.add_business(located_business('1'))
+    revision = repository.version
+    offer = Offer('1', '1')
+    repository.add_offer(offer)
+    repository.business_updated(repository.get_business('1'))
+
+    assert repository.changes_since(revision) == {'business': {'1'}, 'offer': {'1'}}
+    assert repository.changes_since(repository.version) == {'business': set(), 'offer': set()}
+    assert repository.changes_since(repository.version + 1) is None
+
+
+def test_changes_since_before_the_retained_log_needs_a_resync(backend):
+    repository = Repository(backend, change_log_limit=4)
+    start = repository.version
+    for i in range(1, 10):
+        repository.add_business(located_business(str(i)))
+
+    assert repository.changes_since(start) is None
+    assert repository.changes_since(repository.version - 1) == {'business': {'9'}, 'offer': set()}
+
+
+def test_clear_resets_the_change_log(repository):
+    repository.add_business(located_business('1'))
+    revision = repository.version
+    repository.clear()
+
+    assert repository.businesses == {}
+    assert repository.business_coordinates.ids == []
+    assert repository.changes_since(revision) is None
+
+
+def test_refresh_updates_in_place_without_writing_through(repository, backend):
+    business = located_business('1')
+    repository.add_business(business)
+    offer, removed = Offer('1', '1'), Offer('2', '1')
+    repository.add_offers([offer, removed])
+    backend.calls.clear()
+    writes, changes = [], []
+    repository.add_write_listener(lambda changes: writes.append(repository.version))
+    repository.add_change_listener(changes.append)
+
+    row = {column: getattr(business, column) for column in BUSINESS_COLUMNS}
+    row.update(email='nuevo@example.com', latitude=0.0, longitude=0.0)
+    offer_row = {column: getattr(offer, column) for column in OFFER_COLUMNS}
+    offer_row.update(title='Nuevo título', is_active=False)
+    repository.refresh([Business(**row)], [Offer(**offer_row), Offer('3', '1')], removed_offer_ids=['2'])
+
+    assert backend.calls == []
+    assert writes == []
+    assert repository.get_business('1') is business
+    assert repository.get_business_by_email('nuevo@example.com') is business
+    assert repository.get_business_by_email('b1@example.com') is None
+    assert repository.business_coordinates.ids == []
+    assert repository.get_offer('1') is offer and offer.title == 'Nuevo título'
+    assert repository.get_offer('2') is None
+    assert [o.id for o in repository.active_business_offers('1')] == ['3']
+    assert len(changes) == 1 and ('offer', '2') in changes[0] and ('business', '1') in changes[0]
@@ -0,0 +1,123 @@
+"""
+Tokenisation of offer text, the inverted index following offer writes,
+and its results against the substring scan it replaced.
+"""
+import random
+
+import pytest
+
+from repository import Repository
+from search import OfferTextIndex, fold, tokenize, query_terms
+from records import Offer, located_business
+
+
+@pytest.fixture
+def repository():
+    repository = Repository()
+    repository.add_businesses([located_business('1')])
+    return repository
+
+
+@pytest.fixture
+def index(repository):
+    return OfferTextIndex(repository)
+
+
+def search(index, query):
+    return index.match(query_terms(query))
+
+
+def test_text_is_lowercased_and_accent_folded():
+    assert fold('CAFÉ Ñandú Über') == 'cafe nandu uber'
+    assert tokenize('Café con LECHE') == ['cafe', 'leche']
+    assert query_terms('café CAFE cafe') == ['cafe']
+
+
+def test_plurals_meet_their_singular_and_stopwords_are_dropped():
+    assert tokenize('cafés panes flores postres') == tokenize('café pan flor postre')
+    assert tokenize('2x1 en las pizzas') == ['2x1', 'pizza']
+    assert tokenize('de la') == []
+
+
+def test_queries_match_whatever_the_case_and_accents(repository, index):
+    repository.add_offer(Offer('1', '1', title='Café de especialidad', description='Tostado en el local'))
+
+    for query in ('cafe', 'CAFÉ', 'Cafés', 'cafe especialidad', 'TOSTADO'):
+        assert search(index, query) == {'1'}, query
+    assert search(index, 'te') == set()
+
+
+def test_the_last_term_matches_as_a_prefix(repository, index):
+    repository.add_offers([Offer('1', '1', title='Empanadas salteñas'), Offer('2', '1', title='Empanadas de carne')])
+
+    assert search(index, 'empan') == {'1', '2'}
+    assert search(index, 'empanadas salt') == {'1'}
+    assert search(index, 'empan salteñas') == set()
+
+
+def test_updates_reindex_the_changed_text(repository, index):
+    offer = Offer('1', '1', title='Pizza grande', description='Muzzarella')
+    repository.add_offer(offer)
+
+    offer.title, offer.description = 'Helado artesanal', 'Cuarto kilo'
+    repository.offer_updated(offer)
+
+    assert search(index, 'pizza') == set()
+    assert search(index, 'muzzarella') == set()
+    assert search(index, 'helado kilo') == {'1'}
+    assert index.term_count == len(tokenize('Helado artesanal Cuarto kilo'))
+
+
+def test_deleted_and_deactivated_offers_leave_the_index(repository, index):
+    kept, deleted, paused = Offer('1', '1', title='Sushi'), Offer('2', '1', title='Sushi'), Offer('3', '1', title='Sushi')
+    repository.add_offers([kept, deleted, paused])
+
+    repository.remove_offer(deleted)
+    paused.is_active = False
+    repository.offer_updated(paused)
+
+    assert search(index, 'sushi') == {'1'}
+    paused.is_active = True
+    repository.offer_updated(paused)
+    assert search(index, 'sushi') == {'1', '3'}
+
+
+def test_rebuild_matches_incremental_updates(repository, index):
+    repository.add_offers([Offer(str(i), '1', title=f'Oferta {i % 7}', description='Vinos y quesos')
+                           for i in range(30)])
+    incremental = {term: search(index, term) for term in ('vino', 'quesos', 'oferta')}
+
+    index._on_change(())
+
+    assert {term: search(index, term) for term in incremental} == incremental
+
+
+# Words none of which contains another, so whole-word queries mean the same
+# thing to the index and to a substring scan over the folded text
+WORDS = ['café', 'pizza', 'cerveza', 'helado', 'menú', 'librería', 'zapatos', 'sushi', 'empanada', 'vino',
+         'panadería', 'peluquería', 'Descuento', 'PROMO', '2x1']
+
+
+def substring_scan(repository, query):
+    needle = fold(query)
+    return {offer.id for offer in repository.active_offers()
+            if needle in fold(offer.title) or needle in fold(offer.description)}
+
+
+def test_whole_word_queries_match_the_substring_scan(repository, index):
+    rng = random.Random(21)
+    offers = [Offer(str(i), '1', title=' '.join(rng.choices(WORDS, k=2)), description=' '.join(rng.choices(WORDS, k=4)),
+                    is_active=rng.random() > 0.2)
+              for i in range(500)]
+    repository.add_offers(offers)
+    # Some text changes and deletions on the way
+    for offer in rng.sample(offers, 50):
+        offer.title = ' '.join(rng.choices(WORDS, k=2))
+        repository.offer_updated(offer)
+    for offer in rng.sample(offers, 20):
+        if repository.get_offer(offer.id):
+            repository.remove_offer(offer)
+
+    for word in WORDS:
+        for query in (word, word.upper(), fold(word)):
+            assert search(index, query) == substring_scan(repository, word), query
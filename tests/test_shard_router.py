@@ -0,0 +1,137 @@
+"""
+The shard router: closest-first merging of shard responses, and what a
+client gets when some or all of the shards fail.
+"""
+import io
+import json
+from urllib.error import URLError
+
+import pytest
+
+import shard_router
+from shard_router import ShardRouter, merge_nearby_responses
+from sharding import ShardMap
+
+NODES = ['http://a', 'http://b', 'http://c']
+# Wide enough around Buenos Aires to overlap cells of every shard
+QUERY = {'lat': '-34.6', 'lng': '-58.4', 'radius': '300000'}
+
+
+def flat_offer(offer_id, distance, business_id='1'):
+    return {'id': offer_id, 'business_id': business_id, 'distance': distance}
+
+
+def test_flat_responses_merge_closest_first_without_repeats():
+    merged = merge_nearby_responses([
+        {'offers': [flat_offer('1', 10), flat_offer('4', 300)], 'count': 2},
+        {'offers': [flat_offer('2', 20), flat_offer('1', 10), flat_offer('5', 400)], 'count': 3},
+        {'offers': [], 'count': 0},
+    ])
+
+    assert [offer['id'] for offer in merged['offers']] == ['1', '2', '4', '5']
+    assert merged['count'] == 4
+
+
+def test_merging_stops_at_the_limit():
+    merged = merge_nearby_responses([
+        {'offers': [flat_offer(str(i), i * 10) for i in range(0, 10, 2)]},
+        {'offers': [flat_offer(str(i), i * 10) for i in range(1, 10, 2)]},
+    ], limit=3)
+
+    assert [offer['id'] for offer in merged['offers']] == ['0', '1', '2']
+
+
+def test_normalized_responses_merge_businesses_closest_first():
+    merged = merge_nearby_responses([
+        {'businesses': [{'id': 'a', 'distance': 5}, {'id': 'c', 'distance': 50}],
+         'offers': [flat_offer('1', 5, 'a'), flat_offer('3', 50, 'c')]},
+        {'businesses': [{'id': 'b', 'distance': 20}],
+         'offers': [flat_offer('2', 20, 'b'), flat_offer('4', 20, 'b')]},
+    ], shape='normalized')
+
+    assert [business['id'] for business in merged['businesses']] == ['a', 'b', 'c']
+    assert [offer['id'] for offer in merged['offers']] == ['1', '2', '4', '3']
+    assert merged['count'] == 4
+
+
+class StubRouter(ShardRouter):
+    """
+    Router whose shards answer from a dict: shard -> (status, body dict),
+    or an exception to raise
+    """
+
+    def __init__(self, answers):
+        super().__init__(ShardMap(NODES), threads=4)
+        self.answers = answers
+        self.asked = []
+
+    def _fetch(self, shard, path, query):
+        self.asked.append(shard)
+        answer = self.answers[shard]
+        if isinstance(answer, Exception):
+            raise answer
+        status, body = answer
+        return status, json.dumps(body).encode()
+
+
+@pytest.fixture
+def shards():
+    shards = ShardMap(NODES).shards_for_circle(-34.6, -58.4, 300000)
+    assert len(shards) == len(NODES)
+    return shards
+
+
+def test_every_overlapping_shard_is_asked_and_merged(shards):
+    router = StubRouter({shard: (200, {'offers': [flat_offer(str(shard), 100 - shard)], 'count': 1})
+                         for shard in shards})
+
+    status, body = router.route('/api/nearby_offers', QUERY)
+
+    assert status == 200
+    assert sorted(router.asked) == shards
+    merged = json.loads(body)
+    assert [offer['id'] for offer in merged['offers']] == ['2', '1', '0']
+    assert 'partial' not in merged
+
+
+def test_a_failed_shard_makes_the_response_partial(shards):
+    answers = {shard: (200, {'offers': [flat_offer(str(shard), shard)], 'count': 1}) for shard in shards}
+    answers[shards[0]] = URLError('connection refused')
+    answers[shards[1]] = (500, {'error': 'Error interno del servidor'})
+
+    status, body = StubRouter(answers).route('/api/nearby_offers', QUERY)
+
+    assert status == 200
+    merged = json.loads(body)
+    assert merged['partial'] is True
+    assert [offer['id'] for offer in merged['offers']] == [str(shards[2])]
+
+
+def test_client_errors_are_passed_through(shards):
+    answers = {shard: (400, {'error': 'Búsqueda vacía'}) for shard in shards}
+
+    status, body = StubRouter(answers).route('/api/search_offers', QUERY)
+
+    assert status == 400
+    assert json.loads(body) == {'error': 'Búsqueda vacía'}
+
+
+def test_no_shard_answering_is_a_502(shards, monkeypatch):
+    monkeypatch.setattr(shard_router, 'router', StubRouter({shard: URLError('down') for shard in shards}))
+    statuses = []
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/api/nearby_offers',
+               'QUERY_STRING': 'lat=-34.6&lng=-58.4&radius=300000', 'wsgi.input': io.BytesIO()}
+
+    body = b''.join(shard_router.application(environ, lambda status, headers: statuses.append(status)))
+
+    assert statuses == ['502 Bad Gateway']
+    assert json.loads(body) == {'error': 'Servicio no disponible'}
+
+
+def test_invalid_locations_are_rejected_before_fanning_out():
+    router = StubRouter({})
+
+    for query in ({'lat': 'nan', 'lng': '1'}, {'lat': '91', 'lng': '1'}, {'lat': '1', 'lng': '1', 'radius': 'inf'}):
+        status, _ = router.route('/api/nearby_offers', query)
+        assert status == 400
+    assert router.asked == []
@@ -0,0 +1,86 @@
+"""
+Cell assignment of the geo shard map, and what a shard node reads from
+the shared backend.
+"""
+import pytest
+
+from sharding import ShardMap, load_owned_rows
+from storage import SQLiteBackend
+from records import Business, Offer
+
+NODES = ['http://a', 'http://b', 'http://c']
+
+
+@pytest.fixture
+def backend(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / 'geoofertas.db'))
+    yield backend
+    backend.close()
+
+
+def test_shard_nodes_read_exactly_their_own_cells(backend):
+    # City centres, cell edges, the poles, the antimeridian and no location
+    locations = [(-34.6, -58.4), (-31.4, -64.2), (-33.0, -60.65), (-35.0, -58.0), (-34.999, -57.999),
+                 (90.0, 10.0), (-90.0, 5.0), (10.0, 180.0), (10.0, -180.0), (0.0, 0.0), (3.0, 0.0)]
+    backend.insert_businesses([Business(str(i), f'b{i}@example.com', latitude=lat, longitude=lng)
+                               for i, (lat, lng) in enumerate(locations, 1)])
+    backend.insert_offers([Offer(str(i), str(i)) for i in range(1, len(locations) + 1)])
+
+    kept = []
+    for shard in range(len(NODES)):
+        shard_map = ShardMap(NODES, shard)
+        business_rows, offer_rows = load_owned_rows(shard_map, backend)
+        expected = {row[0] for row in backend.load_businesses() if shard_map.owns(row[6], row[7])}
+        assert sorted(row[0] for row in business_rows) == sorted(expected)
+        assert sorted(row[1] for row in offer_rows) == sorted(expected)
+        kept.append(expected)
+
+    unlocated = {'10', '11'}
+    assert all(unlocated <= shard_businesses for shard_businesses in kept)
+    assert sorted(i for shard_businesses in kept for i in shard_businesses - unlocated) == \
+        sorted(str(i) for i in range(1, 10))
+
+
+def test_owned_boxes_skip_empty_regions(backend):
+    backend.insert_businesses([Business('1', 'b1@example.com', latitude=-34.6, longitude=-58.4)])
+    shard_map = ShardMap(NODES, ShardMap(NODES).shard_for(-34.6, -58.4))
+    calls = []
+
+    def occupied(*box):
+        calls.append(box)
+        return backend.has_located_businesses(*box)
+
+    assert shard_map.owned_boxes(occupied) == [(-35.0, -34.0, -59.0, -58.0)]
+    # Two halves per level down to one cell, not one call per cell
+    assert len(calls) < 2 * 20
+
+
+def cell_owners(shard_map):
+    return {(row, column): shard_map.nodes[shard_map.cell_shard(row, column)]
+            for row in range(0, shard_map.rows, 3) for column in range(0, shard_map.columns, 3)}
+
+
+def test_adding_a_node_only_moves_the_cells_it_takes():
+    before = cell_owners(ShardMap(NODES))
+    after = cell_owners(ShardMap(NODES + ['http://d']))
+
+    moved = {cell for cell in before if before[cell] != after[cell]}
+    assert moved == {cell for cell in after if after[cell] == 'http://d'}
+    # About a quarter of the cells, not a reshuffle
+    assert 0.2 < len(moved) / len(before) < 0.3
+
+
+@pytest.mark.parametrize('removed', NODES)
+def test_removing_a_node_only_moves_the_cells_it_held(removed):
+    before = cell_owners(ShardMap(NODES))
+    after = cell_owners(ShardMap([node for node in NODES if node != removed]))
+
+    assert {cell for cell in before if before[cell] != after[cell]} == \
+        {cell for cell in before if before[cell] == removed}
+
+
+def test_every_shard_map_instance_agrees():
+    assert cell_owners(ShardMap(NODES)) == cell_owners(ShardMap(NODES, 1))
+    for lat, lng in [(-34.6, -58.4), (10.0, 180.0), (10.0, -180.0), (90.0, 0.5), (-90.0, -0.5)]:
+        owners = [shard for shard in range(len(NODES)) if ShardMap(NODES, shard).owns(lat, lng)]
+        assert owners == [ShardMap(NODES).shard_for(lat, lng)]
@@ -0,0 +1,77 @@
+"""
+Publishing and reading the shared memory-mapped snapshot, and the
+businesses a publisher reports as pending until its next generation.
+"""
+import pytest
+
+from repository import Repository
+from snapshot import SharedSnapshot, SnapshotPublisher
+from storage import SQLiteBackend
+from records import Offer, BUENOS_AIRES, located_business
+
+
+@pytest.fixture
+def repository(tmp_path):
+    repository = Repository(SQLiteBackend(str(tmp_path / 'geoofertas.db')))
+    yield repository
+    repository.backend.close()
+
+
+@pytest.fixture
+def snapshot_path(tmp_path):
+    return str(tmp_path / 'snapshot')
+
+
+def test_published_generation_lists_active_offers_closest_first(repository, snapshot_path):
+    near, far = located_business('1'), located_business('2', latitude=BUENOS_AIRES[0] + 0.005)
+    repository.add_businesses([near, far])
+    repository.add_offers([Offer('1', '1'), Offer('2', '2'), Offer('3', '2', is_active=False)])
+    SnapshotPublisher(repository, snapshot_path).publish()
+
+    view = SharedSnapshot(snapshot_path).current()
+    nearby = view.nearby(*BUENOS_AIRES, 1000)
+
+    assert [(business_id, offer_ids) for business_id, _, offer_ids in nearby] == [('1', ['1']), ('2', ['2'])]
+    assert nearby[0][1] == pytest.approx(0, abs=1e-6)
+    assert view.nearby(*BUENOS_AIRES, 100)[-1][0] == '1'
+
+
+def test_local_writes_are_pending_until_published(repository, snapshot_path):
+    publisher = SnapshotPublisher(repository, snapshot_path)
+    repository.add_businesses([located_business('1'), located_business('2')])
+    publisher.publish()
+    repository.add_offer(Offer('1', '2'))
+
+    assert publisher.pending_businesses() == {'2'}
+    publisher.publish()
+    assert publisher.pending_businesses() == set()
+
+
+def test_refreshed_records_are_not_pending(repository, snapshot_path):
+    publisher = SnapshotPublisher(repository, snapshot_path)
+    repository.refresh([located_business('1')], [Offer('1', '1')])
+
+    assert publisher.pending_businesses() == set()
+
+
+def test_an_empty_generation_is_still_current(repository, snapshot_path):
+    SnapshotPublisher(repository, snapshot_path).publish()
+
+    assert SharedSnapshot(snapshot_path).generation == 1
+
+
+def test_new_generation_notifies_listeners_once(repository, snapshot_path):
+    publisher = SnapshotPublisher(repository, snapshot_path)
+    shared = SharedSnapshot(snapshot_path)
+    calls = []
+    shared.add_listener(lambda: calls.append(shared.generation))
+
+    assert shared.current() is None
+    publisher.publish()
+    shared.current()
+    shared.current()
+    publisher.publish()
+    shared.current()
+
+    assert len(calls) == 2
+    assert shared.generation == 2
@@ -0,0 +1,75 @@
+"""
+Candidates the grid index hands to the exact distance check: bounded by
+the density around the query, and never missing a point in range, near
+the antimeridian and the poles included.
+"""
+import math
+import random
+
+import pytest
+
+from spatial_index import GridIndex, EARTH_RADIUS_METERS
+from records import BUENOS_AIRES
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def random_point(rng):
+    # Uniform over the sphere, not over the lat/lng rectangle
+    return math.degrees(math.asin(rng.uniform(-1, 1))), rng.uniform(-180, 180)
+
+
+@pytest.mark.parametrize('radius', [1000, 5000])
+def test_candidates_stay_bounded_as_the_index_grows(radius):
+    rng = random.Random(4)
+    index = GridIndex()
+    for i in range(50):
+        index.insert(f'local{i}', BUENOS_AIRES[0] + rng.uniform(-0.01, 0.01), BUENOS_AIRES[1] + rng.uniform(-0.01, 0.01))
+
+    counts = []
+    for size in (1000, 10000, 100000):
+        while len(index) < size:
+            index.insert(f'far{len(index)}', *random_point(rng))
+        counts.append(len(index.query_radius(*BUENOS_AIRES, radius)))
+
+    # The local points, plus at most a few of the 100000 spread over the globe
+    assert all(50 <= count <= 55 for count in counts)
+
+
+QUERIES = [
+    BUENOS_AIRES,
+    (0.0, 179.999), (0.0, -179.999), (-16.5, 180.0), (65.0, -179.5),
+    (90.0, 0.0), (-90.0, 0.0), (89.99, 45.0), (-89.95, -120.0),
+]
+
+
+@pytest.mark.parametrize('cell_size', [500, 20000])
+@pytest.mark.parametrize('radius', [500, 20000, 300000])
+def test_query_radius_finds_every_point_brute_force_does(cell_size, radius):
+    rng = random.Random(cell_size + radius)
+    points = {}
+    for i in range(3000):
+        points[str(i)] = random_point(rng)
+    # Dense clusters around the queries, so every case has points in range
+    for lat, lng in QUERIES:
+        for j in range(40):
+            spread = 3 * radius / 111000
+            point_lat = max(-90.0, min(90.0, lat + rng.uniform(-spread, spread)))
+            point_lng = (lng + rng.uniform(-spread, spread) + 180) % 360 - 180
+            points[f'{lat},{lng},{j}'] = (point_lat, point_lng)
+
+    index = GridIndex(cell_size_meters=cell_size)
+    for point_id, (lat, lng) in points.items():
+        index.insert(point_id, lat, lng)
+
+    for lat, lng in QUERIES:
+        expected = {point_id for point_id, point in points.items() if haversine(lat, lng, *point) <= radius}
+        candidates = index.query_radius(lat, lng, radius)
+        found = {point_id for point_id in candidates if haversine(lat, lng, *points[point_id]) <= radius}
+        assert expected, (lat, lng)
+        assert found == expected, (lat, lng)
+        assert len(candidates) == len(set(candidates))